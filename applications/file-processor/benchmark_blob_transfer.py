@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Benchmark for large blob transfers
+
+Uploads and downloads a large file through the local FakeBlobServer, which
+limits each request to a fixed bandwidth like a long-distance link does to a
+single TCP stream. Compares Azure SDK defaults (one PUT, one GET for anything
+under 32-64 MB) with the processor's parallel staged blocks and ranged GETs.
+
+Usage: python benchmark_blob_transfer.py [--size-mb 128] [--link-mbps 200] [--latency-ms 20] [--concurrency 1 4 8]
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import time
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from azure.storage.blob import BlobServiceClient
+from local_standins import FakeBlobServer
+import process_documents
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parallel blob upload and download")
+    parser.add_argument("--size-mb", type=int, default=128)
+    parser.add_argument("--link-mbps", type=float, default=200, help="bandwidth of a single request, in megabits per second")
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+
+    data = os.urandom(args.size_mb * 1024 * 1024)
+    digest = hashlib.md5(data).digest()
+
+    print("=" * 72)
+    print(f"BLOB TRANSFER BENCHMARK ({args.size_mb} MB, {args.link_mbps:g} Mbit/s per request, {args.latency_ms:g} ms latency)")
+    print("=" * 72)
+    print(f"{'configuration':<28} {'upload (s)':>11} {'download (s)':>13} {'MB/s up':>9} {'MB/s down':>10}")
+
+    with FakeBlobServer(latency=args.latency_ms / 1000, bandwidth=args.link_mbps * 1e6 / 8) as fake:
+        # SDK defaults: single PUT under 64 MB, 32 MB first GET, no parallelism
+        client = BlobServiceClient.from_connection_string(fake.connection_string)
+        client.create_container("benchmark")
+        blob = client.get_blob_client("benchmark", "defaults.bin")
+        upload_time, _ = timed(lambda: blob.upload_blob(data, overwrite=True))
+        download_time, downloaded = timed(lambda: blob.download_blob().readall())
+        assert downloaded == data
+        print(f"{'SDK defaults':<28} {upload_time:>11.2f} {download_time:>13.2f} "
+              f"{args.size_mb / upload_time:>9.1f} {args.size_mb / download_time:>10.1f}")
+
+        # Processor helpers: staged blocks and ranged GETs with per-request MD5
+        process_documents.blob_service_client = process_documents.create_blob_service_client(fake.connection_string)
+        for concurrency in args.concurrency:
+            process_documents.BLOB_MAX_CONCURRENCY = concurrency
+            upload_time, _ = timed(process_documents.upload_blob_data, "benchmark", "parallel.bin", data)
+            download_time, document = timed(process_documents.download_document, "benchmark", "parallel.bin")
+            assert hashlib.md5(document.data).digest() == digest
+            label = f"parallel x{concurrency}, {process_documents.BLOB_BLOCK_SIZE // (1024 * 1024)} MiB blocks"
+            print(f"{label:<28} {upload_time:>11.2f} {download_time:>13.2f} "
+                  f"{args.size_mb / upload_time:>9.1f} {args.size_mb / download_time:>10.1f}")
+
+    print("=" * 72)
+
+if __name__ == "__main__":
+    main()
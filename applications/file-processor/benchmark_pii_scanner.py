@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Benchmark for PII redaction
+
+Compares the previous redaction path (one re.sub pass per PII type followed by
+one re.findall pass per type for the summary counts) with the single-pass
+PIIScanner on synthetic multi-megabyte markdown.
+
+Usage: python benchmark_pii_scanner.py [--size-mb 2 8 32] [--repeat 3]
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from process_documents import VaultKVPIIProtector
+
+SSN = r'\b\d{3}-\d{2}-\d{4}\b'
+EMAIL = r'\b[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b'
+PHONE = r'\b\d{3}-\d{3}-\d{4}\b'
+BANK = r'\b\d{4}-\d{4}-\d{4}-\d{4}\b'
+
+def generate_markdown(size_bytes, seed=42):
+    """Generate markdown with a realistic mix of prose, tables and PII"""
+    rng = random.Random(seed)
+    words = ["policy", "claim", "coverage", "insured", "premium", "deductible", "benefit",
+             "provider", "review", "approved", "pending", "section", "amount", "date"]
+    parts = ["# Synthetic Insurance Binder\n\n"]
+    size = len(parts[0])
+    while size < size_bytes:
+        kind = rng.random()
+        if kind < 0.6:
+            line = " ".join(rng.choice(words) for _ in range(rng.randint(8, 20))) + ".\n"
+        elif kind < 0.7:
+            line = f"SSN: {rng.randint(100, 999)}-{rng.randint(10, 99)}-{rng.randint(1000, 9999)}\n"
+        elif kind < 0.8:
+            line = f"Contact: user{rng.randint(1, 99999)}@example{rng.randint(1, 50)}.com\n"
+        elif kind < 0.9:
+            line = f"| Phone | {rng.randint(100, 999)}-{rng.randint(100, 999)}-{rng.randint(1000, 9999)} |\n"
+        else:
+            line = f"Account {rng.randint(1000, 9999)}-{rng.randint(1000, 9999)}-{rng.randint(1000, 9999)}-{rng.randint(1000, 9999)}\n"
+        parts.append(line)
+        size += len(line)
+    return "".join(parts)
+
+def legacy_redact(text, token):
+    """Previous path: four re.sub passes plus four re.findall passes for counts"""
+    protected = re.sub(SSN, lambda m: f"tok_ssn_{token()}", text)
+    protected = re.sub(EMAIL, lambda m: f"tok_email_{token()}", protected)
+    protected = re.sub(PHONE, "***-***-****", protected)
+    protected = re.sub(BANK, "****-****-****-****", protected)
+    counts = {
+        'ssn': len(re.findall(SSN, text)),
+        'email': len(re.findall(EMAIL, text)),
+        'phone': len(re.findall(PHONE, text)),
+        'bank': len(re.findall(BANK, text))
+    }
+    return protected, counts
+
+def best_of(repeat, func, *args):
+    """Best wall time over several runs, plus the last result"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark single-pass PII scanning")
+    parser.add_argument("--size-mb", type=float, nargs="+", default=[2, 8, 32])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    protector = VaultKVPIIProtector("http://vault.invalid:8200", "benchmark")
+    scanner = protector.build_scanner(
+        {pii_type: re.compile(pattern) for pii_type, pattern in protector._fallback_patterns().items()},
+        protector._fallback_strategies()
+    )
+
+    print("=" * 72)
+    print("PII REDACTION BENCHMARK")
+    print("=" * 72)
+    print(f"{'size':>8} {'legacy (s)':>12} {'scanner (s)':>12} {'MB/s':>10} {'speedup':>9}  counts")
+
+    for size_mb in args.size_mb:
+        text = generate_markdown(int(size_mb * 1024 * 1024))
+        legacy_time, (_, legacy_counts) = best_of(args.repeat, legacy_redact, text, protector._generate_secure_token)
+        scanner_time, (_, scanner_counts) = best_of(args.repeat, scanner.redact, text)
+
+        match = "✓" if legacy_counts == scanner_counts else "✗"
+        throughput = size_mb / scanner_time
+        print(f"{size_mb:>6.1f}MB {legacy_time:>12.3f} {scanner_time:>12.3f} {throughput:>10.1f} "
+              f"{legacy_time / scanner_time:>8.2f}x  {match} {scanner_counts}")
+
+    print("=" * 72)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the document pipeline end to end
+
+Runs synthetic uploads through process_upload() on the UploadScheduler's worker
+lanes, against stand-ins from local_standins.py running in this process:
+FakeBlobServer for storage, MockVaultServer for Vault KV, FakeOpenWebUI, and
+FakeDoclingServe for conversion (or the Docling library with --converter local).
+Each stand-in has its own latency. The corpora are PII-dense markdown, large
+PDFs and many tiny files. For each corpus the benchmark reports documents per
+second, p50/p99 latency per pipeline stage and peak RSS.
+
+Pipeline settings (workers, block sizes, thresholds) come from the same
+environment variables as the processor. --json writes the results together with
+the commit and settings, and --compare prints the change against such a file, so
+runs on different commits can be compared.
+
+Usage: python benchmark_pipeline.py [--corpus pii pdf tiny] [--blob-latency-ms 5] [--vault-latency-ms 5]
+                                    [--openwebui-latency-ms 20] [--docling-latency-ms 5] [--conversion-ms 200]
+                                    [--json results.json] [--compare baseline.json]
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import process_documents
+from local_standins import FakeBlobServer, FakeDoclingServe, FakeOpenWebUI, MockVaultServer
+from process_documents import PendingBlob
+
+STAGES = ("download", "convert", "pii_scan", "vault_fetch", "blob_upload", "openwebui_upload", "kb_add", "document")
+
+FIRST_NAMES = ("Jane", "Omar", "Li", "Priya", "Carlos", "Ana", "Tom", "Fatima")
+LAST_NAMES = ("Doe", "Haddad", "Wei", "Patel", "Garcia", "Silva", "Brown", "Khan")
+
+def pii_line(rng):
+    """A line of prose with an email, SSN, phone number and bank card"""
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    return (f"- {first} {last} <{first.lower()}.{last.lower()}{rng.randint(1, 999)}@example.com>, "
+            f"SSN {rng.randint(100, 899)}-{rng.randint(10, 99)}-{rng.randint(1000, 9999)}, "
+            f"phone {rng.randint(200, 999)}-{rng.randint(200, 999)}-{rng.randint(1000, 9999)}, "
+            f"card {'-'.join(str(rng.randint(1000, 9999)) for _ in range(4))}, renewal due next quarter.\n")
+
+def pii_markdown(index, size, rng):
+    """PII-dense markdown of about `size` bytes"""
+    lines = [f"# Customer contacts {index}\n\n"]
+    total = len(lines[0])
+    while total < size:
+        line = pii_line(rng)
+        lines.append(line)
+        total += len(line)
+    return "".join(lines).encode()
+
+def large_pdf(index, size, rng):
+    """A valid multi-page PDF of about `size` bytes with text (and some PII) on every page"""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    total = 0
+    while total < size:
+        text = [f"Quarterly report {index}, page {len(page_ids) + 1}"] + [pii_line(rng).strip() for _ in range(40)]
+        stream = "BT /F1 9 Tf 40 800 Td 11 TL " + " ".join(
+            f"({line.replace('(', '[').replace(')', ']')}) '" for line in text) + " ET"
+        stream = stream.encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects))
+        page_ids.append(len(objects))
+        total += len(stream) + 160
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % page_id for page_id in page_ids), len(page_ids))
+
+    pdf = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(pdf)
+
+def tiny_file(index, rng):
+    """A short plain-text note"""
+    return f"Note {index}: call {rng.choice(FIRST_NAMES)} at {rng.randint(200, 999)}-555-{rng.randint(1000, 9999)}.\n".encode()
+
+def build_corpus(name, args, seed=1):
+    """(blob name, data, content type) for each document of a corpus, the same on every run"""
+    rng = random.Random(f"{name}-{seed}")
+    if name == "pii":
+        return [(f"contacts/pii-{i}.md", pii_markdown(i, args.pii_kb * 1024, rng), "text/markdown")
+                for i in range(args.pii_docs)]
+    if name == "pdf":
+        return [(f"reports/large-{i}.pdf", large_pdf(i, int(args.pdf_mb * 1024 * 1024), rng), "application/pdf")
+                for i in range(args.pdf_docs)]
+    if name == "tiny":
+        return [(f"inbox/note-{i}.txt", tiny_file(i, rng), "text/plain") for i in range(args.tiny_docs)]
+    raise ValueError(f"Unknown corpus: {name}")
+
+def percentile(values, q):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+class StageRecorder:
+    """Keeps every stage_seconds observation, for exact percentiles instead of bucket estimates"""
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        observe = self.histogram.observe
+
+        def recording_observe(value, **labels):
+            observe(value, **labels)
+            with self._lock:
+                self.samples.setdefault(labels.get('stage'), []).append(value)
+        self.histogram.observe = recording_observe
+        return self
+
+    def __exit__(self, *exc_info):
+        del self.histogram.observe
+
+    def report(self):
+        with self._lock:
+            samples = {stage: list(values) for stage, values in self.samples.items()}
+        return {
+            stage: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+                "mean_ms": round(sum(values) / len(values) * 1000, 2)
+            }
+            for stage, values in sorted(samples.items(), key=lambda item: STAGES.index(item[0]) if item[0] in STAGES else len(STAGES))
+        }
+
+class PeakRSS:
+    """Samples this process's RSS in the background and keeps the highest value"""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        self.peak = max(self.peak, process_documents.memory_usage()[0])
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+@contextmanager
+def benchmark_pipeline(blob, vault, openwebui, docling=None):
+    """Point process_documents at the stand-ins, restoring its globals afterwards"""
+    pd = process_documents
+    for container in (pd.UPLOAD_CONTAINER, pd.PROCESSED_CONTAINER, pd.LEDGER_CONTAINER, pd.LOCK_CONTAINER, pd.FAILED_CONTAINER):
+        blob.containers.setdefault(container, {})
+    protector = pd.VaultKVPIIProtector(vault.url, "benchmark-token")
+    vault.kv.update({f"pii-patterns/{pii_type}": {"pattern": pattern} for pii_type, pattern in protector._fallback_patterns().items()})
+    vault.kv.update({f"pii-replacements/{pii_type}": strategy for pii_type, strategy in protector._fallback_strategies().items()})
+    replaced = {
+        'blob_service_client': pd.create_blob_service_client(blob.connection_string),
+        'connection_string': blob.connection_string,
+        'OPENWEBUI_URL': openwebui.url,
+        'OPENWEBUI_API_KEY': "benchmark-key",
+        'vault_kv_client': protector,
+        'docling_serve': pd.DoclingServeClient(docling.url) if docling else None,
+        'conversion_cache': None,
+        'io_engine': pd.AsyncIOEngine(),
+        'processing_ledger': pd.ProcessingLedger() if pd.LEDGER_ENABLED else None,
+        'work_claims': pd.BlobWorkClaims(),
+        'knowledge_base_directory': pd.KnowledgeBaseDirectory()
+    }
+    original = {name: getattr(pd, name) for name in replaced}
+    for name, value in replaced.items():
+        setattr(pd, name, value)
+    try:
+        yield pd.VirtualFileHandler(pd.blob_service_client)
+    finally:
+        protector.pattern_cache.stop()
+        pd.io_engine.close()
+        for name, value in original.items():
+            setattr(pd, name, value)
+
+def run_corpus(name, documents, blob, virtual_handler, timeout):
+    """Process one corpus through the scheduler and return its report"""
+    pending = []
+    for blob_name, data, content_type in documents:
+        stored = blob.put_blob(process_documents.UPLOAD_CONTAINER, blob_name, data, content_type)
+        pending.append(PendingBlob(blob_name, len(data), stored['etag']))
+
+    results = []
+    results_lock = threading.Lock()
+    finished = threading.Event()
+
+    def handle(upload):
+        succeeded = process_documents.process_upload(upload, virtual_handler)
+        with results_lock:
+            results.append(succeeded)
+            if len(results) == len(pending):
+                finished.set()
+
+    scheduler = process_documents.UploadScheduler(handle).start()
+    try:
+        with StageRecorder(process_documents.stage_seconds) as stages, PeakRSS() as rss:
+            start = time.perf_counter()
+            for upload in pending:
+                scheduler.submit(upload)
+            completed = finished.wait(timeout)
+            elapsed = time.perf_counter() - start
+    finally:
+        scheduler.stop()
+
+    total_bytes = sum(len(data) for _, data, _ in documents)
+    return {
+        "documents": len(documents),
+        "bytes": total_bytes,
+        "seconds": round(elapsed, 3),
+        "docs_per_second": round(len(results) / elapsed, 2),
+        "mb_per_second": round(total_bytes / 1024 / 1024 / elapsed, 2),
+        "processed": sum(1 for succeeded in results if succeeded),
+        "failed": sum(1 for succeeded in results if not succeeded),
+        "timed_out": not completed,
+        "peak_rss_mb": round(rss.peak / 1024 / 1024, 1),
+        "stages": stages.report()
+    }
+
+def git_revision():
+    """Short commit hash of the working tree, with '-dirty' for uncommitted changes (None outside git)"""
+    try:
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=cwd, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--", "."], cwd=cwd, capture_output=True, text=True, check=True).stdout.strip()
+        return f"{commit}-dirty" if dirty else commit
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(args):
+    """Run the selected corpora and return the results as a JSON-serializable dict"""
+    settings = {
+        "corpora": {name: {"pii": {"docs": args.pii_docs, "kb": args.pii_kb},
+                           "pdf": {"docs": args.pdf_docs, "mb": args.pdf_mb},
+                           "tiny": {"docs": args.tiny_docs}}[name] for name in args.corpus},
+        "latency_ms": {"blob": args.blob_latency_ms, "vault": args.vault_latency_ms,
+                       "openwebui": args.openwebui_latency_ms, "docling": args.docling_latency_ms},
+        "conversion_ms": args.conversion_ms,
+        "converter": args.converter,
+        "light_workers": process_documents.SCHEDULER_LIGHT_WORKERS,
+        "heavy_workers": process_documents.SCHEDULER_HEAVY_WORKERS,
+        "scheduler_policy": process_documents.SCHEDULER_POLICY,
+        "ledger": process_documents.LEDGER_ENABLED
+    }
+    results = {
+        "commit": git_revision(),
+        "timestamp": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "settings": settings,
+        "corpora": {}
+    }
+
+    with FakeBlobServer(latency=args.blob_latency_ms / 1000) as blob, \
+         MockVaultServer(latency=args.vault_latency_ms / 1000) as vault, \
+         FakeOpenWebUI(latency=args.openwebui_latency_ms / 1000) as openwebui, \
+         FakeDoclingServe(latency=args.docling_latency_ms / 1000, conversion_time=args.conversion_ms / 1000) as docling:
+        with benchmark_pipeline(blob, vault, openwebui, docling if args.converter == "remote" else None) as virtual_handler:
+            for name in args.corpus:
+                documents = build_corpus(name, args)
+                results["corpora"][name] = run_corpus(name, documents, blob, virtual_handler, args.timeout)
+        results["openwebui_files"] = len(openwebui.files)
+
+    results["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return results
+
+def change(old, new):
+    if not old:
+        return ""
+    return f"{(new - old) / old * 100:+.1f}%"
+
+def print_results(results, baseline=None):
+    print("=" * 72)
+    print(f"PIPELINE BENCHMARK (commit {results['commit'] or 'unknown'}, Python {results['python']})")
+    latency = results["settings"]["latency_ms"]
+    print(f"latency ms: blob {latency['blob']:g}, vault {latency['vault']:g}, openwebui {latency['openwebui']:g}, "
+          f"docling {latency['docling']:g}; conversion {results['settings']['conversion_ms']:g} ms ({results['settings']['converter']}); "
+          f"workers {results['settings']['light_workers']} light / {results['settings']['heavy_workers']} heavy")
+    if baseline:
+        print(f"compared with commit {baseline.get('commit') or 'unknown'}")
+        shared = {key: value for key, value in results["settings"].items() if key != "corpora"}
+        if {key: value for key, value in baseline.get("settings", {}).items() if key != "corpora"} != shared:
+            print("⚠ the baseline was run with different latencies or pipeline settings")
+    print("=" * 72)
+
+    for name, corpus in results["corpora"].items():
+        before = (baseline or {}).get("corpora", {}).get(name)
+        summary = (f"{name}: {corpus['documents']} docs, {corpus['bytes'] / 1024 / 1024:.1f} MB in {corpus['seconds']:.2f}s -> "
+                   f"{corpus['docs_per_second']:.2f} docs/s, {corpus['mb_per_second']:.2f} MB/s, peak RSS {corpus['peak_rss_mb']:.0f} MB")
+        if before:
+            summary += f" ({change(before['docs_per_second'], corpus['docs_per_second'])} docs/s)"
+            if baseline["settings"]["corpora"].get(name) != results["settings"]["corpora"][name]:
+                summary += " ⚠ different corpus size"
+        print(summary)
+        if corpus["failed"] or corpus["timed_out"]:
+            print(f"  ✗ {corpus['failed']} failed{', timed out' if corpus['timed_out'] else ''}")
+        print(f"  {'stage':<18} {'count':>6} {'p50 (ms)':>10} {'p99 (ms)':>10}" + (f" {'p50 change':>11} {'p99 change':>11}" if before else ""))
+        for stage, stats in corpus["stages"].items():
+            line = f"  {stage:<18} {stats['count']:>6} {stats['p50_ms']:>10.2f} {stats['p99_ms']:>10.2f}"
+            previous = before["stages"].get(stage) if before else None
+            if previous:
+                line += f" {change(previous['p50_ms'], stats['p50_ms']):>11} {change(previous['p99_ms'], stats['p99_ms']):>11}"
+            print(line)
+        print()
+
+    print(f"Peak RSS of the whole run (stand-ins included): {results['max_rss_mb']:.0f} MB")
+    print("=" * 72)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the document pipeline against in-process stand-ins")
+    parser.add_argument("--corpus", nargs="+", choices=["pii", "pdf", "tiny"], default=["pii", "pdf", "tiny"])
+    parser.add_argument("--pii-docs", type=int, default=20)
+    parser.add_argument("--pii-kb", type=int, default=256, help="size of each PII-dense markdown document")
+    parser.add_argument("--pdf-docs", type=int, default=4)
+    parser.add_argument("--pdf-mb", type=float, default=8, help="size of each PDF")
+    parser.add_argument("--tiny-docs", type=int, default=500)
+    parser.add_argument("--blob-latency-ms", type=float, default=5)
+    parser.add_argument("--vault-latency-ms", type=float, default=5)
+    parser.add_argument("--openwebui-latency-ms", type=float, default=20)
+    parser.add_argument("--docling-latency-ms", type=float, default=5)
+    parser.add_argument("--conversion-ms", type=float, default=200, help="time FakeDoclingServe takes per document")
+    parser.add_argument("--converter", choices=["remote", "local"], default="remote",
+                        help="'remote' = FakeDoclingServe, 'local' = the Docling library (must be installed)")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for a corpus to finish")
+    parser.add_argument("--log-level", default="WARNING", help="processor log level (INFO logs every document)")
+    parser.add_argument("--json", metavar="PATH", help="write the results as JSON")
+    parser.add_argument("--compare", metavar="PATH", help="JSON results of an earlier run to compare with")
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    logging.getLogger().setLevel(args.log_level)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = run_benchmark(args)
+    print_results(results, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.json}")
+
+    incomplete = any(corpus["failed"] or corpus["timed_out"] for corpus in results["corpora"].values())
+    sys.exit(1 if incomplete else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Benchmark for import time and memory at startup
+
+Imports each module in a fresh interpreter and reports the median wall time,
+the peak RSS after the import, and which heavy dependencies it pulled in.
+Helpers such as VirtualFileHandler and the comparison endpoint should not load
+Docling (and torch behind it), aiohttp or any client. Exits non-zero when a
+limit is exceeded or a heavy module is imported, so it can guard against
+regressions in CI.
+
+Usage: python benchmark_startup.py [--runs 5] [--modules process_documents health_server test_virtual_files] [--max-seconds 2] [--max-rss-mb 150]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Modules that must only be imported when their feature is used
+HEAVY_MODULES = ["docling", "torch", "aiohttp", "azure.storage.blob.aio"]
+
+PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+module = __import__({module!r})
+elapsed = time.perf_counter() - start
+clients = [name for name in ("blob_service_client", "vault_kv_client")
+           if name in vars(sys.modules.get("process_documents", module))]
+print(json.dumps({{
+    "seconds": elapsed,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "heavy": [name for name in {heavy!r} if name in sys.modules],
+    "clients": clients
+}}))
+"""
+
+def measure(module, runs):
+    """Median import time and peak RSS over fresh interpreters, with the heavy modules and clients seen"""
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        "seconds": statistics.median(result["seconds"] for result in results),
+        "max_rss_mb": statistics.median(result["max_rss_mb"] for result in results),
+        "heavy": results[-1]["heavy"],
+        "clients": results[-1]["clients"]
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark module import time and memory")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--modules", nargs="+", default=["process_documents", "health_server", "test_virtual_files"])
+    parser.add_argument("--max-seconds", type=float, default=None, help="fail if a median import takes longer")
+    parser.add_argument("--max-rss-mb", type=float, default=None, help="fail if the peak RSS after import is higher")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    results = {module: measure(module, args.runs) for module in args.modules}
+    failures = []
+    for module, result in results.items():
+        if result["heavy"]:
+            failures.append(f"{module} imports {', '.join(result['heavy'])}")
+        if result["clients"]:
+            failures.append(f"{module} creates {', '.join(result['clients'])} at import")
+        if args.max_seconds is not None and result["seconds"] > args.max_seconds:
+            failures.append(f"{module} imports in {result['seconds']:.2f}s (limit {args.max_seconds:g}s)")
+        if args.max_rss_mb is not None and result["max_rss_mb"] > args.max_rss_mb:
+            failures.append(f"{module} peaks at {result['max_rss_mb']:.0f} MB (limit {args.max_rss_mb:g} MB)")
+
+    if args.json:
+        print(json.dumps({"results": results, "failures": failures}, indent=2))
+    else:
+        print("=" * 72)
+        print(f"STARTUP BENCHMARK (median of {args.runs} fresh interpreters)")
+        print("=" * 72)
+        print(f"{'module':<24} {'import (s)':>11} {'peak RSS (MB)':>14}  heavy modules")
+        for module, result in results.items():
+            print(f"{module:<24} {result['seconds']:>11.3f} {result['max_rss_mb']:>14.1f}  {', '.join(result['heavy']) or '-'}")
+        print("=" * 72)
+        for failure in failures:
+            print(f"✗ {failure}")
+
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for Vault Transform encoding
+
+Runs VaultTransformClient.tokenize_pii() against the local MockVaultServer and
+compares one request per chunk (batch size 1, the previous behaviour) with
+batched batch_input requests.
+
+Usage: python benchmark_vault_transform.py [--size-kb 1024] [--latency-ms 2] [--batch-sizes 1 25 100 250]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from local_standins import MockVaultServer
+from process_documents import VaultTransformClient
+
+def generate_text(size_bytes):
+    """Sentences with SSNs and emails sprinkled in"""
+    sentences = []
+    size = 0
+    i = 0
+    while size < size_bytes:
+        sentence = f"Claim {i} for member user{i}@example.com with SSN 123-45-{i % 10000:04d} was reviewed and approved. "
+        sentences.append(sentence)
+        size += len(sentence)
+        i += 1
+    return "".join(sentences)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batched Vault Transform encoding")
+    parser.add_argument("--size-kb", type=int, default=1024)
+    parser.add_argument("--latency-ms", type=float, default=2.0)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 25, 100, 250])
+    args = parser.parse_args()
+
+    text = generate_text(args.size_kb * 1024)
+
+    print("=" * 64)
+    print(f"VAULT TRANSFORM THROUGHPUT ({args.size_kb} KB, {args.latency_ms} ms per request)")
+    print("=" * 64)
+    print(f"{'batch size':>10} {'requests':>10} {'seconds':>10} {'KB/s':>10}")
+
+    for batch_size in args.batch_sizes:
+        with MockVaultServer(latency=args.latency_ms / 1000) as vault:
+            client = VaultTransformClient(vault.url, "benchmark", "ai_data_transform", "file-processor", batch_size=batch_size)
+            start = time.perf_counter()
+            client.tokenize_pii(text)
+            elapsed = time.perf_counter() - start
+            print(f"{batch_size:>10} {vault.request_count:>10} {elapsed:>10.3f} {args.size_kb / elapsed:>10.1f}")
+
+    print("=" * 64)
+
+if __name__ == "__main__":
+    main()
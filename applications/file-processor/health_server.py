@@ -1,65 +1,258 @@
 #!/usr/bin/env python3
 import http.server
-import socketserver
 import json
 import os
 import sys
+import threading
+import zlib
+from collections import OrderedDict
+from urllib.parse import unquote
 
 # Add the current directory to Python path to import process_documents
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 try:
-    from process_documents import get_document_comparison
+    from process_documents import DocumentComparison, metrics, pipeline_health
 except ImportError:
     # Fallback if import fails
-    get_document_comparison = None
+    DocumentComparison = None
+    metrics = None
+    pipeline_health = None
+
+COMPARISON_CACHE_MAX_MB = int(os.getenv('COMPARISON_CACHE_MAX_MB', '64'))  # Memory cap for cached comparison responses (gzipped)
+COMPARISON_CACHE_MAX_ENTRY_MB = int(os.getenv('COMPARISON_CACHE_MAX_ENTRY_MB', '8'))  # Larger responses are streamed every time
+
+class ComparisonCache:
+    """LRU of gzipped comparison responses, keyed by file name and validated by etag
+
+    An entry is only served while its etag matches the current one, so a reprocessed
+    document is never answered from a stale entry. The total size stays under `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=COMPARISON_CACHE_MAX_MB * 1024 * 1024, max_entry_bytes=COMPARISON_CACHE_MAX_ENTRY_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # file name -> (etag, gzipped body)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, file_name, etag):
+        with self._lock:
+            entry = self._entries.get(file_name)
+            if entry is None or entry[0] != etag:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(file_name)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, file_name, etag, body):
+        if len(body) > self.max_entry_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(file_name, None)
+            if previous:
+                self._size -= len(previous[1])
+            self._entries[file_name] = (etag, body)
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'bytes': self._size}
+
+comparison_cache = ComparisonCache()
+
+def iter_comparison_json(protected_chunks, metadata, available):
+    """The comparison response as JSON text pieces, escaping the protected markdown chunk by chunk"""
+    yield '{"protected": "'
+    for chunk in protected_chunks:
+        yield json.dumps(chunk)[1:-1]
+    yield f'", "metadata": {json.dumps(metadata, indent=2)}, "comparison_available": {json.dumps(available)}}}'
 
 class HealthHandler(http.server.BaseHTTPRequestHandler):
+    headers_sent = False
+    
+    def end_headers(self):
+        super().end_headers()
+        self.headers_sent = True
+    
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _accepts_gzip(self):
+        """Whether Accept-Encoding lists gzip (or *) without refusing it with q=0"""
+        qualities = {}
+        for entry in self.headers.get("Accept-Encoding", "").split(","):
+            coding, *params = entry.split(";")
+            quality = 1.0
+            for param in params:
+                name, _, value = param.partition("=")
+                if name.strip().lower() == "q":
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            qualities[coding.strip().lower()] = quality
+        return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+    def _send_comparison(self, filename):
+        """Answer from the cache, with 304 for a matching If-None-Match, or stream the response
+
+        As before streaming, a comparison that cannot be read is a 200 with
+        `comparison_available` false, and an `error` if the blobs could not be checked.
+        """
+        try:
+            comparison = DocumentComparison(filename)
+        except Exception as e:
+            self._send_json(200, {"protected": "", "metadata": {}, "comparison_available": False, "error": str(e)})
+            return
+        etag = comparison.etag
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        gzip_ok = self._accepts_gzip()
+        cached = comparison_cache.get(filename, etag)
+        if cached is not None:
+            body = cached if gzip_ok else zlib.decompress(cached, wbits=31)
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            if gzip_ok:
+                self.send_header("Content-Encoding", "gzip")
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        # Start the download before answering, so a failure can still be reported as unavailable
+        available = comparison.available
+        try:
+            protected_chunks = comparison.iter_protected()
+        except Exception as e:
+            self.log_error("Could not retrieve the protected version of %s: %s", filename, e)
+            protected_chunks, available = iter(()), False
+        metadata = comparison.metadata()
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("ETag", etag)
+        if gzip_ok:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+
+        # The body is streamed without a Content-Length and ends when the connection
+        # closes; the gzipped copy is kept for the cache unless it grows too large
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        cache_parts, cache_size = ([], 0) if available == comparison.available else (None, 0)
+        for piece in iter_comparison_json(protected_chunks, metadata, available):
+            data = piece.encode()
+            compressed = compressor.compress(data)
+            if cache_parts is not None and compressed:
+                cache_parts.append(compressed)
+                cache_size += len(compressed)
+                if cache_size > comparison_cache.max_entry_bytes:
+                    cache_parts = None
+            if gzip_ok:
+                if compressed:
+                    self.wfile.write(compressed)
+            else:
+                self.wfile.write(data)
+        compressed = compressor.flush()
+        if gzip_ok:
+            self.wfile.write(compressed)
+        if cache_parts is not None:
+            comparison_cache.put(filename, etag, b"".join(cache_parts) + compressed)
+
     def do_GET(self):
+        self.headers_sent = False
         if self.path == "/health":
-            self.send_response(200)
+            # Liveness as plain text, for existing checks
+            live = pipeline_health.liveness()[0] if pipeline_health else True
+            self.send_response(200 if live else 503)
             self.send_header("Content-type", "text/plain")
             self.end_headers()
-            self.wfile.write(b"healthy")
-        
+            self.wfile.write(b"healthy" if live else b"unhealthy")
+
+        elif self.path == "/health/live":
+            if pipeline_health is None:
+                self._send_json(503, {"error": "Pipeline health not available"})
+                return
+            live, details = pipeline_health.liveness()
+            self._send_json(200 if live else 503, details)
+
+        elif self.path == "/health/ready":
+            if pipeline_health is None:
+                self._send_json(503, {"error": "Pipeline health not available"})
+                return
+            ready, details = pipeline_health.readiness()
+            self._send_json(200 if ready else 503, details)
+
+        elif self.path == "/metrics":
+            if metrics is None:
+                self._send_json(503, {"error": "Metrics not available"})
+                return
+
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
         elif self.path.startswith("/demo/compare/"):
             # Extract filename from path: /demo/compare/filename
-            filename = self.path.split("/demo/compare/")[-1]
+            filename = unquote(self.path.split("/demo/compare/")[-1])
             if not filename:
-                self.send_response(400)
-                self.send_header("Content-type", "application/json")
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": "No filename provided"}).encode())
+                self._send_json(400, {"error": "No filename provided"})
                 return
-            
-            if get_document_comparison:
+
+            if DocumentComparison:
                 try:
-                    comparison = get_document_comparison(filename)
-                    self.send_response(200)
-                    self.send_header("Content-type", "application/json")
-                    self.end_headers()
-                    self.wfile.write(json.dumps(comparison, indent=2).encode())
+                    self._send_comparison(filename)
                 except Exception as e:
-                    self.send_response(500)
-                    self.send_header("Content-type", "application/json")
-                    self.end_headers()
-                    self.wfile.write(json.dumps({"error": str(e)}).encode())
+                    if self.headers_sent:
+                        # Too late for an error status; closing leaves the body visibly incomplete
+                        self.log_error("Comparison of %s failed while streaming: %s", filename, e)
+                        self.close_connection = True
+                    else:
+                        self._send_json(500, {"error": str(e)})
             else:
-                self.send_response(503)
-                self.send_header("Content-type", "application/json")
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": "Comparison service not available"}).encode())
-        
+                self._send_json(503, {"error": "Comparison service not available"})
+
         else:
-            self.send_response(404)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": "Endpoint not found"}).encode())
+            self._send_json(404, {"error": "Endpoint not found"})
+
+class HealthServer(http.server.ThreadingHTTPServer):
+    """Handles each request in its own thread, so a slow comparison never delays /health"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+def start_health_server(port=8081):
+    """Serve the endpoints from a background thread of the current process (the processor's, for /metrics)"""
+    httpd = HealthServer(("", port), HealthHandler)
+    threading.Thread(target=httpd.serve_forever, name="health-server", daemon=True).start()
+    return httpd
 
 if __name__ == "__main__":
-    with socketserver.TCPServer(("", 8081), HealthHandler) as httpd:
+    # Standalone: comparisons work, but /metrics only reflects this process
+    with HealthServer(("", 8081), HealthHandler) as httpd:
         print("Health server started on port 8081")
         print("Available endpoints:")
         print("  GET /health - Health check")
+        print("  GET /health/live - Liveness of the processing loop and workers")
+        print("  GET /health/ready - Readiness, including dependency checks")
+        print("  GET /metrics - Prometheus metrics")
         print("  GET /demo/compare/{filename} - Compare original vs protected document")
-        httpd.serve_forever() 
\ No newline at end of file
+        httpd.serve_forever()
@@ -0,0 +1,657 @@
+#!/usr/bin/env python3
+"""
+Local stand-ins for the services the file processor talks to
+
+Each stand-in is a small HTTP server running in a background thread of the
+current process, with configurable per-request latency, so tests and
+benchmarks can exercise the real client code without Vault, OpenWebUI,
+docling-serve or Azure. Start one with a `with` block and point the client at `server.url`.
+"""
+
+import base64
+import hashlib
+import http.server
+import json
+import re
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.utils import formatdate
+from urllib.parse import urlparse, parse_qs, unquote
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+class StandInServer:
+    """Base class: threaded HTTP server with latency and failure injection and request counting
+
+    Set `fail_requests` to answer that many upcoming requests with `fail_status`.
+    `connection_count` counts TCP connections, to check keep-alive reuse. With
+    `bandwidth` set, each request is delayed as if its request and response bodies
+    crossed a link of that many bytes per second.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.bandwidth = bandwidth  # bytes per second per request, to model a slow link
+        self.fail_requests = 0
+        self.fail_status = 503
+        self.request_count = 0
+        self.connection_count = 0
+        self.requests_by_path = {}
+        self._count_lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _record(self, method, path):
+        with self._count_lock:
+            self.request_count += 1
+            key = f"{method} {path}"
+            self.requests_by_path[key] = self.requests_by_path.get(key, 0) + 1
+
+    def _take_failure(self):
+        with self._count_lock:
+            if self.fail_requests > 0:
+                self.fail_requests -= 1
+                return True
+            return False
+
+    def handle(self, method, path, query, headers, body):
+        """Return (status, payload) for a request; payload is a dict (sent as JSON) or bytes"""
+        return 404, {"errors": [f"no route for {method} {path}"]}
+
+    def _make_handler(self):
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes; without this keep-alive
+            # connections stall on delayed ACKs
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with stand_in._count_lock:
+                    stand_in.connection_count += 1
+
+            def _dispatch(self, method):
+                parsed = urlparse(self.path)
+                length = int(self.headers.get("Content-Length", 0) or 0)
+                body = self.rfile.read(length) if length else b""
+                stand_in._record(method, parsed.path)
+                if stand_in.latency:
+                    time.sleep(stand_in.latency)
+
+                if stand_in._take_failure():
+                    result = (stand_in.fail_status, {"errors": ["injected failure"]})
+                else:
+                    result = stand_in.handle(method, parsed.path, parsed.query, self.headers, body)
+                status, payload = result[0], result[1]
+                extra_headers = result[2] if len(result) > 2 else {}
+                if isinstance(payload, (dict, list)):
+                    data = json.dumps(payload).encode()
+                    content_type = "application/json"
+                else:
+                    data = payload or b""
+                    content_type = "application/octet-stream"
+
+                if stand_in.bandwidth:
+                    time.sleep((len(body) + len(data)) / stand_in.bandwidth)
+
+                self.send_response(status)
+                self.send_header("Content-Type", extra_headers.pop("Content-Type", content_type))
+                content_length = extra_headers.pop("Content-Length", str(len(data)))
+                for name, value in extra_headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", content_length)
+                self.end_headers()
+                if method != "HEAD":
+                    self.wfile.write(data)
+
+            def do_GET(self):
+                self._dispatch("GET")
+
+            def do_POST(self):
+                self._dispatch("POST")
+
+            def do_PUT(self):
+                self._dispatch("PUT")
+
+            def do_DELETE(self):
+                self._dispatch("DELETE")
+
+            def do_HEAD(self):
+                self._dispatch("HEAD")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+class MockVaultServer(StandInServer):
+    """Vault stand-in: sys/health, KV v2 reads and Transform encode (single and batch_input)
+
+    Transform encoding tokenizes SSNs and emails and masks phone numbers, which is
+    enough for the processor's tokenize/mask calls. Set `available = False` to make
+    every request fail with 503.
+    """
+
+    SSN = re.compile(r'\b\d{3}-\d{2}-\d{4}\b')
+    EMAIL = re.compile(r'\b[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b')
+    PHONE = re.compile(r'\b\d{3}-\d{3}-\d{4}\b')
+
+    def __init__(self, latency=0.0, kv=None, transform_path="ai_data_transform", **kwargs):
+        super().__init__(latency=latency, **kwargs)
+        self.kv = dict(kv or {})
+        self.transform_path = transform_path
+        self.available = True
+        self.encoded_values = 0
+
+    def encode(self, transformation, value):
+        if transformation.endswith("mask"):
+            return self.PHONE.sub("***-***-****", value)
+        value = self.SSN.sub(lambda m: f"tok_ssn_{uuid.uuid4().hex[:12]}", value)
+        return self.EMAIL.sub(lambda m: f"tok_email_{uuid.uuid4().hex[:12]}", value)
+
+    def handle(self, method, path, query, headers, body):
+        if not self.available:
+            return 503, {"errors": ["Vault is sealed"]}
+
+        if path == "/v1/sys/health":
+            return 200, {"initialized": True, "sealed": False, "standby": False}
+
+        if path.startswith("/v1/secret/data/") and method == "GET":
+            key = path[len("/v1/secret/data/"):]
+            if key not in self.kv:
+                return 404, {"errors": []}
+            return 200, {"data": {"data": self.kv[key], "metadata": {"version": 1}}}
+
+        encode_prefix = f"/v1/{self.transform_path}/encode/"
+        if path.startswith(encode_prefix) and method == "POST":
+            parts = path[len(encode_prefix):].split("/")
+            payload = json.loads(body or b"{}")
+            default_transformation = parts[1] if len(parts) > 1 else payload.get("transformation", "")
+
+            if "batch_input" in payload:
+                results = []
+                for item in payload["batch_input"]:
+                    transformation = item.get("transformation", default_transformation)
+                    results.append({"encoded_value": self.encode(transformation, item["value"])})
+                self.encoded_values += len(results)
+                return 200, {"data": {"batch_results": results}}
+
+            self.encoded_values += 1
+            return 200, {"data": {"encoded_value": self.encode(default_transformation, payload["value"])}}
+
+        return super().handle(method, path, query, headers, body)
+
+class FakeBlobServer(StandInServer):
+    """Azurite-style Blob Storage stand-in for path-style URLs (/{account}/{container}/{blob})
+
+    Supports what the processor uses: container create/list/properties, Put Blob,
+    Put Block, Put Block List, Copy Blob (same account, completes synchronously),
+    ranged Get Blob, Get Blob Properties, Set Blob Metadata, Lease Blob (acquire,
+    renew, release) and Delete Blob. Writes to a leased blob need its lease ID, and
+    If-Match is checked against the blob's ETag.
+    Content-MD5 request headers are verified, range MD5s are returned on request,
+    and the blob-level MD5 is stored like the real service does. Requests are not
+    authenticated. Use `connection_string` with the Azure SDK.
+    """
+
+    ACCOUNT = "devstoreaccount1"
+    KEY = "Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw=="
+
+    def __init__(self, latency=0.0, bandwidth=None, **kwargs):
+        super().__init__(latency=latency, bandwidth=bandwidth, **kwargs)
+        self.containers = {}
+        self._uncommitted = {}
+        self._blob_lock = threading.Lock()
+
+    @property
+    def connection_string(self):
+        return (f"DefaultEndpointsProtocol=http;AccountName={self.ACCOUNT};AccountKey={self.KEY};"
+                f"BlobEndpoint={self.url}/{self.ACCOUNT};")
+
+    def put_blob(self, container, name, data, content_type="application/octet-stream", metadata=None):
+        """Seed a blob directly"""
+        with self._blob_lock:
+            blobs = self.containers.setdefault(container, {})
+            blobs[name] = self._new_blob(data, content_type, None, metadata or {})
+            return blobs[name]
+
+    def get_blob(self, container, name):
+        """Stored blob dict (data, content_type, content_md5, metadata, etag), or None"""
+        return self.containers.get(container, {}).get(name)
+
+    def _new_blob(self, data, content_type, content_md5, metadata):
+        return {
+            'data': bytes(data),
+            'content_type': content_type or "application/octet-stream",
+            'content_md5': content_md5,
+            'metadata': dict(metadata),
+            'etag': f'"0x{uuid.uuid4().hex[:16].upper()}"',
+            'last_modified': formatdate(usegmt=True),
+            'lease': None
+        }
+
+    @staticmethod
+    def _lease_active(blob):
+        lease = blob['lease']
+        return lease is not None and (lease['duration'] == -1 or lease['expires'] > time.time())
+
+    def _lease_conflict(self, blob, headers):
+        """Error response if a write or delete does not carry the blob's active lease"""
+        if blob is None:
+            return None
+        lease_id = headers.get("x-ms-lease-id")
+        if self._lease_active(blob):
+            if lease_id is None:
+                return self._error(412, "LeaseIdMissing")
+            if lease_id != blob['lease']['id']:
+                return self._error(412, "LeaseIdMismatchWithBlobOperation")
+        elif lease_id is not None:
+            return self._error(412, "LeaseNotPresentWithBlobOperation")
+        return None
+
+    def _lease(self, blob, headers):
+        action = headers.get("x-ms-lease-action")
+        lease = blob['lease']
+        if action == "acquire":
+            proposed_id = headers.get("x-ms-proposed-lease-id") or str(uuid.uuid4())
+            if self._lease_active(blob) and lease['id'] != proposed_id:
+                return self._error(409, "LeaseAlreadyPresent")
+            duration = int(headers.get("x-ms-lease-duration", "-1"))
+            blob['lease'] = {'id': proposed_id, 'duration': duration, 'expires': time.time() + duration}
+            status = 201
+        elif lease is None:
+            return self._error(409, "LeaseNotPresentWithLeaseOperation")
+        elif headers.get("x-ms-lease-id") != lease['id']:
+            return self._error(409, "LeaseIdMismatchWithLeaseOperation")
+        elif action == "renew":
+            lease['expires'] = time.time() + lease['duration']
+            status = 200
+        elif action == "release":
+            blob['lease'] = None
+            status = 200
+        else:
+            return self._error(400, "InvalidHeaderValue", f"Unsupported lease action: {action}")
+        return status, b"", {"ETag": blob['etag'], "Last-Modified": blob['last_modified'],
+                             "x-ms-lease-id": lease['id'] if action != "acquire" else blob['lease']['id']}
+
+    @staticmethod
+    def _error(status, code, message=""):
+        body = (f'<?xml version="1.0" encoding="utf-8"?><Error><Code>{code}</Code>'
+                f'<Message>{escape(message or code)}</Message></Error>').encode()
+        return status, body, {"Content-Type": "application/xml", "x-ms-error-code": code}
+
+    @staticmethod
+    def _md5(data):
+        return base64.b64encode(hashlib.md5(data).digest()).decode()
+
+    def _blob_headers(self, blob):
+        headers = {
+            "ETag": blob['etag'],
+            "Last-Modified": blob['last_modified'],
+            "x-ms-blob-type": "BlockBlob",
+            "x-ms-creation-time": blob['last_modified'],
+            "Accept-Ranges": "bytes",
+            "Content-Type": blob['content_type'],
+            "x-ms-lease-state": "leased" if self._lease_active(blob) else "available",
+            "x-ms-lease-status": "locked" if self._lease_active(blob) else "unlocked"
+        }
+        for key, value in blob['metadata'].items():
+            headers[f"x-ms-meta-{key}"] = value
+        return headers
+
+    def _check_md5(self, headers, body):
+        expected = headers.get("Content-MD5")
+        return expected is None or expected == self._md5(body)
+
+    def handle(self, method, path, query, headers, body):
+        parts = unquote(path).lstrip("/").split("/", 2)
+        params = {key: values[0] for key, values in parse_qs(query, keep_blank_values=True).items()}
+        if len(parts) < 2 or parts[0] != self.ACCOUNT:
+            return self._error(400, "InvalidUri")
+        container = parts[1]
+        blob_name = parts[2] if len(parts) > 2 else None
+
+        if blob_name is None:
+            return self._handle_container(method, container, params)
+
+        with self._blob_lock:
+            blobs = self.containers.get(container)
+            if blobs is None:
+                return self._error(404, "ContainerNotFound")
+            blob = blobs.get(blob_name)
+            comp = params.get("comp")
+
+            if method == "PUT" and comp == "lease":
+                if blob is None:
+                    return self._error(404, "BlobNotFound")
+                return self._lease(blob, headers)
+
+            if headers.get("If-None-Match") == "*" and blob is not None:
+                return self._error(409, "BlobAlreadyExists")
+
+            if headers.get("If-Match") and blob is not None and headers["If-Match"] not in ("*", blob['etag']):
+                return self._error(412, "ConditionNotMet")
+
+            if method in ("PUT", "DELETE") and comp != "block":
+                conflict = self._lease_conflict(blob, headers)
+                if conflict:
+                    return conflict
+
+            if method == "PUT" and comp == "block":
+                if not self._check_md5(headers, body):
+                    return self._error(400, "Md5Mismatch")
+                pending = self._uncommitted.setdefault((container, blob_name), {})
+                pending[params["blockid"]] = bytes(body)
+                return 201, b"", {"Content-MD5": self._md5(body)}
+
+            if method == "PUT" and comp == "blocklist":
+                pending = self._uncommitted.get((container, blob_name), {})
+                block_ids = [element.text for element in ElementTree.fromstring(body)]
+                if any(block_id not in pending for block_id in block_ids):
+                    return self._error(400, "InvalidBlockList")
+                blobs[blob_name] = self._new_blob(
+                    b"".join(pending[block_id] for block_id in block_ids),
+                    headers.get("x-ms-blob-content-type"),
+                    headers.get("x-ms-blob-content-md5"),
+                    self._metadata_from(headers)
+                )
+                self._uncommitted.pop((container, blob_name), None)
+                return 201, b"", {"ETag": blobs[blob_name]['etag'], "Last-Modified": blobs[blob_name]['last_modified']}
+
+            if method == "PUT" and comp == "metadata":
+                if blob is None:
+                    return self._error(404, "BlobNotFound")
+                blob['metadata'] = self._metadata_from(headers)
+                return 200, b"", {"ETag": blob['etag'], "Last-Modified": blob['last_modified']}
+
+            if method == "PUT" and comp is None and headers.get("x-ms-copy-source"):
+                source_parts = unquote(urlparse(headers["x-ms-copy-source"]).path).lstrip("/").split("/", 2)
+                source = self.containers.get(source_parts[1], {}).get(source_parts[2]) if len(source_parts) == 3 else None
+                if source is None:
+                    return self._error(404, "CannotVerifyCopySource")
+                blobs[blob_name] = self._new_blob(source['data'], source['content_type'], source['content_md5'],
+                                                  self._metadata_from(headers) or source['metadata'])
+                return 202, b"", {"ETag": blobs[blob_name]['etag'], "Last-Modified": blobs[blob_name]['last_modified'],
+                                  "x-ms-copy-id": str(uuid.uuid4()), "x-ms-copy-status": "success"}
+
+            if method == "PUT" and comp is None:
+                if not self._check_md5(headers, body):
+                    return self._error(400, "Md5Mismatch")
+                # Like the service, a single Put Blob stores the MD5 of the content
+                blobs[blob_name] = self._new_blob(
+                    body,
+                    headers.get("x-ms-blob-content-type"),
+                    headers.get("x-ms-blob-content-md5") or self._md5(body),
+                    self._metadata_from(headers)
+                )
+                return 201, b"", {"ETag": blobs[blob_name]['etag'], "Last-Modified": blobs[blob_name]['last_modified'],
+                                  "Content-MD5": self._md5(body)}
+
+            if blob is None:
+                return self._error(404, "BlobNotFound")
+
+            if method == "DELETE":
+                del blobs[blob_name]
+                return 202, b"", {}
+
+            if method == "HEAD":
+                response_headers = self._blob_headers(blob)
+                response_headers["Content-Length"] = str(len(blob['data']))
+                if blob['content_md5']:
+                    response_headers["Content-MD5"] = blob['content_md5']
+                return 200, b"", response_headers
+
+            if method == "GET":
+                return self._get_blob(blob, headers)
+
+        return self._error(405, "UnsupportedHttpVerb")
+
+    def _get_blob(self, blob, headers):
+        data = blob['data']
+        response_headers = self._blob_headers(blob)
+        range_header = headers.get("x-ms-range") or headers.get("Range")
+        if not range_header:
+            if blob['content_md5']:
+                response_headers["Content-MD5"] = blob['content_md5']
+            return 200, data, response_headers
+
+        start, _, end = range_header.split("=", 1)[1].partition("-")
+        start = int(start)
+        end = min(int(end) if end else len(data) - 1, len(data) - 1)
+        if start >= len(data):
+            return self._error(416, "InvalidRange")
+        chunk = data[start:end + 1]
+        response_headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+        if blob['content_md5']:
+            response_headers["x-ms-blob-content-md5"] = blob['content_md5']
+        if headers.get("x-ms-range-get-content-md5") == "true":
+            response_headers["Content-MD5"] = self._md5(chunk)
+        return 206, chunk, response_headers
+
+    @staticmethod
+    def _metadata_from(headers):
+        return {key[len("x-ms-meta-"):]: value for key, value in headers.items() if key.lower().startswith("x-ms-meta-")}
+
+    def _handle_container(self, method, container, params):
+        with self._blob_lock:
+            if method == "PUT":
+                if container in self.containers:
+                    return self._error(409, "ContainerAlreadyExists")
+                self.containers[container] = {}
+                return 201, b"", {"ETag": '"0x1"', "Last-Modified": formatdate(usegmt=True)}
+
+            blobs = self.containers.get(container)
+            if blobs is None:
+                return self._error(404, "ContainerNotFound")
+
+            if method == "GET" and params.get("comp") == "list":
+                prefix = params.get("prefix", "")
+                names = sorted(name for name in blobs if name.startswith(prefix))
+                items = "".join(
+                    f"<Blob><Name>{escape(name)}</Name><Properties>"
+                    f"<Last-Modified>{blobs[name]['last_modified']}</Last-Modified>"
+                    f"<Etag>{escape(blobs[name]['etag'])}</Etag>"
+                    f"<Content-Length>{len(blobs[name]['data'])}</Content-Length>"
+                    f"<Content-Type>{escape(blobs[name]['content_type'])}</Content-Type>"
+                    f"<BlobType>BlockBlob</BlobType></Properties></Blob>"
+                    for name in names
+                )
+                body = (f'<?xml version="1.0" encoding="utf-8"?><EnumerationResults ContainerName="{escape(container)}">'
+                        f"<Prefix>{escape(prefix)}</Prefix><Blobs>{items}</Blobs><NextMarker /></EnumerationResults>").encode()
+                return 200, body, {"Content-Type": "application/xml"}
+
+            if method in ("GET", "HEAD") and "comp" not in params:
+                return 200, b"", {"ETag": '"0x1"', "Last-Modified": formatdate(usegmt=True), "x-ms-lease-state": "available"}
+
+            if method == "DELETE":
+                del self.containers[container]
+                return 202, b"", {}
+
+        return self._error(405, "UnsupportedHttpVerb")
+
+class FakeDoclingServe(StandInServer):
+    """docling-serve stand-in for the async conversion API
+
+    Supports POST /v1/convert/file/async (multipart `files` plus option fields),
+    GET /v1/status/poll/{task_id}?wait=N, GET /v1/result/{task_id}, GET /health and
+    GET /version. "Converting" takes `conversion_time` seconds and turns the file
+    into markdown by decoding it as text. Set `fail_tasks` to make that many upcoming
+    tasks end in failure. `max_in_flight` records the most tasks converting at once.
+    """
+
+    def __init__(self, latency=0.0, conversion_time=0.0, **kwargs):
+        super().__init__(latency=latency, **kwargs)
+        self.conversion_time = conversion_time
+        self.fail_tasks = 0
+        self.versions = {"docling-serve": "fake", "docling": "2.43.0"}
+        self.tasks = {}
+        self.last_options = {}
+        self.max_in_flight = 0
+        self._task_lock = threading.Lock()
+
+    @staticmethod
+    def _parse_form(headers, body):
+        """Fields and files of a multipart/form-data body"""
+        message = BytesParser().parsebytes(f"Content-Type: {headers.get('Content-Type')}\r\n\r\n".encode() + body)
+        fields, files = {}, []
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename():
+                files.append((part.get_filename(), part.get_payload(decode=True)))
+            else:
+                fields[name] = part.get_payload(decode=True).decode()
+        return fields, files
+
+    def _status(self, task_id, task):
+        if time.time() < task['ready_at']:
+            status = "started"
+        else:
+            status = "failure" if task['fail'] else "success"
+        return {"task_id": task_id, "task_type": "convert", "task_status": status, "task_position": None}
+
+    def handle(self, method, path, query, headers, body):
+        if path == "/health":
+            return 200, {"status": "ok"}
+        if path == "/version":
+            return 200, self.versions
+
+        if path == "/v1/convert/file/async" and method == "POST":
+            fields, files = self._parse_form(headers, body)
+            if not files:
+                return 422, {"detail": "files is required"}
+            task_id = uuid.uuid4().hex
+            now = time.time()
+            with self._task_lock:
+                self.last_options = fields
+                fail = self.fail_tasks > 0
+                self.fail_tasks -= 1 if fail else 0
+                self.tasks[task_id] = {'files': files, 'ready_at': now + self.conversion_time, 'fail': fail}
+                in_flight = sum(1 for task in self.tasks.values() if task['ready_at'] > now)
+                self.max_in_flight = max(self.max_in_flight, in_flight)
+            return 200, {"task_id": task_id, "task_type": "convert", "task_status": "pending", "task_position": 1}
+
+        parts = path.strip("/").split("/")
+        if len(parts) == 4 and parts[:3] == ["v1", "status", "poll"] and method == "GET":
+            task = self.tasks.get(parts[3])
+            if task is None:
+                return 404, {"detail": "Task not found."}
+            wait = float(parse_qs(query).get("wait", ["0"])[0])
+            time.sleep(max(0.0, min(wait, task['ready_at'] - time.time())))
+            return 200, self._status(parts[3], task)
+
+        if len(parts) == 3 and parts[:2] == ["v1", "result"] and method == "GET":
+            task = self.tasks.get(parts[2])
+            if task is None:
+                return 404, {"detail": "Task not found."}
+            if task['fail']:
+                return 200, {"document": {"md_content": None}, "status": "failure",
+                             "errors": [{"component_type": "pipeline", "error_message": "conversion failed"}]}
+            file_name, data = task['files'][0]
+            markdown = f"# {file_name}\n\n{data.decode('utf-8', errors='replace')}"
+            return 200, {"document": {"filename": file_name, "md_content": markdown}, "status": "success",
+                         "errors": [], "processing_time": self.conversion_time}
+
+        return 404, {"detail": "Not Found"}
+
+class FakeOpenWebUI(StandInServer):
+    """OpenWebUI stand-in for the file and knowledge base API the processor uses
+
+    Supports GET /health, GET /api/v1/knowledge/, POST /api/v1/knowledge/create,
+    POST /api/v1/knowledge/{id}/file/add, GET /api/v1/knowledge/{id}/files,
+    GET /api/v1/models/, POST /api/v1/models/create and POST /api/v1/files/
+    (multipart `file`). Uploaded files are kept in `files`; `embedding_rate` (bytes
+    per second) delays each file upload the way OpenWebUI's embedding on upload does.
+    Bearer tokens are not checked.
+    """
+
+    def __init__(self, latency=0.0, embedding_rate=None, **kwargs):
+        super().__init__(latency=latency, **kwargs)
+        self.embedding_rate = embedding_rate
+        self.knowledge_bases = {}  # id -> {'id', 'name', 'description', 'files'}
+        self.files = {}  # id -> {'id', 'filename', 'size'}
+        self.models = []
+        self._state_lock = threading.Lock()
+
+    def handle(self, method, path, query, headers, body):
+        if path == "/health":
+            return 200, {"status": True}
+
+        if path == "/api/v1/files/" and method == "POST":
+            files = FakeDoclingServe._parse_form(headers, body)[1]
+            if not files:
+                return 422, {"detail": "file is required"}
+            file_name, data = files[0]
+            if self.embedding_rate:
+                time.sleep(len(data) / self.embedding_rate)
+            file = {"id": uuid.uuid4().hex, "filename": file_name, "size": len(data)}
+            with self._state_lock:
+                self.files[file["id"]] = file
+            return 200, file
+
+        if path == "/api/v1/knowledge/" and method == "GET":
+            with self._state_lock:
+                return 200, [{key: kb[key] for key in ("id", "name", "description")} for kb in self.knowledge_bases.values()]
+
+        if path == "/api/v1/knowledge/create" and method == "POST":
+            payload = json.loads(body or b"{}")
+            kb = {"id": uuid.uuid4().hex, "name": payload.get("name"), "description": payload.get("description"), "files": []}
+            with self._state_lock:
+                self.knowledge_bases[kb["id"]] = kb
+            return 200, {key: kb[key] for key in ("id", "name", "description")}
+
+        if path == "/api/v1/models/":
+            with self._state_lock:
+                return 200, list(self.models)
+
+        if path == "/api/v1/models/create" and method == "POST":
+            model = json.loads(body or b"{}")
+            with self._state_lock:
+                self.models.append(model)
+            return 200, model
+
+        parts = path.strip("/").split("/")
+        if len(parts) == 5 and parts[:3] == ["api", "v1", "knowledge"]:
+            with self._state_lock:
+                kb = self.knowledge_bases.get(parts[3])
+                if kb is None:
+                    return 404, {"detail": "Knowledge not found"}
+                if parts[4] == "files" and method == "GET":
+                    return 200, [self.files[file_id] for file_id in kb["files"]]
+
+        if len(parts) == 6 and parts[:3] == ["api", "v1", "knowledge"] and parts[4:] == ["file", "add"] and method == "POST":
+            file_id = json.loads(body or b"{}").get("file_id")
+            with self._state_lock:
+                kb = self.knowledge_bases.get(parts[3])
+                if kb is None or file_id not in self.files:
+                    return 400, {"detail": "Knowledge or file not found"}
+                if file_id in kb["files"]:
+                    return 400, {"detail": "Duplicate content detected"}
+                kb["files"].append(file_id)
+                return 200, {"id": kb["id"], "name": kb["name"], "files": [self.files[f] for f in kb["files"]]}
+
+        return 404, {"detail": "Not Found"}
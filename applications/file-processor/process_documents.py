@@ -17,22 +17,47 @@ This application supports two approaches to PII protection:
 
 To switch to Transform Engine:
 1. Uncomment vault_client initialization
-2. Comment out vault_kv_client initialization
+2. Comment out vault_kv_client initialization (in _lazy_clients)
 3. Update protect_pii_with_vault() function
 """
 
 import os
 import time
+import asyncio
 import requests
+import random
 import sys
 import logging
 import re
 import gc
+import base64
+import codecs
+import hashlib
+import io
+import tempfile
+import threading
+import multiprocessing
+import queue
+import itertools
+import http.server
+import functools
 import psutil
-from azure.storage.blob import BlobServiceClient, ContainerClient
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from azure.core import MatchConditions
+from azure.core.exceptions import (HttpResponseError, ResourceExistsError, ResourceModifiedError, ResourceNotFoundError,
+                                   ServiceRequestError, ServiceResponseError)
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 from datetime import datetime
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from importlib.metadata import version as package_version, PackageNotFoundError
+from requests.adapters import HTTPAdapter
 import json
-from docling.document_converter import DocumentConverter
+# Docling (and the ML stack behind it), the blob SDK (which loads aiohttp) and aiohttp are
+# imported where they are first needed, so importing this module for its helpers stays fast
 
 # Configure logging to write to stdout and stderr
 logging.basicConfig(
@@ -45,14 +70,85 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class FailureReasons(logging.Filter):
+    """Remembers the last error each thread logged, as the failure reason of the upload it is processing
+
+    Failures caused by the document itself are flagged too: it cannot be converted or
+    decoded, a dependency rejected its request with a 4xx, or processing raised an
+    error that is not a dependency outage. Only those count toward MAX_ATTEMPTS;
+    anything else is treated as an outage and deferred without using up an attempt.
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self._local = threading.local()
+    
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            self._local.last = record.getMessage()
+        return True
+    
+    def reset(self):
+        self._local.last = None
+        self._local.document = False
+    
+    def last(self):
+        return getattr(self._local, 'last', None)
+    
+    def mark_document_failure(self):
+        """Flag the current upload's failure as caused by its content"""
+        self._local.document = True
+    
+    def mark_error(self, error):
+        """Flag the current upload's failure as caused by its content unless `error` is a dependency outage"""
+        if not is_dependency_error(error):
+            self.mark_document_failure()
+    
+    def mark_status(self, status_code):
+        """Flag the current upload's failure as caused by its content if a dependency rejected its request"""
+        if is_document_status(status_code):
+            self.mark_document_failure()
+    
+    def is_document_failure(self):
+        return getattr(self._local, 'document', False)
+
+class DependencyError(RuntimeError):
+    """A dependency failed a request; `status_code` is its HTTP status, if it answered"""
+    
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+# 4xx statuses about the service or the caller (auth, rate limits, timeouts, races), not the document
+DEPENDENCY_STATUSES = {401, 403, 404, 408, 409, 412, 429}
+
+def is_document_status(status_code):
+    """Whether a response status means the request for this document is bad (e.g. 400, 413, 415, 422)"""
+    return status_code is not None and 400 <= status_code < 500 and status_code not in DEPENDENCY_STATUSES
+
+def is_dependency_error(error):
+    """Whether an exception means a dependency is unavailable rather than that the document is bad"""
+    if isinstance(error, (DependencyError, HttpResponseError)):
+        return not is_document_status(getattr(error, 'status_code', None))
+    if isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError, ClaimLostError,
+                          requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                          ServiceRequestError, ServiceResponseError)):
+        return True
+    # aiohttp is imported lazily by the async HTTP client
+    aiohttp = sys.modules.get('aiohttp')
+    return aiohttp is not None and isinstance(error, aiohttp.ClientError)
+
+failure_reasons = FailureReasons()
+logger.addFilter(failure_reasons)
+# Parallel blob transfers make many requests; keep the Azure SDK's per-request HTTP logging out of INFO
+logging.getLogger('azure.core.pipeline.policies.http_logging_policy').setLevel(logging.WARNING)
+
 # Memory monitoring and optimization
 def log_memory_usage():
     """Log current memory usage"""
     try:
-        process = psutil.Process()
-        memory_info = process.memory_info()
-        memory_percent = process.memory_percent()
-        logger.info(f"Memory usage: {memory_info.rss / 1024 / 1024:.1f} MB ({memory_percent:.1f}%)")
+        rss, memory_percent = memory_usage()
+        logger.info(f"Memory usage: {rss / 1024 / 1024:.1f} MB ({memory_percent:.1f}%)")
     except Exception as e:
         logger.debug(f"Could not log memory usage: {str(e)}")
 
@@ -78,6 +174,151 @@ def check_memory_available():
         logger.debug(f"Could not check memory: {str(e)}")
         return True  # Assume OK if we can't check
 
+class Counter:
+    """Monotonic counter with optional labels"""
+    
+    def __init__(self, registry):
+        self._registry = registry
+        self._values = {}
+    
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._registry._lock:
+            self._values[key] = self._values.get(key, 0) + value
+    
+    def samples(self):
+        with self._registry._lock:
+            return [(dict(key), value) for key, value in self._values.items()]
+
+class Histogram:
+    """Latency histogram with optional labels; `time()` and `timed()` observe elapsed seconds"""
+    
+    def __init__(self, registry, buckets):
+        self._registry = registry
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [per-bucket counts, count, sum]
+    
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._registry._lock:
+            counts, count, total = self._values.get(key) or ([0] * len(self.buckets), 0, 0.0)
+            index = bisect_left(self.buckets, value)
+            if index < len(counts):
+                counts[index] += 1
+            self._values[key] = (counts, count + 1, total + value)
+    
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+    
+    def timed(self, **labels):
+        """Decorator observing the duration of each call (sync or async)"""
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def wrapper(*args, **kwargs):
+                    with self.time(**labels):
+                        return await func(*args, **kwargs)
+            else:
+                @functools.wraps(func)
+                def wrapper(*args, **kwargs):
+                    with self.time(**labels):
+                        return func(*args, **kwargs)
+            return wrapper
+        return decorator
+    
+    def summary(self):
+        """Count and total seconds per label set"""
+        with self._registry._lock:
+            return {key: (count, total) for key, (_, count, total) in self._values.items()}
+    
+    def samples(self):
+        with self._registry._lock:
+            values = {key: (list(counts), count, total) for key, (counts, count, total) in self._values.items()}
+        samples = []
+        for key, (counts, count, total) in values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', dict(key, le=f"{bound:g}"), cumulative))
+            samples += [('_bucket', dict(key, le="+Inf"), count), ('_sum', dict(key), total), ('_count', dict(key), count)]
+        return samples
+
+class MetricsRegistry:
+    """Prometheus-style metrics rendered in the text exposition format
+
+    Counters and histograms are updated by the pipeline as it runs. Everything else
+    (queue depth, cache statistics, memory) is registered as a callback that is only
+    read when the metrics are rendered, so it costs nothing between scrapes.
+    """
+    
+    def __init__(self, prefix='file_processor'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._metrics = []  # (name, type, help, samples callable)
+    
+    def counter(self, name, help):
+        counter = Counter(self)
+        self._metrics.append((name, 'counter', help, lambda: [('', labels, value) for labels, value in counter.samples()]))
+        return counter
+    
+    def histogram(self, name, help, buckets):
+        histogram = Histogram(self, buckets)
+        self._metrics.append((name, 'histogram', help, histogram.samples))
+        return histogram
+    
+    def collect(self, name, help, read, kind='gauge'):
+        """Register a metric read at render time; `read` returns a number or a list of (labels, value)"""
+        def samples():
+            value = read()
+            if value is None:
+                return []
+            if isinstance(value, (int, float)):
+                return [('', {}, value)]
+            return [('', labels, sample) for labels, sample in value]
+        self._metrics.append((name, kind, help, samples))
+    
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+        return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+    
+    def render(self) -> str:
+        """All metrics in the Prometheus text format"""
+        lines = []
+        for name, kind, help, samples in list(self._metrics):
+            try:
+                values = samples()
+            except Exception as e:
+                logger.debug(f"Could not collect metric {name}: {str(e)}")
+                continue
+            full_name = f"{self.prefix}_{name}"
+            lines += [f"# HELP {full_name} {help}", f"# TYPE {full_name} {kind}"]
+            lines += [f"{full_name}{suffix}{self._labels(labels)} {value}" for suffix, labels, value in values]
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+stage_seconds = metrics.histogram(
+    'stage_seconds', 'Seconds spent in each pipeline stage',
+    (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+)
+documents_total = metrics.counter('documents_total', 'Uploads finished, by result (processed, failed, deferred, dead_lettered)')
+downloaded_bytes_total = metrics.counter('downloaded_bytes_total', 'Bytes of uploads downloaded for processing')
+
+def memory_usage():
+    """RSS in bytes and percent of system memory used by this process"""
+    process = psutil.Process()
+    return process.memory_info().rss, process.memory_percent()
+
+metrics.collect('memory_rss_bytes', 'Resident set size of the processor', lambda: memory_usage()[0])
+metrics.collect('memory_percent', 'Share of system memory used by the processor', lambda: memory_usage()[1])
+
 # Configuration
 AZURE_STORAGE_ACCOUNT = os.getenv('AZURE_STORAGE_ACCOUNT')
 AZURE_STORAGE_ACCESS_KEY = os.getenv('AZURE_STORAGE_ACCESS_KEY')
@@ -85,20 +326,139 @@ OPENWEBUI_URL = os.getenv('OPENWEBUI_URL')
 OPENWEBUI_API_KEY = os.getenv('OPENWEBUI_API_KEY')
 UPLOAD_CONTAINER = os.getenv('UPLOAD_CONTAINER', 'uploads')
 PROCESSED_CONTAINER = os.getenv('PROCESSED_CONTAINER', 'processed')
+LEDGER_CONTAINER = os.getenv('LEDGER_CONTAINER', 'ledger')  # Processing ledger: completed stages per content hash
+LEDGER_ENABLED = os.getenv('LEDGER_ENABLED', 'true').lower() == 'true'  # Skip duplicate content and resume interrupted documents
+LEDGER_WRITE_ATTEMPTS = int(os.getenv('LEDGER_WRITE_ATTEMPTS', '5'))  # Re-reads of an entry another replica changed before giving up
+WORK_CLAIMS = os.getenv('WORK_CLAIMS', 'blob')  # 'blob' = leased lock blobs shared by all replicas, 'local' = this process only
+LOCK_CONTAINER = os.getenv('LOCK_CONTAINER', 'locks')  # Lock blobs leased by the replica processing each upload
+LEASE_DURATION = int(os.getenv('LEASE_DURATION', '30'))  # Seconds (15-60) before a crashed replica's claim expires; renewed every third
+FAILED_CONTAINER = os.getenv('FAILED_CONTAINER', 'failed')  # Dead-letter container for uploads that used up their attempts
+MAX_ATTEMPTS = int(os.getenv('MAX_ATTEMPTS', '5'))  # Attempts per upload before it is dead-lettered (0 = retry forever)
+RETRY_BACKOFF_BASE = float(os.getenv('RETRY_BACKOFF_BASE', '60'))  # Seconds before the first retry of a failed upload, doubling per attempt
+RETRY_BACKOFF_MAX = float(os.getenv('RETRY_BACKOFF_MAX', '3600'))  # Cap on the wait between attempts
 PROCESSING_INTERVAL = int(os.getenv('PROCESSING_INTERVAL', '30'))
 KNOWLEDGE_BASE_NAME = os.getenv('KNOWLEDGE_BASE_NAME', 'Default Knowledge Base')
 KNOWLEDGE_BASE_DESCRIPTION = os.getenv('KNOWLEDGE_BASE_DESCRIPTION', 'Knowledge base for processed documents from the upload pipeline')
 BASE_MODEL_ID = os.getenv('BASE_MODEL_ID', 'granite-code:latest')  # Base model for new KB agents
+KB_CACHE_TTL = int(os.getenv('KB_CACHE_TTL', '300'))  # Seconds between reconciling the cached KB name -> ID map with OpenWebUI
+
+# Worker pool configuration
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', '4'))  # Concurrent file jobs (network-bound stages run in threads)
+SCHEDULER_POLICY = os.getenv('SCHEDULER_POLICY', 'sjf')  # Order of pending uploads: 'sjf' (smallest first), 'fifo' or 'fair' (per knowledge base)
+SCHEDULER_LIGHT_WORKERS = int(os.getenv('SCHEDULER_LIGHT_WORKERS', str(max(1, MAX_WORKERS // 2))))  # Workers reserved for text formats (no Docling)
+SCHEDULER_HEAVY_WORKERS = int(os.getenv('SCHEDULER_HEAVY_WORKERS', str(max(1, MAX_WORKERS - SCHEDULER_LIGHT_WORKERS))))  # Workers for Docling/OCR files
+SCHEDULER_AGING_SECONDS = float(os.getenv('SCHEDULER_AGING_SECONDS', '300'))  # Waiting this long halves an upload's effective size under sjf
+CONVERSION_PROCESSES = int(os.getenv('CONVERSION_PROCESSES', '2'))  # Docling conversion processes (0 = convert in-process)
+
+# Change feed configuration
+CHANGE_FEED = os.getenv('CHANGE_FEED', 'http')  # 'http' (upload notifications + polling fallback) or 'poll'
+CHANGE_FEED_PORT = int(os.getenv('CHANGE_FEED_PORT', '8082'))  # Port for upload notifications (POST /notify)
+HEALTH_PORT = int(os.getenv('HEALTH_PORT', '8081'))  # Port for /health, /metrics and /demo/compare (0 = not served)
+HEARTBEAT_TIMEOUT = int(os.getenv('HEARTBEAT_TIMEOUT', str(max(120, 4 * PROCESSING_INTERVAL))))  # Processing loop silent this long = not live
+HEALTH_PROBE_TTL = float(os.getenv('HEALTH_PROBE_TTL', '15'))  # Seconds a dependency probe result is reused by readiness checks
+HEALTH_PROBE_TIMEOUT = float(os.getenv('HEALTH_PROBE_TIMEOUT', '3'))  # Timeout of each dependency probe
+CHANGE_FEED_TOKEN = os.getenv('CHANGE_FEED_TOKEN')  # Optional shared secret expected in X-Notify-Token
+MIN_POLL_INTERVAL = float(os.getenv('MIN_POLL_INTERVAL', '2'))  # Polling backs off from here up to PROCESSING_INTERVAL
+
+# Docling converter configuration
+DOCLING_DO_OCR = os.getenv('DOCLING_DO_OCR', 'true').lower() == 'true'
+DOCLING_DO_TABLE_STRUCTURE = os.getenv('DOCLING_DO_TABLE_STRUCTURE', 'true').lower() == 'true'
+CONVERTER_WARMUP_FORMATS = [fmt.strip() for fmt in os.getenv('CONVERTER_WARMUP_FORMATS', 'pdf').split(',') if fmt.strip()]
+CONVERTER_CACHE_MAX_MB = int(os.getenv('CONVERTER_CACHE_MAX_MB', '3072'))  # Memory cap for cached converters per process
+CONVERTER_IDLE_TTL = int(os.getenv('CONVERTER_IDLE_TTL', '1800'))  # Evict converters unused for this many seconds
+CONVERSION_BACKEND = os.getenv('CONVERSION_BACKEND', 'local')  # 'local' (Docling library) or 'remote' (docling-serve)
+DOCLING_SERVE_URL = os.getenv('DOCLING_SERVE_URL', 'http://localhost:5001')
+DOCLING_SERVE_API_KEY = os.getenv('DOCLING_SERVE_API_KEY')  # Optional, sent as X-Api-Key
+DOCLING_SERVE_MAX_CONCURRENCY = int(os.getenv('DOCLING_SERVE_MAX_CONCURRENCY', str(MAX_WORKERS)))  # Remote conversions in flight per processor
+DOCLING_SERVE_POLL_WAIT = float(os.getenv('DOCLING_SERVE_POLL_WAIT', '5'))  # Seconds docling-serve holds each status long-poll
+DOCLING_SERVE_TIMEOUT = float(os.getenv('DOCLING_SERVE_TIMEOUT', '900'))  # Seconds before a remote conversion is abandoned
+DOCLING_SERVE_VERSION_TTL = float(os.getenv('DOCLING_SERVE_VERSION_TTL', '300'))  # Seconds the reported docling-serve version is reused
+DOCLING_SERVE_FALLBACK = os.getenv('DOCLING_SERVE_FALLBACK', 'true').lower() == 'true'  # Convert locally when docling-serve fails
+CONVERSION_CACHE_ENABLED = os.getenv('CONVERSION_CACHE_ENABLED', 'false').lower() == 'true'  # Reuse markdown for identical content (stores it unredacted)
+CONVERSION_CACHE_DIR = os.getenv('CONVERSION_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'file-processor-conversions'))
+CONVERSION_CACHE_MAX_MB = int(os.getenv('CONVERSION_CACHE_MAX_MB', '1024'))  # Disk cap for cached markdown (least recently used evicted)
+CONVERSION_CACHE_MAX_AGE = float(os.getenv('CONVERSION_CACHE_MAX_AGE', str(7 * 24 * 3600)))  # Seconds an unused entry is kept
 
 # Vault Configuration
 VAULT_ADDR = os.getenv('VAULT_ADDR', 'http://localhost:8200')
 VAULT_TOKEN = os.getenv('VAULT_TOKEN')
 VAULT_TRANSFORM_PATH = os.getenv('VAULT_TRANSFORM_PATH', 'ai_data_transform')
 VAULT_ROLE = os.getenv('VAULT_ROLE', 'file-processor')
+PII_PATTERN_TTL = int(os.getenv('PII_PATTERN_TTL', '300'))  # Seconds between background refreshes of PII patterns from Vault KV
+VAULT_TRANSFORM_BATCH_SIZE = int(os.getenv('VAULT_TRANSFORM_BATCH_SIZE', '100'))  # Values per Transform batch_input encode request
+VAULT_TRANSFORM_CHUNK_SIZE = int(os.getenv('VAULT_TRANSFORM_CHUNK_SIZE', '1000'))  # Characters per value sent to Transform
+VAULT_BREAKER_THRESHOLD = int(os.getenv('VAULT_BREAKER_THRESHOLD', '3'))  # Consecutive failures before Vault calls are skipped
+VAULT_BREAKER_RESET = float(os.getenv('VAULT_BREAKER_RESET', '30'))  # Seconds before an open breaker lets a trial call through
+
+# In-memory data path
+DOCUMENT_SPILL_THRESHOLD = int(os.getenv('DOCUMENT_SPILL_THRESHOLD', str(64 * 1024 * 1024)))  # Bytes above which downloads and OpenWebUI uploads spill to a temp file
 
-# Initialize Azure Blob Service Client
-connection_string = f"DefaultEndpointsProtocol=https;AccountName={AZURE_STORAGE_ACCOUNT};AccountKey={AZURE_STORAGE_ACCESS_KEY};EndpointSuffix=core.windows.net"
-blob_service_client = BlobServiceClient.from_connection_string(connection_string)
+# Streaming redaction for very large documents
+PII_STREAMING_THRESHOLD = int(os.getenv('PII_STREAMING_THRESHOLD', str(16 * 1024 * 1024)))  # Markdown characters above which redaction streams
+PII_STREAM_WINDOW = int(os.getenv('PII_STREAM_WINDOW', str(1024 * 1024)))  # Characters read per redaction window
+PII_STREAM_OVERLAP = int(os.getenv('PII_STREAM_OVERLAP', '4096'))  # Characters held back between windows (must exceed the longest PII match)
+
+# HTTP client configuration (Vault and OpenWebUI)
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', str(max(10, MAX_WORKERS * 2))))  # Keep-alive connections per host
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))  # Seconds to establish a connection
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '30'))  # Seconds to wait for a response
+OPENWEBUI_UPLOAD_TIMEOUT = float(os.getenv('OPENWEBUI_UPLOAD_TIMEOUT', '300'))  # Read timeout for file uploads (OpenWebUI embeds on upload)
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '3'))  # Retries for connection errors and 429/502/503/504
+HTTP_BACKOFF_BASE = float(os.getenv('HTTP_BACKOFF_BASE', '0.5'))  # First retry waits up to this many seconds (doubles each retry)
+HTTP_BACKOFF_MAX = float(os.getenv('HTTP_BACKOFF_MAX', '10'))  # Upper bound for a single retry wait
+IO_MAX_CONNECTIONS = int(os.getenv('IO_MAX_CONNECTIONS', '256'))  # Total connections the async I/O engine keeps per client
+
+# Blob transfer configuration
+BLOB_BLOCK_SIZE = int(os.getenv('BLOB_BLOCK_SIZE', str(4 * 1024 * 1024)))  # Bytes per staged block for large and streamed uploads
+BLOB_SINGLE_PUT_SIZE = int(os.getenv('BLOB_SINGLE_PUT_SIZE', str(8 * 1024 * 1024)))  # Larger uploads are staged as parallel blocks
+BLOB_CHUNK_GET_SIZE = int(os.getenv('BLOB_CHUNK_GET_SIZE', str(4 * 1024 * 1024)))  # Bytes per ranged GET (at most 4 MiB when validating content)
+BLOB_MAX_CONCURRENCY = int(os.getenv('BLOB_MAX_CONCURRENCY', '4'))  # Parallel ranged GETs or block uploads per transfer
+BLOB_VALIDATE_CONTENT = os.getenv('BLOB_VALIDATE_CONTENT', 'true').lower() == 'true'  # MD5 per range/block plus the whole-blob Content-MD5
+
+# Initialize Azure Blob Service Client (AZURE_STORAGE_CONNECTION_STRING overrides the account/key pair, e.g. for Azurite)
+def create_blob_service_client(connection_string, client_class=None):
+    """Blob service client configured for parallel ranged downloads and staged block uploads"""
+    if client_class is None:
+        from azure.storage.blob import BlobServiceClient as client_class
+    return client_class.from_connection_string(
+        connection_string,
+        max_block_size=BLOB_BLOCK_SIZE,
+        max_single_put_size=BLOB_SINGLE_PUT_SIZE,
+        max_single_get_size=BLOB_CHUNK_GET_SIZE,
+        max_chunk_get_size=BLOB_CHUNK_GET_SIZE
+    )
+
+connection_string = os.getenv('AZURE_STORAGE_CONNECTION_STRING') or f"DefaultEndpointsProtocol=https;AccountName={AZURE_STORAGE_ACCOUNT};AccountKey={AZURE_STORAGE_ACCESS_KEY};EndpointSuffix=core.windows.net"
+
+# Shared clients are created on first use rather than at import, so tools that only need
+# helpers from this module do not pay for them. Assigning the module attribute (as tests
+# and benchmarks do) replaces the client.
+_lazy_clients = {
+    'blob_service_client': lambda: create_blob_service_client(connection_string),
+    'vault_kv_client': lambda: VaultKVPIIProtector(VAULT_ADDR, VAULT_TOKEN) if VAULT_TOKEN else None
+}
+_lazy_clients_lock = threading.Lock()
+
+def lazy_client(name):
+    """Module-level client `name`, created on first use"""
+    if name not in globals():
+        with _lazy_clients_lock:
+            if name not in globals():
+                globals()[name] = _lazy_clients[name]()
+    return globals()[name]
+
+def __getattr__(name):
+    if name in _lazy_clients:
+        return lazy_client(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def get_blob_service_client():
+    """Blob service client for the configured storage account"""
+    return lazy_client('blob_service_client')
+
+def get_vault_kv_client():
+    """Vault KV PII protector, or None without a VAULT_TOKEN"""
+    return lazy_client('vault_kv_client')
 
 class VirtualFileHandler:
     """Handles virtual files and directory structures in Azure Blob Storage"""
@@ -171,41 +531,45 @@ class VirtualFileHandler:
     
     def process_virtual_file_hierarchy(self, container_name, max_depth=None):
         """Process virtual file hierarchy in a container"""
-        if max_depth is None:
-            max_depth = 5 # Default to 5 levels for virtual structure
-            
         try:
             container_client = self.blob_service_client.get_container_client(container_name)
-            virtual_structure = {}
-            
-            for blob in container_client.list_blobs():
-                if self.is_virtual_directory(blob.name):
-                    # This is a virtual directory or nested file
-                    components = self.get_virtual_path_components(blob.name)
-                    
-                    if len(components) <= max_depth:
-                        # Build virtual structure
-                        current_level = virtual_structure
-                        for i, component in enumerate(components[:-1]):
-                            if component not in current_level:
-                                current_level[component] = {'type': 'directory', 'children': {}}
-                            current_level = current_level[component]['children']
-                        
-                        # Add the file
-                        if components:
-                            current_level[components[-1]] = {
-                                'type': 'file',
-                                'blob_name': blob.name,
-                                'size': blob.size,
-                                'last_modified': blob.last_modified.isoformat() if blob.last_modified else None
-                            }
-            
-            return virtual_structure
+            return self.build_virtual_file_hierarchy(container_client.list_blobs(), max_depth)
             
         except Exception as e:
             logger.error(f"Error processing virtual file hierarchy: {str(e)}")
             return {}
     
+    def build_virtual_file_hierarchy(self, blobs, max_depth=None):
+        """Build the virtual file hierarchy from blobs that have already been listed"""
+        if max_depth is None:
+            max_depth = 5 # Default to 5 levels for virtual structure
+        
+        virtual_structure = {}
+        for blob in blobs:
+            if self.is_virtual_directory(blob.name):
+                # This is a virtual directory or nested file
+                components = self.get_virtual_path_components(blob.name)
+                
+                if len(components) <= max_depth:
+                    # Build virtual structure
+                    current_level = virtual_structure
+                    for i, component in enumerate(components[:-1]):
+                        if component not in current_level:
+                            current_level[component] = {'type': 'directory', 'children': {}}
+                        current_level = current_level[component]['children']
+                    
+                    # Add the file
+                    if components:
+                        last_modified = blob.last_modified
+                        current_level[components[-1]] = {
+                            'type': 'file',
+                            'blob_name': blob.name,
+                            'size': blob.size,
+                            'last_modified': last_modified.isoformat() if hasattr(last_modified, 'isoformat') else last_modified
+                        }
+        
+        return virtual_structure
+    
     def get_virtual_file_content(self, blob_client, encoding='utf-8'):
         """Get content from virtual file with proper encoding handling"""
         try:
@@ -237,77 +601,433 @@ class VirtualFileHandler:
             logger.error(f"Error getting virtual file content: {str(e)}")
             return None
 
+class HttpClient:
+    """Shared HTTP session with per-host connection pools, timeouts, retries and metrics
+
+    One keep-alive pool of up to `pool_maxsize` connections is kept per host; callers
+    beyond that wait for a free connection instead of opening new ones. Connection
+    errors, timeouts and 429/502/503/504 responses are retried with full-jitter
+    exponential backoff, honouring Retry-After. Only idempotent requests are retried
+    unless the caller passes `idempotent=True`.
+    """
+    
+    RETRY_STATUSES = frozenset({429, 502, 503, 504})
+    IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'})
+    
+    def __init__(self, name, pool_maxsize=HTTP_POOL_MAXSIZE, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+                 max_retries=HTTP_MAX_RETRIES, backoff_base=HTTP_BACKOFF_BASE, backoff_max=HTTP_BACKOFF_MAX, headers=None):
+        self.name = name
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.headers = dict(headers or {})
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._metrics = {}
+        self._metrics_lock = threading.Lock()
+    
+    @property
+    def session(self):
+        """The requests.Session, created on first use so forked/spawned processes get their own"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    session.headers.update(self.headers)
+                    # Retries are handled in request() so they can be jittered and counted
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_maxsize, max_retries=0, pool_block=True)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+        return self._session
+    
+    def _backoff(self, attempt, response=None):
+        """Seconds to wait before retry `attempt` (1-based)"""
+        if response is not None and response.headers.get('Retry-After'):
+            retry_after = response.headers['Retry-After']
+            try:
+                return min(self.backoff_max, max(0.0, float(retry_after)))
+            except ValueError:
+                try:
+                    return min(self.backoff_max, max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()))
+                except (TypeError, ValueError):
+                    pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1))))
+    
+    def _record(self, endpoint, elapsed, status=None, retries=0, error=False):
+        with self._metrics_lock:
+            metric = self._metrics.setdefault(endpoint, {
+                'requests': 0, 'errors': 0, 'retries': 0, 'total_seconds': 0.0, 'max_seconds': 0.0, 'statuses': {}
+            })
+            metric['requests'] += 1
+            metric['retries'] += retries
+            metric['total_seconds'] += elapsed
+            metric['max_seconds'] = max(metric['max_seconds'], elapsed)
+            if error or status is None or status >= 500:
+                metric['errors'] += 1
+            if status is not None:
+                metric['statuses'][str(status)] = metric['statuses'].get(str(status), 0) + 1
+    
+    def request(self, method, url, endpoint=None, idempotent=None, timeout=None, **kwargs):
+        """Send a request and return the final response; raises requests exceptions once retries are exhausted
+
+        `endpoint` names the metric bucket (defaults to the method and URL path, so pass
+        a fixed label for URLs that contain IDs).
+        """
+        method = method.upper()
+        endpoint = endpoint or f"{method} {urlparse(url).path}"
+        if idempotent is None:
+            idempotent = method in self.IDEMPOTENT_METHODS
+        retries = self.max_retries if idempotent else 0
+        start = time.perf_counter()
+        attempt = 0
+        
+        while True:
+            try:
+                response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= retries:
+                    self._record(endpoint, time.perf_counter() - start, retries=attempt, error=True)
+                    raise
+                attempt += 1
+                wait = self._backoff(attempt)
+                logger.warning(f"{self.name} {endpoint} failed ({type(e).__name__}), retry {attempt}/{retries} in {wait:.2f}s")
+                time.sleep(wait)
+                continue
+            
+            if response.status_code in self.RETRY_STATUSES and attempt < retries:
+                attempt += 1
+                wait = self._backoff(attempt, response)
+                logger.warning(f"{self.name} {endpoint} returned {response.status_code}, retry {attempt}/{retries} in {wait:.2f}s")
+                response.close()
+                time.sleep(wait)
+                continue
+            
+            self._record(endpoint, time.perf_counter() - start, status=response.status_code, retries=attempt)
+            return response
+    
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+    
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+    
+    def stats(self):
+        """Per-endpoint request counts, errors, retries, status codes and latency"""
+        with self._metrics_lock:
+            return {
+                endpoint: dict(metric, statuses=dict(metric['statuses']),
+                               avg_seconds=round(metric['total_seconds'] / metric['requests'], 4))
+                for endpoint, metric in self._metrics.items()
+            }
+    
+    def close(self):
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+class HttpResult:
+    """A fully read AsyncHttpClient response, with the parts of requests.Response the processor uses"""
+    
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+    
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+    
+    def json(self):
+        return json.loads(self.content)
+
+class AsyncHttpClient(HttpClient):
+    """asyncio counterpart of HttpClient on aiohttp, with the same timeouts, retries and metrics
+
+    Used from the I/O engine's event loop. Up to `max_connections` connections are kept
+    open in total and `pool_maxsize` per host, so requests from every worker can be in
+    flight at once.
+    """
+    
+    def __init__(self, name, max_connections=IO_MAX_CONNECTIONS, **kwargs):
+        super().__init__(name, **kwargs)
+        self.max_connections = max_connections
+        self._async_session = None
+    
+    def _get_async_session(self):
+        import aiohttp
+        if self._async_session is None or self._async_session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.pool_maxsize)
+            self._async_session = aiohttp.ClientSession(connector=connector, headers=self.headers)
+        return self._async_session
+    
+    async def request(self, method, url, endpoint=None, idempotent=None, timeout=None, **kwargs):
+        """Send a request and return an HttpResult; raises aiohttp errors once retries are exhausted"""
+        import aiohttp
+        method = method.upper()
+        endpoint = endpoint or f"{method} {urlparse(url).path}"
+        if idempotent is None:
+            idempotent = method in self.IDEMPOTENT_METHODS
+        retries = self.max_retries if idempotent else 0
+        connect_timeout, read_timeout = timeout or self.timeout
+        client_timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        start = time.perf_counter()
+        attempt = 0
+        
+        while True:
+            try:
+                async with self._get_async_session().request(method, url, timeout=client_timeout, **kwargs) as response:
+                    result = HttpResult(response.status, response.headers, await response.read())
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt >= retries:
+                    self._record(endpoint, time.perf_counter() - start, retries=attempt, error=True)
+                    raise
+                attempt += 1
+                wait = self._backoff(attempt)
+                logger.warning(f"{self.name} {endpoint} failed ({type(e).__name__}), retry {attempt}/{retries} in {wait:.2f}s")
+                await asyncio.sleep(wait)
+                continue
+            
+            if result.status_code in self.RETRY_STATUSES and attempt < retries:
+                attempt += 1
+                wait = self._backoff(attempt, result)
+                logger.warning(f"{self.name} {endpoint} returned {result.status_code}, retry {attempt}/{retries} in {wait:.2f}s")
+                await asyncio.sleep(wait)
+                continue
+            
+            self._record(endpoint, time.perf_counter() - start, status=result.status_code, retries=attempt)
+            return result
+    
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+    
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+    
+    async def aclose(self):
+        if self._async_session is not None:
+            await self._async_session.close()
+            self._async_session = None
+
+class AsyncIOEngine:
+    """Event loop on a background thread that carries the processor's network I/O
+
+    Worker threads hand coroutines to run() or gather() and block until they finish,
+    while the loop multiplexes the requests of every worker over shared connection
+    pools. gather() runs independent steps of one document concurrently. Docling
+    conversion stays in its process pool and never runs on the loop.
+    """
+    
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._blob_service = None
+    
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name='io-engine', daemon=True)
+                self._thread.start()
+                logger.info("Started async I/O engine")
+            return self._loop
+    
+    def run(self, coro):
+        """Run a coroutine on the engine's loop and return its result"""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("AsyncIOEngine.run() called from the engine's own loop")
+        return asyncio.run_coroutine_threadsafe(coro, self._get_loop()).result()
+    
+    def gather(self, *coros, return_exceptions=False):
+        """Run coroutines concurrently on the engine's loop and return their results in order
+
+        With `return_exceptions`, every coroutine runs to the end and a failure is
+        returned in its place instead of raised.
+        """
+        async def gather_all():
+            return await asyncio.gather(*coros, return_exceptions=return_exceptions)
+        return self.run(gather_all())
+    
+    @property
+    def blob_service(self):
+        """Async blob service client, created on the engine's loop on first use"""
+        if self._blob_service is None:
+            from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+            self._blob_service = create_blob_service_client(connection_string, client_class=AsyncBlobServiceClient)
+        return self._blob_service
+    
+    def close(self):
+        """Close async clients and stop the loop"""
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        
+        async def close_clients():
+            for client in (vault_http_async, openwebui_http_async):
+                await client.aclose()
+            if self._blob_service is not None:
+                await self._blob_service.close()
+                self._blob_service = None
+        asyncio.run_coroutine_threadsafe(close_clients(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join()
+        loop.close()
+
+# Shared HTTP clients; every Vault and OpenWebUI call goes through one of these
+vault_http = HttpClient("Vault")
+openwebui_http = HttpClient("OpenWebUI")
+vault_http_async = AsyncHttpClient("Vault (async)")
+openwebui_http_async = AsyncHttpClient("OpenWebUI (async)", timeout=(HTTP_CONNECT_TIMEOUT, OPENWEBUI_UPLOAD_TIMEOUT))
+io_engine = AsyncIOEngine()
+
+def get_http_stats() -> dict:
+    """Per-endpoint metrics of the shared HTTP clients"""
+    clients = [vault_http, openwebui_http, vault_http_async, openwebui_http_async]
+    if docling_serve is not None:
+        clients.append(docling_serve.http)
+    return {client.name: client.stats() for client in clients}
+
+def _http_stat(name):
+    return lambda: [({'client': client, 'endpoint': endpoint}, metric[name])
+                    for client, endpoints in get_http_stats().items() for endpoint, metric in endpoints.items()]
+
+metrics.collect('http_requests_total', 'Requests to Vault, OpenWebUI and docling-serve', _http_stat('requests'), kind='counter')
+metrics.collect('http_errors_total', 'Failed requests (connection errors, timeouts and 5xx)', _http_stat('errors'), kind='counter')
+metrics.collect('http_retries_total', 'Retried requests', _http_stat('retries'), kind='counter')
+metrics.collect('http_request_seconds_total', 'Total seconds spent in requests', _http_stat('total_seconds'), kind='counter')
+
+class CircuitBreaker:
+    """Tracks the health of a dependency from the outcome of real calls
+
+    After `failure_threshold` consecutive failures the breaker opens and calls are
+    skipped. Once `reset_timeout` seconds have passed a single trial call is let
+    through: success closes the breaker, failure opens it again.
+    """
+    
+    def __init__(self, name, failure_threshold=VAULT_BREAKER_THRESHOLD, reset_timeout=VAULT_BREAKER_RESET):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+    
+    def allow(self):
+        """Whether a call should be attempted now"""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                return True
+            return False
+    
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                logger.info(f"{self.name} circuit breaker closed")
+            self.state = 'closed'
+            self.failures = 0
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    logger.warning(f"{self.name} circuit breaker opened after {self.failures} failure(s)")
+                self.state = 'open'
+                self.opened_at = time.time()
+
 class VaultTransformClient:
     """Client for interacting with Vault Transform Engine (Enterprise Feature)"""
     
-    def __init__(self, vault_url, token, transform_path, role):
+    def __init__(self, vault_url, token, transform_path, role, batch_size=VAULT_TRANSFORM_BATCH_SIZE, chunk_size=VAULT_TRANSFORM_CHUNK_SIZE, http=None):
         self.vault_url = vault_url.rstrip('/')
         self.token = token
         self.transform_path = transform_path
         self.role = role
         self.headers = {"X-Vault-Token": token}
+        self.http = http or vault_http
+        self.batch_size = max(1, batch_size)
+        self.chunk_size = chunk_size
+        self.breaker = CircuitBreaker("Vault Transform")
         
     def is_available(self):
         """Check if Vault is available"""
         try:
-            response = requests.get(f"{self.vault_url}/v1/sys/health", timeout=5)
+            response = self.http.get(f"{self.vault_url}/v1/sys/health", timeout=5)
             return response.status_code == 200
         except Exception:
             return False
     
+    def encode_values(self, transformation, values):
+        """Encode values with Vault's batch_input API, `batch_size` values per request
+
+        Values Vault rejects individually are returned unchanged. Raises if a request fails.
+        """
+        encoded = []
+        for start in range(0, len(values), self.batch_size):
+            batch = values[start:start + self.batch_size]
+            # Encoding the same values twice is harmless, so the batch can be retried
+            response = self.http.post(
+                f"{self.vault_url}/v1/{self.transform_path}/encode/{self.role}",
+                endpoint=f"encode {transformation}",
+                idempotent=True,
+                headers=self.headers,
+                json={"batch_input": [{"value": value, "transformation": transformation} for value in batch]},
+                timeout=(HTTP_CONNECT_TIMEOUT, 10)
+            )
+            
+            if response.status_code != 200:
+                raise DependencyError(f"Vault {transformation} batch failed: {response.status_code}", response.status_code)
+            
+            results = response.json()["data"]["batch_results"]
+            for value, result in zip(batch, results):
+                if result.get("error") or "encoded_value" not in result:
+                    logger.warning(f"Vault {transformation} failed for one value: {result.get('error')}")
+                    encoded.append(value)
+                else:
+                    encoded.append(result["encoded_value"])
+        return encoded
+    
     def tokenize_pii(self, text):
         """Tokenize sensitive data (SSN, email) using Vault Transform Engine"""
-        if not self.is_available():
+        if not self.breaker.allow():
             logger.warning("Vault not available, using fallback tokenization")
             return self._fallback_tokenization(text)
         
         try:
-            # Split text into manageable chunks (Vault has limits)
-            chunks = self._split_text_into_chunks(text, max_length=1000)
-            processed_chunks = []
-            
-            for chunk in chunks:
-                response = requests.post(
-                    f"{self.vault_url}/v1/{self.transform_path}/encode/{self.role}/pii-tokenize",
-                    headers=self.headers,
-                    json={"value": chunk},
-                    timeout=10
-                )
-                
-                if response.status_code == 200:
-                    processed_chunks.append(response.json()["data"]["encoded_value"])
-                else:
-                    logger.warning(f"Vault tokenization failed for chunk: {response.status_code}")
-                    processed_chunks.append(chunk)
-            
+            # Split text into manageable chunks (Vault has limits) and encode them in batches
+            chunks = self._split_text_into_chunks(text, max_length=self.chunk_size)
+            processed_chunks = self.encode_values("pii-tokenize", chunks)
+            self.breaker.record_success()
             return " ".join(processed_chunks)
             
         except Exception as e:
             logger.error(f"Error in Vault tokenization: {str(e)}")
+            self.breaker.record_failure()
             return self._fallback_tokenization(text)
     
     def mask_pii(self, text):
         """Mask sensitive data (phone, bank account) using Vault Transform Engine"""
-        if not self.is_available():
+        if not self.breaker.allow():
             logger.warning("Vault not available, using fallback masking")
             return self._fallback_masking(text)
         
         try:
-            response = requests.post(
-                f"{self.vault_url}/v1/{self.transform_path}/encode/{self.role}/pii-mask",
-                headers=self.headers,
-                json={"value": text},
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                return response.json()["data"]["encoded_value"]
-            else:
-                logger.warning(f"Vault masking failed: {response.status_code}")
-                return self._fallback_masking(text)
+            masked = self.encode_values("pii-mask", [text])[0]
+            self.breaker.record_success()
+            return masked
                 
         except Exception as e:
             logger.error(f"Error in Vault masking: {str(e)}")
+            self.breaker.record_failure()
             return self._fallback_masking(text)
     
     def _fallback_tokenization(self, text):
@@ -345,80 +1065,300 @@ class VaultTransformClient:
         
         return chunks
 
+class PIIScanner:
+    """Finds every configured PII type in a single pass over the text
+
+    The per-type patterns are combined into one alternation of named groups, so one
+    scan both applies the replacements and counts matches per type. Patterns that
+    cannot be combined safely (numbered backreferences, clashing group names,
+    unsupported flags) fall back to one pass per type.
+    """
+    
+    _INLINE_FLAGS = ((re.IGNORECASE, 'i'), (re.MULTILINE, 'm'), (re.DOTALL, 's'))
+    _SUPPORTED_FLAGS = re.UNICODE | re.IGNORECASE | re.MULTILINE | re.DOTALL
+    
+    def __init__(self, patterns, replacements):
+        # replacements: {pii_type: replacement string or callable(match) -> str}
+        self.patterns = {
+            pii_type: pattern if isinstance(pattern, re.Pattern) else re.compile(pattern)
+            for pii_type, pattern in patterns.items()
+            if pii_type in replacements
+        }
+        self.replacements = {
+            pii_type: replacement if callable(replacement) else (lambda m, replacement=replacement: replacement)
+            for pii_type, replacement in replacements.items()
+            if pii_type in self.patterns
+        }
+        self._group_types = {}
+        self.combined = self._combine()
+    
+    def _combine(self):
+        """Build the single alternation, or None if the patterns cannot be combined"""
+        parts = []
+        for index, (pii_type, pattern) in enumerate(self.patterns.items()):
+            inline = ''.join(letter for flag, letter in self._INLINE_FLAGS if pattern.flags & flag)
+            if pattern.flags & ~self._SUPPORTED_FLAGS or re.search(r'\\[1-9]|\(\?P=', pattern.pattern):
+                logger.info(f"PII pattern for {pii_type} cannot be combined, scanning it separately")
+                return None
+            
+            group = f"pii_{index}"
+            self._group_types[group] = pii_type
+            body = f"(?{inline}:{pattern.pattern})" if inline else pattern.pattern
+            parts.append(f"(?P<{group}>{body})")
+        
+        if not parts:
+            return None
+        try:
+            return re.compile('|'.join(parts))
+        except re.error as e:
+            logger.info(f"PII patterns cannot be combined, scanning each type separately: {str(e)}")
+            return None
+    
+    def redact(self, text):
+        """Replace every PII match; returns (protected_text, {pii_type: count})"""
+        counts = dict.fromkeys(self.patterns, 0)
+        
+        if self.combined is None:
+            for pii_type, pattern in self.patterns.items():
+                text, counts[pii_type] = pattern.subn(self.replacements[pii_type], text)
+            return text, counts
+        
+        def replace(match):
+            pii_type = self._group_types[match.lastgroup]
+            counts[pii_type] += 1
+            return self.replacements[pii_type](match)
+        
+        return self.combined.sub(replace, text), counts
+    
+    def _iter_matches(self, text, pos):
+        """Yield (pii_type, match) in text order starting at pos, as one scan would find them"""
+        if self.combined is not None:
+            for match in self.combined.finditer(text, pos):
+                yield self._group_types[match.lastgroup], match
+            return
+        
+        # Patterns scanned separately: merge their next matches in order
+        order = list(self.patterns)
+        upcoming = {pii_type: self.patterns[pii_type].search(text, pos) for pii_type in order}
+        while True:
+            candidates = [(m.start(), order.index(t), t) for t, m in upcoming.items() if m]
+            if not candidates:
+                return
+            _, _, pii_type = min(candidates)
+            match = upcoming[pii_type]
+            yield pii_type, match
+            pos = max(match.end(), match.start() + 1)
+            for other, other_match in upcoming.items():
+                if other_match and other_match.start() < pos:
+                    upcoming[other] = self.patterns[other].search(text, pos)
+    
+    def _redact_window(self, text, start, safe, write, counts):
+        """Write protected text from start up to safe (None = end of text); returns where output stopped"""
+        end = len(text) if safe is None else safe
+        if end <= start:
+            return start
+        
+        last = start
+        for pii_type, match in self._iter_matches(text, start):
+            if match.start() >= end:
+                break
+            if safe is not None and match.end() > safe:
+                # The match may continue into the next window - hold it back
+                end = match.start()
+                break
+            counts[pii_type] += 1
+            write(text[last:match.start()])
+            write(self.replacements[pii_type](match))
+            last = match.end()
+        
+        write(text[last:end])
+        return end
+    
+    def redact_stream(self, chunks, write, overlap=PII_STREAM_OVERLAP, context=256):
+        """Redact text arriving in chunks, passing protected text to write() as soon as it is final
+
+        The last `overlap` characters of each window are held back and rescanned with
+        the next window, so matches spanning a boundary are never split. A little
+        already-written context is kept so word boundaries still see the preceding text.
+        Returns {pii_type: count}.
+        """
+        counts = dict.fromkeys(self.patterns, 0)
+        buffer = ""
+        start = 0
+        for chunk in chunks:
+            buffer = buffer + chunk
+            done = self._redact_window(buffer, start, len(buffer) - overlap, write, counts)
+            keep = max(0, done - context)
+            buffer = buffer[keep:]
+            start = done - keep
+        
+        self._redact_window(buffer, start, None, write, counts)
+        return counts
+
+class PIIPatternCache:
+    """Compiled PII patterns and replacement strategies loaded from Vault KV
+
+    The first call loads synchronously. After that a background thread refreshes the
+    set every `ttl` seconds, so pattern rotations in Vault reach the processor within
+    one TTL. If Vault is unreachable the last known good set keeps being served.
+    """
+    
+    def __init__(self, protector, ttl=PII_PATTERN_TTL):
+        self.protector = protector
+        self.ttl = ttl
+        self._config = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._refresher = None
+        self._stop = threading.Event()
+    
+    def _compile(self, patterns, strategies, source):
+        """Compile patterns, keeping the fallback pattern for any that do not compile"""
+        fallback_patterns = self.protector._fallback_patterns()
+        compiled = {}
+        for pii_type, pattern in patterns.items():
+            try:
+                compiled[pii_type] = re.compile(pattern)
+            except re.error as e:
+                logger.warning(f"Invalid {pii_type} pattern from Vault, using fallback: {str(e)}")
+                compiled[pii_type] = re.compile(fallback_patterns[pii_type])
+        return {
+            'patterns': compiled,
+            'strategies': strategies,
+            'scanner': self.protector.build_scanner(compiled, strategies),
+            'source': source,
+            'loaded_at': time.time()
+        }
+    
+    def refresh(self):
+        """Fetch patterns and strategies from Vault, keeping the current set if Vault is unreachable"""
+        try:
+            config = self._compile(
+                self.protector.fetch_pii_patterns(),
+                self.protector.fetch_replacement_strategies(),
+                'vault'
+            )
+        except Exception as e:
+            if self._config is not None:
+                age = time.time() - self._config['loaded_at']
+                logger.warning(f"Could not refresh PII patterns from Vault, serving last known good set ({age:.0f}s old): {str(e)}")
+                return False
+            logger.warning(f"Could not load PII patterns from Vault, using fallback patterns: {str(e)}")
+            config = self._compile(
+                self.protector._fallback_patterns(),
+                self.protector._fallback_strategies(),
+                'fallback'
+            )
+        
+        with self._lock:
+            self._config = config
+        logger.debug(f"Loaded {len(config['patterns'])} PII patterns from {config['source']}")
+        return config['source'] == 'vault'
+    
+    def _refresh_loop(self):
+        while True:
+            # Retry sooner while running on fallback patterns
+            on_fallback = self._config is not None and self._config['source'] == 'fallback'
+            if self._stop.wait(min(self.ttl, 30) if on_fallback else self.ttl):
+                break
+            self.refresh()
+    
+    def start(self):
+        """Start the background refresh thread"""
+        with self._lock:
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=self._refresh_loop, name='pii-pattern-refresh', daemon=True)
+                self._refresher.start()
+    
+    def stop(self):
+        self._stop.set()
+    
+    def get(self):
+        """Current compiled patterns and strategies"""
+        if self._config is None:
+            with self._load_lock:
+                if self._config is None:
+                    self.refresh()
+            self.start()
+        return self._config
+    
+    def age(self):
+        """Seconds since the current set was loaded (None before the first load)"""
+        config = self._config
+        return time.time() - config['loaded_at'] if config else None
+
 class VaultKVPIIProtector:
     """Client for PII protection using Vault KV (Open Source Compatible)"""
     
-    def __init__(self, vault_url, token):
+    def __init__(self, vault_url, token, pattern_ttl=PII_PATTERN_TTL, http=None, http_async=None):
         self.vault_url = vault_url.rstrip('/')
         self.token = token
         self.headers = {"X-Vault-Token": token}
+        self.http = http or vault_http
+        self.http_async = http_async or vault_http_async
+        self.pattern_cache = PIIPatternCache(self, ttl=pattern_ttl)
         
     def is_available(self):
         """Check if Vault is available"""
         try:
-            response = requests.get(f"{self.vault_url}/v1/sys/health", timeout=5)
+            response = self.http.get(f"{self.vault_url}/v1/sys/health", timeout=5)
             return response.status_code == 200
         except Exception:
             return False
     
+    def _read_kv(self, path):
+        """Read a KV v2 secret; returns None if Vault answers without it, raises if Vault is unreachable"""
+        response = self.http.get(
+            f"{self.vault_url}/v1/secret/data/{path}",
+            endpoint="kv read",
+            headers=self.headers,
+            timeout=(HTTP_CONNECT_TIMEOUT, 10)
+        )
+        
+        if response.status_code == 200:
+            return response.json()['data']['data']
+        return None
+    
+    async def _read_kv_async(self, path):
+        """_read_kv() on the I/O engine's async HTTP client"""
+        response = await self.http_async.get(
+            f"{self.vault_url}/v1/secret/data/{path}",
+            endpoint="kv read",
+            headers=self.headers,
+            timeout=(HTTP_CONNECT_TIMEOUT, 10)
+        )
+        
+        if response.status_code == 200:
+            return response.json()['data']['data']
+        return None
+    
+    @stage_seconds.timed(stage='vault_fetch')
+    def _read_kv_many(self, paths):
+        """Read several KV v2 secrets concurrently, in order"""
+        return io_engine.gather(*(self._read_kv_async(path) for path in paths))
+    
+    def fetch_pii_patterns(self):
+        """Retrieve PII patterns from Vault KV, using the fallback pattern for any missing entry"""
+        fallbacks = self._fallback_patterns()
+        entries = self._read_kv_many([f"pii-patterns/{pii_type}" for pii_type in fallbacks])
+        return {
+            pii_type: data['pattern'] if data else fallback_pattern
+            for (pii_type, fallback_pattern), data in zip(fallbacks.items(), entries)
+        }
+    
+    def fetch_replacement_strategies(self):
+        """Retrieve replacement strategies from Vault KV, using the fallback strategy for any missing entry"""
+        fallbacks = self._fallback_strategies()
+        entries = self._read_kv_many([f"pii-replacements/{pii_type}" for pii_type in fallbacks])
+        return {
+            pii_type: data if data else fallback_strategy
+            for (pii_type, fallback_strategy), data in zip(fallbacks.items(), entries)
+        }
+    
     def get_pii_patterns(self):
         """Securely retrieve PII patterns from Vault KV"""
         try:
-            # Get SSN pattern
-            response = requests.get(
-                f"{self.vault_url}/v1/secret/data/pii-patterns/ssn",
-                headers=self.headers,
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                ssn_pattern = response.json()['data']['data']['pattern']
-            else:
-                ssn_pattern = r'\b\d{3}-\d{2}-\d{4}\b'  # Fallback pattern
-            
-            # Get email pattern
-            response = requests.get(
-                f"{self.vault_url}/v1/secret/data/pii-patterns/email",
-                headers=self.headers,
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                email_pattern = response.json()['data']['data']['pattern']
-            else:
-                email_pattern = r'\b[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b'  # Fallback pattern
-            
-            # Get phone pattern
-            response = requests.get(
-                f"{self.vault_url}/v1/secret/data/pii-patterns/phone",
-                headers=self.headers,
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                phone_pattern = response.json()['data']['data']['pattern']
-            else:
-                phone_pattern = r'\b\d{3}-\d{3}-\d{4}\b'  # Fallback pattern
-            
-            # Get bank pattern
-            response = requests.get(
-                f"{self.vault_url}/v1/secret/data/pii-patterns/bank",
-                headers=self.headers,
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                bank_pattern = response.json()['data']['data']['pattern']
-            else:
-                bank_pattern = r'\b\d{4}-\d{4}-\d{4}-\d{4}\b'  # Fallback pattern
-            
-            return {
-                'ssn': ssn_pattern,
-                'email': email_pattern,
-                'phone': phone_pattern,
-                'bank': bank_pattern
-            }
-            
+            return self.fetch_pii_patterns()
         except Exception as e:
             logger.warning(f"Error retrieving PII patterns from Vault: {str(e)}")
             return self._fallback_patterns()
@@ -426,35 +1366,7 @@ class VaultKVPIIProtector:
     def get_replacement_strategies(self):
         """Get how to replace each PII type"""
         try:
-            # Get SSN strategy
-            response = requests.get(
-                f"{self.vault_url}/v1/secret/data/pii-replacements/ssn",
-                headers=self.headers,
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                ssn_strategy = response.json()['data']['data']
-            else:
-                ssn_strategy = {'method': 'tokenize', 'prefix': 'tok_ssn_'}
-            
-            # Get phone strategy
-            response = requests.get(
-                f"{self.vault_url}/v1/secret/data/pii-replacements/phone",
-                headers=self.headers,
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                phone_strategy = response.json()['data']['data']
-            else:
-                phone_strategy = {'method': 'mask', 'pattern': '***-***-****'}
-            
-            return {
-                'ssn': ssn_strategy,
-                'phone': phone_strategy
-            }
-            
+            return self.fetch_replacement_strategies()
         except Exception as e:
             logger.warning(f"Error retrieving replacement strategies from Vault: {str(e)}")
             return self._fallback_strategies()
@@ -475,60 +1387,38 @@ class VaultKVPIIProtector:
             'phone': {'method': 'mask', 'pattern': '***-***-****'}
         }
     
-    def protect_pii(self, text):
-        """Protect PII using patterns stored in Vault KV"""
+    def build_scanner(self, patterns, strategies):
+        """Single-pass scanner applying the replacement for each PII type"""
+        replacements = {
+            'email': lambda m: f"tok_email_{self._generate_secure_token()}",
+            'phone': "***-***-****",
+            'bank': "****-****-****-****"
+        }
+        # SSNs are only replaced when the strategy asks for tokenization
+        if strategies.get('ssn', {}).get('method') == 'tokenize':
+            replacements['ssn'] = lambda m: f"tok_ssn_{self._generate_secure_token()}"
+        
+        # Keep the original order: SSN, email, phone, bank
+        ordered = {pii_type: replacements[pii_type] for pii_type in patterns if pii_type in replacements}
+        return PIIScanner(patterns, ordered)
+    
+    def protect_pii_with_counts(self, text):
+        """Protect PII in one pass; returns (protected_text, {pii_type: count})"""
         try:
-            # Get patterns and strategies from Vault
-            patterns = self.get_pii_patterns()
-            strategies = self.get_replacement_strategies()
-            
-            protected_text = text
-            
-            # Apply SSN protection
-            if 'ssn' in patterns:
-                ssn_pattern = patterns['ssn']
-                ssn_strategy = strategies['ssn']
-                
-                if ssn_strategy['method'] == 'tokenize':
-                    # Generate secure token
-                    protected_text = re.sub(
-                        ssn_pattern, 
-                        lambda m: f"tok_ssn_{self._generate_secure_token()}", 
-                        protected_text
-                    )
-            
-            # Apply email protection
-            if 'email' in patterns:
-                email_pattern = patterns['email']
-                protected_text = re.sub(
-                    email_pattern,
-                    lambda m: f"tok_email_{self._generate_secure_token()}", 
-                    protected_text
-                )
-            
-            # Apply phone masking
-            if 'phone' in patterns:
-                phone_pattern = patterns['phone']
-                protected_text = re.sub(
-                    phone_pattern,
-                    "***-***-****",
-                    protected_text
-                )
-            
-            # Apply bank account masking
-            if 'bank' in patterns:
-                bank_pattern = patterns['bank']
-                protected_text = re.sub(
-                    bank_pattern,
-                    "****-****-****-****",
-                    protected_text
-                )
-            
-            return protected_text
+            # Compiled scanner from the cache (refreshed from Vault in the background)
+            return self.pattern_cache.get()['scanner'].redact(text)
             
         except Exception as e:
             logger.error(f"Error in Vault KV PII protection: {str(e)}")
-            return self._fallback_protection(text)
+            return basic_pii_scanner.redact(text)
+    
+    def protect_pii(self, text):
+        """Protect PII using patterns stored in Vault KV"""
+        return self.protect_pii_with_counts(text)[0]
+    
+    def protect_pii_stream(self, chunks, write):
+        """Protect PII in text arriving in chunks, writing protected output incrementally"""
+        return self.pattern_cache.get()['scanner'].redact_stream(chunks, write)
     
     def _generate_secure_token(self):
         """Generate a secure random token"""
@@ -538,11 +1428,23 @@ class VaultKVPIIProtector:
     def _fallback_protection(self, text):
         """Fallback PII protection if Vault KV fails"""
         # Simple regex-based protection
-        text = re.sub(r'\b\d{3}-\d{2}-\d{4}\b', 'tok_ssn_xxxxx', text)
-        text = re.sub(r'\b[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b', 'tok_email_xxxxx', text)
-        text = re.sub(r'\b\d{3}-\d{3}-\d{4}\b', '***-***-****', text)
-        text = re.sub(r'\b\d{4}-\d{4}-\d{4}-\d{4}\b', '****-****-****-****', text)
-        return text
+        return basic_pii_scanner.redact(text)[0]
+
+# Scanner for basic protection with hardcoded patterns (used when Vault is unavailable)
+basic_pii_scanner = PIIScanner(
+    {
+        'ssn': r'\b\d{3}-\d{2}-\d{4}\b',
+        'email': r'\b[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b',
+        'phone': r'\b\d{3}-\d{3}-\d{4}\b',
+        'bank': r'\b\d{4}-\d{4}-\d{4}-\d{4}\b'
+    },
+    {
+        'ssn': 'tok_ssn_xxxxx',
+        'email': 'tok_email_xxxxx',
+        'phone': '***-***-****',
+        'bank': '****-****-****-****'
+    }
+)
 
 # Initialize Vault clients
 # Comment out Transform Engine client (Enterprise feature)
@@ -550,49 +1452,642 @@ class VaultKVPIIProtector:
 
 # Use KV-based PII protection (Open Source compatible)
 # This approach works with Vault Community Edition and stores PII patterns securely
-vault_kv_client = VaultKVPIIProtector(VAULT_ADDR, VAULT_TOKEN) if VAULT_TOKEN else None
+# vault_kv_client is created on first use, see get_vault_kv_client()
+
+# A blob waiting in the upload container, as returned by the listing (only the name is known for notifications)
+PendingBlob = namedtuple('PendingBlob', ['name', 'size', 'etag', 'last_modified'], defaults=[None, None, None])
 
 def list_blobs(container_name):
     """List all blobs in a container"""
-    container_client = blob_service_client.get_container_client(container_name)
-    return [blob.name for blob in container_client.list_blobs()]
+    return [blob.name for blob in iter_blobs(container_name)]
+
+def iter_blobs(container_name):
+    """Stream the blobs in a container page by page as PendingBlob items"""
+    container_client = get_blob_service_client().get_container_client(container_name)
+    for blob in container_client.list_blobs():
+        yield PendingBlob(blob.name, blob.size, blob.etag, blob.last_modified)
+
+def file_md5(path) -> bytes:
+    """MD5 digest of a local file, read in blocks"""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOB_BLOCK_SIZE), b''):
+            md5.update(block)
+    return md5.digest()
+
+def verify_content_md5(downloader, digest, blob_name):
+    """Raise if downloaded content does not match the Content-MD5 stored with the blob"""
+    expected = downloader.properties.content_settings.content_md5
+    if expected and bytes(expected) != digest:
+        raise ValueError(f"MD5 mismatch for {blob_name}: downloaded content does not match the stored Content-MD5")
+
+def _download(blob_client):
+    """Start a download that fetches ranges in parallel, validating each range's MD5"""
+    return blob_client.download_blob(max_concurrency=BLOB_MAX_CONCURRENCY, validate_content=BLOB_VALIDATE_CONTENT)
 
 def download_blob(container_name, blob_name, local_path):
     """Download a blob to local storage"""
-    container_client = blob_service_client.get_container_client(container_name)
+    container_client = get_blob_service_client().get_container_client(container_name)
     blob_client = container_client.get_blob_client(blob_name)
     
+    downloader = _download(blob_client)
     with open(local_path, "wb") as file:
-        download_stream = blob_client.download_blob()
-        file.write(download_stream.readall())
+        downloader.readinto(file)
+    if BLOB_VALIDATE_CONTENT:
+        verify_content_md5(downloader, file_md5(local_path), blob_name)
+
+def _upload_options(content_md5=None):
+    """upload_blob() options: parallel staged blocks above BLOB_SINGLE_PUT_SIZE, storing the whole-blob MD5"""
+    from azure.storage.blob import ContentSettings
+    return {
+        'overwrite': True,
+        'max_concurrency': BLOB_MAX_CONCURRENCY,
+        'validate_content': BLOB_VALIDATE_CONTENT,
+        'content_settings': ContentSettings(content_md5=bytearray(content_md5)) if content_md5 else None
+    }
+
+def _upload(blob_client, data, content_md5=None):
+    """Upload with parallel staged blocks above BLOB_SINGLE_PUT_SIZE, storing the whole-blob MD5"""
+    blob_client.upload_blob(data, **_upload_options(content_md5))
 
 def upload_blob(container_name, blob_name, local_path):
     """Upload a file to blob storage"""
-    container_client = blob_service_client.get_container_client(container_name)
+    container_client = get_blob_service_client().get_container_client(container_name)
     blob_client = container_client.get_blob_client(blob_name)
     
+    content_md5 = file_md5(local_path) if BLOB_VALIDATE_CONTENT else None
     with open(local_path, "rb") as data:
-        blob_client.upload_blob(data, overwrite=True)
+        _upload(blob_client, data, content_md5)
 
-def get_list_knowledge() -> list[dict]:
-    """Get list of knowledge bases from OpenWebUI"""
+@stage_seconds.timed(stage='blob_upload')
+def upload_blob_data(container_name, blob_name, data):
+    """Upload bytes, text or an open binary file to blob storage"""
+    container_client = get_blob_service_client().get_container_client(container_name)
+    blob_client = container_client.get_blob_client(blob_name)
+    
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    content_md5 = hashlib.md5(data).digest() if BLOB_VALIDATE_CONTENT and isinstance(data, bytes) else None
+    _upload(blob_client, data, content_md5)
+
+@stage_seconds.timed(stage='blob_upload')
+async def upload_blob_data_async(container_name, blob_name, data):
+    """upload_blob_data() on the I/O engine's async blob client"""
+    blob_client = io_engine.blob_service.get_blob_client(container_name, blob_name)
+    
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    content_md5 = hashlib.md5(data).digest() if BLOB_VALIDATE_CONTENT and isinstance(data, bytes) else None
+    await blob_client.upload_blob(data, **_upload_options(content_md5))
+
+def copy_blob(container_name, source_name, target_name, target_container=None, metadata=None):
+    """Server-side copy of a blob (into `target_container`, default the same one); no data passes through the processor"""
+    source = get_blob_service_client().get_container_client(container_name).get_blob_client(source_name)
+    target = get_blob_service_client().get_container_client(target_container or container_name).get_blob_client(target_name)
+    
+    # Same-account copies of block blobs normally complete synchronously
+    status = target.start_copy_from_url(source.url, metadata=metadata)['copy_status']
+    while status == 'pending':
+        time.sleep(0.5)
+        status = target.get_blob_properties().copy.status
+    if status != 'success':
+        raise DependencyError(f"Copy of {source_name} to {target_name} ended with status {status}")
+
+# A downloaded document: its bytes in `data`, or in a temporary file at `path` when too large to hold in memory
+DocumentInput = namedtuple('DocumentInput', ['name', 'data', 'path', 'etag', 'content_type'], defaults=[None, None, None, None])
+
+@stage_seconds.timed(stage='download')
+def download_document(container_name, blob_name, spill_threshold=DOCUMENT_SPILL_THRESHOLD) -> DocumentInput:
+    """Download a blob into memory, or stream it to a temporary file above `spill_threshold` bytes"""
+    container_client = get_blob_service_client().get_container_client(container_name)
+    blob_client = container_client.get_blob_client(blob_name)
+    base_filename = blob_name.split('/')[-1]
+    
+    downloader = _download(blob_client)
+    downloaded_bytes_total.inc(downloader.size)
+    if downloader.size <= spill_threshold:
+        data = downloader.readall()
+        if BLOB_VALIDATE_CONTENT:
+            verify_content_md5(downloader, hashlib.md5(data).digest(), blob_name)
+        return DocumentInput(base_filename, data=data, etag=downloader.properties.etag,
+                             content_type=downloader.properties.content_settings.content_type)
+    
+    # Keep the original name at the end of the path so the format can still be detected
+    fd, path = tempfile.mkstemp(prefix='file-processor-', suffix=f"-{base_filename}")
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            downloader.readinto(file)
+        if BLOB_VALIDATE_CONTENT:
+            verify_content_md5(downloader, file_md5(path), blob_name)
+    except Exception:
+        os.remove(path)
+        raise
+    logger.info(f"Spilled large download to disk: {blob_name} ({downloader.size} bytes)")
+    return DocumentInput(base_filename, path=path, etag=downloader.properties.etag,
+                         content_type=downloader.properties.content_settings.content_type)
+
+def release_document(document):
+    """Remove the temporary file behind a spilled document"""
+    if isinstance(document, DocumentInput) and document.path:
+        try:
+            os.remove(document.path)
+        except OSError:
+            pass
+
+def document_source(document):
+    """Docling conversion source for a document: a file path, or an in-memory DocumentStream"""
+    if isinstance(document, str):
+        return document
+    if document.path:
+        return document.path
+    from docling.datamodel.base_models import DocumentStream
+    return DocumentStream(name=document.name, stream=io.BytesIO(document.data))
+
+def read_document_bytes(document) -> bytes:
+    """Raw bytes of a document given as a file path or DocumentInput"""
+    path = document if isinstance(document, str) else document.path
+    if path:
+        with open(path, 'rb') as f:
+            return f.read()
+    return document.data
+
+def document_size(document) -> int:
+    """Size in bytes of a document given as a file path or DocumentInput"""
+    path = document if isinstance(document, str) else document.path
+    return os.path.getsize(path) if path else len(document.data)
+
+def iter_document_bytes(document, chunk_size=1024 * 1024):
+    """Yield the raw bytes of a document in chunks, without reading it all at once"""
+    path = document if isinstance(document, str) else document.path
+    if path:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+    else:
+        for start in range(0, len(document.data), chunk_size):
+            yield document.data[start:start + chunk_size]
+
+def document_sha256(document) -> str:
+    """Hex SHA-256 of a document given as a file path or DocumentInput"""
+    path = document if isinstance(document, str) else document.path
+    if path:
+        with open(path, 'rb') as f:
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+    return hashlib.sha256(document.data).hexdigest()
+
+class BlobStreamWriter:
+    """Writes text to a block blob incrementally, staging a block every `block_size` bytes
+
+    Up to `max_concurrency` blocks upload in the background while more text is
+    produced. Nothing is visible in the container until close() commits the block
+    list, together with the MD5 of the whole blob.
+    """
+    
+    def __init__(self, container_name, blob_name, block_size=BLOB_BLOCK_SIZE, max_concurrency=BLOB_MAX_CONCURRENCY):
+        container_client = get_blob_service_client().get_container_client(container_name)
+        self.blob_client = container_client.get_blob_client(blob_name)
+        self.block_size = block_size
+        self.max_concurrency = max(1, max_concurrency)
+        self._buffer = bytearray()
+        self._block_ids = []
+        self._pending = []
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='block-upload')
+        self._md5 = hashlib.md5()
+        self.bytes_written = 0
+    
+    def _stage(self, data):
+        block_id = base64.b64encode(f"block-{len(self._block_ids):08d}".encode()).decode()
+        self._block_ids.append(block_id)
+        self._md5.update(data)
+        # Bound the blocks held in memory: wait for the oldest upload once the window is full
+        if len(self._pending) >= self.max_concurrency:
+            self._pending.pop(0).result()
+        self._pending.append(self._executor.submit(
+            self.blob_client.stage_block, block_id, bytes(data), validate_content=BLOB_VALIDATE_CONTENT
+        ))
+    
+    def write(self, text):
+        data = text.encode('utf-8')
+        self._buffer.extend(data)
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.block_size:
+            self._stage(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+    
+    def close(self):
+        """Stage any remaining data and commit the blob"""
+        from azure.storage.blob import BlobBlock, ContentSettings
+        try:
+            if self._buffer or not self._block_ids:
+                self._stage(self._buffer)
+                self._buffer = bytearray()
+            for staged in self._pending:
+                staged.result()
+            self._pending = []
+            content_settings = ContentSettings(content_md5=bytearray(self._md5.digest())) if BLOB_VALIDATE_CONTENT else None
+            self.blob_client.commit_block_list(
+                [BlobBlock(block_id=block_id) for block_id in self._block_ids],
+                content_settings=content_settings
+            )
+        finally:
+            self._executor.shutdown(wait=True)
+    
+    def abort(self):
+        """Stop staging blocks without committing; staged blocks expire uncommitted"""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._pending = []
+
+class ProcessingLedger:
+    """Persistent record of processed documents, keyed by content hash and upload etag
+
+    Each entry is a JSON blob `content/<sha256>.json` in the ledger container with the
+    stages the document has completed (`stored`, `uploaded`, `added`, `completed`) and
+    their results. An entry is written after every stage, so a restarted processor
+    resumes after the last completed stage instead of repeating it. `etags/<etag>.json`
+    maps an upload's etag to its content hash, so an upload that already completed is
+    recognised without downloading it again.
+    
+    Replicas share the ledger, so entries are written conditionally: a new entry only if
+    none exists yet, an existing one only while it has the etag it was read with. When
+    another replica wrote first, its entry is read again and merged before retrying.
+    """
+    
+    def __init__(self, container_name=LEDGER_CONTAINER, write_attempts=LEDGER_WRITE_ATTEMPTS):
+        self.container_name = container_name
+        self.write_attempts = write_attempts
+        self._locks = {}  # content hash -> [lock, holders and waiters]
+        self._locks_lock = threading.Lock()
+    
+    @property
+    def container(self):
+        return get_blob_service_client().get_container_client(self.container_name)
+    
+    def ensure_container(self):
+        """Create the ledger container if it does not exist"""
+        try:
+            self.container.create_container()
+            logger.info(f"Created processing ledger container: {self.container_name}")
+        except ResourceExistsError:
+            pass
+    
+    @contextmanager
+    def lock(self, content_hash):
+        """Per-hash lock, so identical content in concurrent jobs is processed once; dropped when no job uses it"""
+        with self._locks_lock:
+            holder = self._locks.setdefault(content_hash, [threading.Lock(), 0])
+            holder[1] += 1
+        try:
+            with holder[0]:
+                yield
+        finally:
+            with self._locks_lock:
+                holder[1] -= 1
+                if not holder[1]:
+                    del self._locks[content_hash]
+    
+    def _read(self, name):
+        """JSON blob with the etag it was read at under `_etag`, or None"""
+        try:
+            downloader = self.container.get_blob_client(name).download_blob()
+            entry = json.loads(downloader.readall())
+        except ResourceNotFoundError:
+            return None
+        entry['_etag'] = downloader.properties.etag
+        return entry
+    
+    def _write(self, name, entry):
+        """Create `name`, or replace it if it still has the entry's `_etag`; raises if another replica wrote first"""
+        data = json.dumps({key: value for key, value in entry.items() if key != '_etag'}, indent=2).encode('utf-8')
+        if entry.get('_etag'):
+            conditions = {'etag': entry['_etag'], 'match_condition': MatchConditions.IfNotModified}
+        else:
+            conditions = {'match_condition': MatchConditions.IfMissing}
+        result = self.container.get_blob_client(name).upload_blob(data, overwrite=True, **conditions)
+        entry['_etag'] = result['etag']
+    
+    @staticmethod
+    def _etag_name(etag):
+        etag = etag.strip('"')
+        return f"etags/{etag}.json"
+    
+    def get(self, content_hash):
+        """Entry for a content hash, or None"""
+        return self._read(f"content/{content_hash}.json")
+    
+    def lookup_etag(self, etag):
+        """Entry of the content uploaded with this etag, or None"""
+        link = self._read(self._etag_name(etag))
+        return self.get(link['content_hash']) if link else None
+    
+    def new_entry(self, content_hash, file_name):
+        return {
+            'content_hash': content_hash,
+            'file_name': file_name,
+            'duplicates': [],
+            'linked_knowledge_bases': [],
+            'stages': {},
+            'created_at': datetime.utcnow().isoformat()
+        }
+    
+    def save(self, entry):
+        """Write the entry, merging in what other replicas wrote since it was read"""
+        name = f"content/{entry['content_hash']}.json"
+        for _ in range(self.write_attempts):
+            try:
+                self._write(name, entry)
+                return
+            except (ResourceModifiedError, ResourceExistsError):
+                if not self._merge(entry, self._read(name)):
+                    return
+        raise DependencyError(f"Ledger entry {name} kept changing, gave up after {self.write_attempts} attempts")
+    
+    @classmethod
+    def _merge(cls, entry, current):
+        """Fold the stored entry into ours; False if ours should not be written over it
+
+        Duplicate names and linked knowledge bases are combined. Stages of the same file are
+        combined, ours winning. A completed entry for another file is kept as it is, since
+        its results are what duplicates are linked to.
+        """
+        if current is None:
+            entry.pop('_etag', None)
+            return True
+        entry['_etag'] = current['_etag']
+        for key in ('duplicates', 'linked_knowledge_bases'):
+            entry[key].extend(value for value in current[key] if value not in entry[key])
+        if current['file_name'] == entry['file_name']:
+            for stage, results in current['stages'].items():
+                entry['stages'].setdefault(stage, results)
+        elif cls.is_completed(current) and not cls.is_completed(entry):
+            return False
+        return True
+    
+    def record(self, entry, stage, **results):
+        """Mark a stage as completed with its results and persist the entry"""
+        entry['stages'][stage] = dict(results, completed_at=datetime.utcnow().isoformat())
+        self.save(entry)
+    
+    def link_etag(self, etag, entry, file_name):
+        """Remember that the upload with this etag is covered by `entry`"""
+        if etag:
+            try:
+                self._write(self._etag_name(etag), {'content_hash': entry['content_hash'], 'file_name': file_name})
+            except (ResourceModifiedError, ResourceExistsError):
+                pass  # Already linked: an etag always names the same content
+    
+    @staticmethod
+    def is_completed(entry, file_name=None):
+        """Whether the entry's content has been processed completely (for `file_name`, if given)"""
+        if not entry or 'completed' not in entry['stages']:
+            return False
+        return file_name is None or file_name == entry['file_name'] or file_name in entry['duplicates']
+
+processing_ledger = ProcessingLedger() if LEDGER_ENABLED else None
+
+# Failed attempts at an upload: count, earliest next attempt (epoch seconds), upload etag, last error
+# and the number of retries in a row deferred because a dependency failed
+AttemptRecord = namedtuple('AttemptRecord', ['attempts', 'retry_at', 'etag', 'error', 'deferrals'], defaults=[0, 0.0, None, None, 0])
+
+def attempt_record_from(metadata, etag=None):
+    """AttemptRecord stored in lock blob metadata; a changed upload etag starts the count again"""
+    if not metadata or (etag and metadata.get('etag') and metadata['etag'] != etag):
+        return AttemptRecord()
+    return AttemptRecord(int(metadata.get('attempts', 0)), float(metadata.get('retry_at', 0)),
+                         metadata.get('etag'), metadata.get('error'), int(metadata.get('deferrals', 0)))
+
+def attempt_metadata(record):
+    """Blob metadata for an AttemptRecord; values must be single-line ASCII"""
+    metadata = {'attempts': str(record.attempts), 'retry_at': f"{record.retry_at:.3f}"}
+    if record.etag:
+        metadata['etag'] = record.etag
+    if record.error:
+        metadata['error'] = " ".join(record.error.split()).encode('ascii', 'replace').decode()[:512]
+    if record.deferrals:
+        metadata['deferrals'] = str(record.deferrals)
+    return metadata
+
+class ClaimLostError(RuntimeError):
+    """The claim on an upload could not be renewed, so another replica may be processing it"""
+
+# The claim of the upload each worker thread is processing
+_current_claim = threading.local()
+
+def ensure_claimed(step):
+    """Raise ClaimLostError instead of taking an irreversible `step` once this thread's claim is lost"""
+    claim = getattr(_current_claim, 'claim', None)
+    if claim is not None and claim.lost:
+        raise ClaimLostError(f"Lost the claim on {claim.name}, not going to {step}")
+
+class WorkClaim:
+    """An upload claimed by this replica; `lost` is set if the claim could not be renewed"""
+    
+    def __init__(self, name, owner, lease=None, record=None):
+        self.name = name
+        self.lease = lease
+        self.record = record or AttemptRecord()
+        self.lost = False
+        self.released = False
+        self._owner = owner
+    
+    def release(self, done=False, failure=None):
+        """Give the upload back; `done` also removes its lock, `failure` (an AttemptRecord) is kept with it"""
+        if not self.released:
+            self.released = True
+            self._owner.release(self, done, failure)
+
+class BlobWorkClaims:
+    """Claims uploads across processor replicas with leases on lock blobs
+
+    Every upload has an empty lock blob of the same name in the lock container. A
+    replica processes an upload only while it holds the lease on that lock blob, so
+    replicas listing the same container never convert, upload or delete the same file
+    twice. Leases are renewed in the background every third of `lease_duration`; if a
+    replica crashes, its lease expires and another replica claims the upload on its
+    next listing. The upload blob itself is never leased, so the web upload app can
+    still overwrite it and its etag stays as the ledger recorded it.
+    
+    Failed attempts are recorded in the lock blob's metadata, so every replica sees the
+    same attempt count and backoff. Uploads whose next attempt is not yet due are not
+    claimed.
+    """
+    
+    def __init__(self, container_name=LOCK_CONTAINER, lease_duration=LEASE_DURATION):
+        self.container_name = container_name
+        self.lease_duration = lease_duration
+        self._claims = {}
+        self._claims_lock = threading.Lock()
+        self._renewer = None
+        self._retry_at = {}  # name -> (next attempt, etag) known to this replica, saves claiming too early
+    
+    @property
+    def container(self):
+        return get_blob_service_client().get_container_client(self.container_name)
+    
+    def ensure_container(self):
+        """Create the lock container if it does not exist"""
+        try:
+            self.container.create_container()
+            logger.info(f"Created work claim container: {self.container_name}")
+        except ResourceExistsError:
+            pass
+    
+    def claim(self, name, etag=None):
+        """Lease the lock blob for `name`; returns a WorkClaim, or None if another replica holds it or a retry is not due"""
+        retry_at, failed_etag = self._retry_at.get(name, (0, None))
+        if retry_at > time.time() and not (etag and failed_etag and etag != failed_etag):
+            return None
+        self._retry_at.pop(name, None)
+        lock_blob = self.container.get_blob_client(name)
+        try:
+            lock_blob.upload_blob(b"", overwrite=False)
+        except ResourceExistsError:
+            pass
+        try:
+            lease = lock_blob.acquire_lease(lease_duration=self.lease_duration)
+        except ResourceNotFoundError:
+            return None  # Another replica finished the upload and removed its lock
+        except HttpResponseError as e:
+            if e.status_code == 409:
+                return None
+            raise
+        
+        try:
+            record = attempt_record_from(lock_blob.get_blob_properties().metadata, etag)
+        except Exception:
+            lease.release()
+            raise
+        if record.retry_at > time.time():
+            self._remember_retry(name, record)
+            lease.release()
+            return None
+        
+        claim = WorkClaim(name, self, lease, record)
+        with self._claims_lock:
+            self._claims[name] = claim
+            if self._renewer is None:
+                self._renewer = threading.Thread(target=self._renew_claims, name='lease-renewer', daemon=True)
+                self._renewer.start()
+        return claim
+    
+    def release(self, claim, done=False, failure=None):
+        with self._claims_lock:
+            self._claims.pop(claim.name, None)
+        if failure:
+            self._remember_retry(claim.name, failure)
+        else:
+            self._retry_at.pop(claim.name, None)
+        if claim.lost:
+            return
+        try:
+            lock_blob = self.container.get_blob_client(claim.name)
+            if done:
+                lock_blob.delete_blob(lease=claim.lease)
+                return
+            if failure:
+                lock_blob.set_blob_metadata(attempt_metadata(failure), lease=claim.lease)
+            claim.lease.release()
+        except Exception as e:
+            # The lease expires on its own
+            logger.warning(f"Could not release the claim on {claim.name}: {str(e)}")
+    
+    def _remember_retry(self, name, record):
+        """Note when `name` is due again; entries already due are dropped, so only pending retries are kept"""
+        now = time.time()
+        with self._claims_lock:
+            for other, (retry_at, _) in list(self._retry_at.items()):
+                if retry_at <= now:
+                    del self._retry_at[other]
+            self._retry_at[name] = (record.retry_at, record.etag)
+    
+    def _renew_claims(self):
+        while True:
+            time.sleep(self.lease_duration / 3)
+            with self._claims_lock:
+                claims = list(self._claims.values())
+            for claim in claims:
+                try:
+                    claim.lease.renew()
+                except Exception as e:
+                    claim.lost = True
+                    with self._claims_lock:
+                        self._claims.pop(claim.name, None)
+                    logger.warning(f"Lost the claim on {claim.name}, another replica may process it: {str(e)}")
+
+class LocalWorkClaims:
+    """In-process stand-in for BlobWorkClaims, for a single replica and for tests"""
+    
+    def __init__(self):
+        self._names = set()
+        self._records = {}
+        self._lock = threading.Lock()
+    
+    def ensure_container(self):
+        pass
+    
+    def claim(self, name, etag=None):
+        with self._lock:
+            record = self._records.get(name, AttemptRecord())
+            if etag and record.etag and record.etag != etag:
+                record = AttemptRecord()
+            if name in self._names or record.retry_at > time.time():
+                return None
+            self._names.add(name)
+            return WorkClaim(name, self, record=record)
+    
+    def release(self, claim, done=False, failure=None):
+        with self._lock:
+            self._names.discard(claim.name)
+            if failure:
+                self._records[claim.name] = failure
+            elif done:
+                self._records.pop(claim.name, None)
+
+def create_work_claims():
+    """Build the work claim backend selected by WORK_CLAIMS"""
+    if WORK_CLAIMS == 'local':
+        return LocalWorkClaims()
+    return BlobWorkClaims()
+
+work_claims = create_work_claims()
+
+def record_stage(entry, stage, **results):
+    """Record a completed stage in the ledger; a ledger failure never fails the document"""
+    if entry is None or processing_ledger is None:
+        return
+    try:
+        processing_ledger.record(entry, stage, **results)
+    except Exception as e:
+        logger.warning(f"Could not record stage '{stage}' for {entry['file_name']} in the ledger: {str(e)}")
+
+def fetch_knowledge_bases() -> list[dict]:
+    """Get list of knowledge bases from OpenWebUI; raises if OpenWebUI does not return it"""
     url = f'{OPENWEBUI_URL}/api/v1/knowledge/'
     headers = {
         'Authorization': f'Bearer {OPENWEBUI_API_KEY}',
         'Content-Type': 'application/json'
     }
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        knowledge_list = []
-        for knowledge in response.json():
-            knowledge_list.append({
-                'id': knowledge['id'], 
-                'name': knowledge['name'], 
-                'description': knowledge['description']
-            })
-        return knowledge_list
-    else:
-        logger.error(f"Failed to get knowledge bases. Response status code: {response.status_code}")
+    response = openwebui_http.get(url, headers=headers)
+    if response.status_code != 200:
+        raise DependencyError(f"Failed to get knowledge bases. Response status code: {response.status_code}", response.status_code)
+    
+    knowledge_list = []
+    for knowledge in response.json():
+        knowledge_list.append({
+            'id': knowledge['id'], 
+            'name': knowledge['name'], 
+            'description': knowledge['description']
+        })
+    return knowledge_list
+
+def get_list_knowledge() -> list[dict]:
+    """Get list of knowledge bases from OpenWebUI"""
+    try:
+        return fetch_knowledge_bases()
+    except RuntimeError as e:
+        logger.error(str(e))
         return []
 
 def create_knowledge(name: str = None, description: str = None, data: dict = {}, access_control: dict = {}):
@@ -614,7 +2109,7 @@ def create_knowledge(name: str = None, description: str = None, data: dict = {},
         "access_control": access_control
     }
     
-    response = requests.post(url, headers=headers, json=payload)
+    response = openwebui_http.post(url, headers=headers, json=payload)
     if response.status_code == 200:
         logger.info(f"Successfully created knowledge base: {name}")
         return response.json()
@@ -624,31 +2119,7 @@ def create_knowledge(name: str = None, description: str = None, data: dict = {},
 
 def get_or_create_knowledge_base():
     """Get existing knowledge base or create a new one"""
-    knowledge_bases = get_list_knowledge()
-    
-    # Look for existing knowledge base with our name
-    for kb in knowledge_bases:
-        if kb['name'] == KNOWLEDGE_BASE_NAME:
-            logger.info(f"Found existing knowledge base: {kb['name']} (ID: {kb['id']})")
-            return kb['id']
-    
-    # Create new knowledge base if none exists
-    logger.info(f"No existing knowledge base found. Creating new one: {KNOWLEDGE_BASE_NAME}")
-    result = create_knowledge()
-    if result and 'id' in result:
-        logger.info(f"Successfully created default knowledge base: {KNOWLEDGE_BASE_NAME} (ID: {result['id']})")
-        
-        # Automatically create a model and attach this default knowledge base
-        model_result = create_model_with_knowledge_base(result['id'], KNOWLEDGE_BASE_NAME)
-        if model_result:
-            logger.info(f"Successfully created model for default knowledge base: {KNOWLEDGE_BASE_NAME}")
-        else:
-            logger.warning(f"Failed to create model for default knowledge base: {KNOWLEDGE_BASE_NAME}")
-        
-        return result['id']
-    else:
-        logger.error("Failed to create knowledge base")
-        return None
+    return knowledge_base_directory.get_or_create(KNOWLEDGE_BASE_NAME, KNOWLEDGE_BASE_DESCRIPTION)
 
 def list_models():
     """List all models in OpenWebUI"""
@@ -663,7 +2134,7 @@ def list_models():
             'Accept': 'application/json'
         }
         
-        response = requests.get(url, headers=headers)
+        response = openwebui_http.get(url, headers=headers)
         if response.status_code == 200:
             models = response.json()
             logger.info(f"Found {len(models)} existing models")
@@ -722,7 +2193,7 @@ def create_model_with_knowledge_base(knowledge_base_id: str, knowledge_base_name
             "access_control": None
         }
         
-        response = requests.post(url, headers=headers, json=payload)
+        response = openwebui_http.post(url, headers=headers, json=payload)
         if response.status_code == 200:
             result = response.json()
             logger.info(f"Successfully created model '{model_name}' with knowledge base '{knowledge_base_name}'")
@@ -735,6 +2206,102 @@ def create_model_with_knowledge_base(knowledge_base_id: str, knowledge_base_name
         logger.error(f"Error creating model with knowledge base: {str(e)}")
         return None
 
+class KnowledgeBaseDirectory:
+    """Cached knowledge base name -> ID map
+
+    The map is loaded from OpenWebUI on first use and replaced by a fresh listing every
+    `ttl` seconds, which picks up knowledge bases created or deleted elsewhere. If a
+    listing fails the cached map stays in use. Creation is single-flight per name: a
+    miss is confirmed against a fresh listing under a per-name lock, so concurrent
+    workers never create the same knowledge base (or its kb-agent model) twice.
+    """
+    
+    def __init__(self, lister=fetch_knowledge_bases, creator=create_knowledge,
+                 on_created=create_model_with_knowledge_base, ttl=KB_CACHE_TTL):
+        self.lister = lister
+        self.creator = creator
+        self.on_created = on_created
+        self.ttl = ttl
+        self.listings = 0
+        self._ids = {}
+        self._loaded_at = None
+        self._refresh_lock = threading.Lock()
+        self._name_locks = {}
+        self._name_locks_lock = threading.Lock()
+    
+    def _stale(self):
+        return self._loaded_at is None or time.time() - self._loaded_at >= self.ttl
+    
+    def reconcile(self, force=False):
+        """Reload the map from OpenWebUI if it is stale (or `force`); returns False if the listing failed"""
+        with self._refresh_lock:
+            if not force and not self._stale():
+                return True
+            try:
+                knowledge_bases = self.lister()
+            except Exception as e:
+                logger.warning(f"Could not list knowledge bases, keeping {len(self._ids)} cached: {str(e)}")
+                return False
+            
+            ids = {}
+            for kb in knowledge_bases:
+                ids.setdefault(kb['name'], kb['id'])
+            self._ids = ids
+            self._loaded_at = time.time()
+            self.listings += 1
+            logger.debug(f"Knowledge base directory reconciled: {len(ids)} knowledge bases")
+            return True
+    
+    def lookup(self, name):
+        """Cached ID for a knowledge base name, or None"""
+        self.reconcile()
+        return self._ids.get(name)
+    
+    def _name_lock(self, name):
+        with self._name_locks_lock:
+            return self._name_locks.setdefault(name, threading.Lock())
+    
+    def get_or_create(self, name, description=None):
+        """ID of the knowledge base called `name`, creating it (and its model) if it does not exist"""
+        kb_id = self.lookup(name)
+        if kb_id:
+            return kb_id
+        
+        with self._name_lock(name):
+            # Another worker may have created it while we waited for the lock
+            kb_id = self._ids.get(name)
+            if kb_id:
+                return kb_id
+            
+            # Only create once a fresh listing confirms it is missing
+            if not self.reconcile(force=True):
+                logger.error(f"Cannot confirm whether knowledge base exists, not creating: {name}")
+                return None
+            kb_id = self._ids.get(name)
+            if kb_id:
+                return kb_id
+            
+            logger.info(f"No existing knowledge base found. Creating new one: {name}")
+            result = self.creator(name=name, description=description)
+            if not result or 'id' not in result:
+                logger.error(f"Failed to create knowledge base: {name}")
+                return None
+            
+            with self._refresh_lock:
+                self._ids[name] = result['id']
+            logger.info(f"Successfully created knowledge base: {name} (ID: {result['id']})")
+            
+            # Automatically create a model and attach this knowledge base
+            model_result = self.on_created(result['id'], name)
+            if model_result:
+                logger.info(f"Successfully created model for knowledge base: {name}")
+            else:
+                logger.warning(f"Failed to create model for knowledge base: {name}")
+            
+            return result['id']
+
+knowledge_base_directory = KnowledgeBaseDirectory()
+
 def get_virtual_path_from_blob_name(blob_name):
     """Extract virtual path from blob name"""
     if '/' not in blob_name:
@@ -748,8 +2315,9 @@ def get_virtual_path_from_blob_name(blob_name):
     # Return the directory path (everything except the filename)
     return '/'.join(path_parts[:-1])
 
-def upload_file_to_openwebui(file_path: str, file_name: str):
-    """Upload a file to OpenWebUI"""
+@stage_seconds.timed(stage='openwebui_upload')
+def upload_file_to_openwebui(content, file_name: str):
+    """Upload a file to OpenWebUI from a file path, bytes or an open binary file"""
     url = f'{OPENWEBUI_URL}/api/v1/files/'
     headers = {
         'Authorization': f'Bearer {OPENWEBUI_API_KEY}',
@@ -757,9 +2325,13 @@ def upload_file_to_openwebui(file_path: str, file_name: str):
     }
     
     try:
-        with open(file_path, 'rb') as file:
+        file = open(content, 'rb') if isinstance(content, str) else content
+        try:
             files = {'file': (file_name, file, 'application/octet-stream')}
-            response = requests.post(url, headers=headers, files=files)
+            response = openwebui_http.post(url, headers=headers, files=files, timeout=(HTTP_CONNECT_TIMEOUT, OPENWEBUI_UPLOAD_TIMEOUT))
+        finally:
+            if file is not content:
+                file.close()
             
         if response.status_code == 200:
             result = response.json()
@@ -767,13 +2339,46 @@ def upload_file_to_openwebui(file_path: str, file_name: str):
             return result.get('id')
         else:
             logger.error(f"Failed to upload file to OpenWebUI. Status code: {response.status_code}")
+            failure_reasons.mark_status(response.status_code)
             return None
     except Exception as e:
         logger.error(f"Error uploading file to OpenWebUI: {str(e)}")
+        failure_reasons.mark_error(e)
         return None
 
+@stage_seconds.timed(stage='openwebui_upload')
+async def upload_file_to_openwebui_async(content, file_name: str):
+    """upload_file_to_openwebui() on the I/O engine's async HTTP client
+
+    Raises instead of returning None: it runs on the engine's thread, so the caller
+    logs and classifies the failure for the upload it is processing.
+    """
+    url = f'{OPENWEBUI_URL}/api/v1/files/'
+    headers = {
+        'Authorization': f'Bearer {OPENWEBUI_API_KEY}',
+        'Accept': 'application/json'
+    }
+    
+    file = open(content, 'rb') if isinstance(content, str) else content
+    try:
+        import aiohttp
+        form = aiohttp.FormData()
+        form.add_field('file', file, filename=file_name, content_type='application/octet-stream')
+        response = await openwebui_http_async.post(url, headers=headers, data=form, endpoint="POST /api/v1/files/")
+    finally:
+        if file is not content:
+            file.close()
+    
+    if response.status_code != 200:
+        raise DependencyError(f"Status code: {response.status_code}", response.status_code)
+    result = response.json()
+    logger.info(f"Successfully uploaded file to OpenWebUI: {file_name}")
+    return result.get('id')
+
+@stage_seconds.timed(stage='kb_add')
 def add_file_to_knowledge_base(file_id: str, knowledge_base_id: str):
     """Add a file to a knowledge base"""
+    ensure_claimed("add it to a knowledge base")
     url = f'{OPENWEBUI_URL}/api/v1/knowledge/{knowledge_base_id}/file/add'
     headers = {
         'Authorization': f'Bearer {OPENWEBUI_API_KEY}',
@@ -781,28 +2386,312 @@ def add_file_to_knowledge_base(file_id: str, knowledge_base_id: str):
     }
     payload = {'file_id': file_id}
     
-    response = requests.post(url, headers=headers, json=payload)
+    response = openwebui_http.post(url, headers=headers, json=payload, endpoint="POST /api/v1/knowledge/{id}/file/add")
     if response.status_code == 200:
         logger.info(f"Successfully added file to knowledge base")
         return True
     else:
         logger.error(f"Failed to add file to knowledge base. Status code: {response.status_code}")
+        failure_reasons.mark_status(response.status_code)
         return False
 
-def convert_document_to_markdown(file_path: str, file_name: str) -> str:
-    """Convert document to markdown using Docling with fallback to text processing"""
+class ConverterRegistry:
+    """Long-lived Docling converters keyed by input format and pipeline options
+
+    Building a DocumentConverter and initializing its pipeline loads the layout,
+    table and OCR models, so converters are kept warm and reused across documents.
+    Idle converters are evicted once they exceed the idle TTL or the memory cap.
+    """
+
+    def __init__(self, max_memory_mb=CONVERTER_CACHE_MAX_MB, idle_ttl=CONVERTER_IDLE_TTL):
+        self.max_memory_mb = max_memory_mb
+        self.idle_ttl = idle_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._extension_formats = None
+
+    def get_pipeline_options(self):
+        """Current pipeline options as a hashable key"""
+        return (('do_ocr', DOCLING_DO_OCR), ('do_table_structure', DOCLING_DO_TABLE_STRUCTURE))
+
+    def format_for_file(self, file_name):
+        """Map a file extension to a Docling input format (None = auto-detect)"""
+        file_ext = file_name.lower().split('.')[-1] if '.' in file_name else ''
+        if self._extension_formats is None:
+            from docling.datamodel.base_models import FormatToExtensions
+            self._extension_formats = {
+                ext: input_format
+                for input_format, extensions in FormatToExtensions.items()
+                for ext in extensions
+            }
+        return self._extension_formats.get(file_ext)
+
+    def _build_converter(self, input_format, options):
+        """Create a converter and load its pipeline models"""
+        # Importing Docling loads torch and the rest of the ML stack
+        from docling.document_converter import DocumentConverter, PdfFormatOption, ImageFormatOption
+        from docling.datamodel.base_models import InputFormat
+        from docling.datamodel.pipeline_options import PdfPipelineOptions
+        if input_format is None:
+            return DocumentConverter()
+
+        option_values = dict(options)
+        pipeline_options = PdfPipelineOptions(
+            do_ocr=option_values['do_ocr'],
+            do_table_structure=option_values['do_table_structure']
+        )
+        format_options = {}
+        if input_format == InputFormat.PDF:
+            format_options[input_format] = PdfFormatOption(pipeline_options=pipeline_options)
+        elif input_format == InputFormat.IMAGE:
+            format_options[input_format] = ImageFormatOption(pipeline_options=pipeline_options)
+
+        converter = DocumentConverter(allowed_formats=[input_format], format_options=format_options)
+        converter.initialize_pipeline(input_format)
+        return converter
+
+    def _get_entry(self, input_format):
+        """Get or create the cache entry for an input format"""
+        options = self.get_pipeline_options()
+        key = (input_format.value if input_format else 'auto', options)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = {
+                    'converter': None,
+                    'lock': threading.Lock(),
+                    'load_seconds': 0.0,
+                    'memory_mb': 0.0,
+                    'uses': 0,
+                    'last_used': time.time()
+                }
+                self._entries[key] = entry
+            self._entries.move_to_end(key)
+
+        with entry['lock']:
+            if entry['converter'] is None:
+                rss_before = psutil.Process().memory_info().rss
+                start = time.time()
+                entry['converter'] = self._build_converter(input_format, options)
+                entry['load_seconds'] = time.time() - start
+                entry['memory_mb'] = max(0.0, (psutil.Process().memory_info().rss - rss_before) / 1024 / 1024)
+                logger.info(f"Loaded Docling converter for {key[0]} in {entry['load_seconds']:.2f}s (~{entry['memory_mb']:.0f} MB)")
+        return key, entry
+
+    def warm_up(self, formats):
+        """Load converters for the given file extensions ahead of the first document"""
+        for file_ext in formats:
+            try:
+                self._get_entry(self.format_for_file(f"warmup.{file_ext}"))
+            except Exception as e:
+                logger.warning(f"Failed to warm up Docling converter for {file_ext}: {str(e)}")
+        self.evict_idle()
+
+    def convert(self, source, file_name):
+        """Convert a file path or DocumentStream with the cached converter for its format"""
+        key, entry = self._get_entry(self.format_for_file(file_name))
+
+        # A converter is used by one document at a time
+        with entry['lock']:
+            entry['uses'] += 1
+            try:
+                return entry['converter'].convert(source)
+            finally:
+                entry['last_used'] = time.time()
+                self.evict_idle(keep=key)
+
+    def evict_idle(self, keep=None):
+        """Drop converters idle past the TTL, then least recently used ones over the memory cap"""
+        now = time.time()
+        evicted = []
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if key != keep and now - entry['last_used'] > self.idle_ttl and not entry['lock'].locked():
+                    evicted.append(key)
+                    del self._entries[key]
+
+            total_mb = sum(entry['memory_mb'] for entry in self._entries.values())
+            for key, entry in list(self._entries.items()):
+                if total_mb <= self.max_memory_mb:
+                    break
+                if key != keep and not entry['lock'].locked():
+                    total_mb -= entry['memory_mb']
+                    evicted.append(key)
+                    del self._entries[key]
+
+        if evicted:
+            logger.info(f"Evicted idle Docling converters: {', '.join(key[0] for key in evicted)}")
+            optimize_memory()
+
+    def stats(self):
+        """Load time and reuse statistics for each cached converter"""
+        now = time.time()
+        with self._lock:
+            return {
+                key[0]: {
+                    'loaded': entry['converter'] is not None,
+                    'load_seconds': round(entry['load_seconds'], 3),
+                    'memory_mb': round(entry['memory_mb'], 1),
+                    'uses': entry['uses'],
+                    'reuse_count': max(0, entry['uses'] - 1),
+                    'idle_seconds': round(now - entry['last_used'], 1)
+                }
+                for key, entry in self._entries.items()
+            }
+
+# Converter registry for this process (each conversion process has its own warm registry)
+converter_registry = ConverterRegistry()
+
+def warm_up_converters():
+    """Load the configured Docling converters so the first document does not pay model load time"""
+    converter_registry.warm_up(CONVERTER_WARMUP_FORMATS)
+
+def decode_text(content: bytes) -> str:
+    """Decode text content, trying UTF-8 before the common single-byte encodings"""
+    for encoding in ['utf-8', 'cp1252']:
+        try:
+            return content.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return content.decode('latin-1')
+
+def convert_text_document(document, file_name: str, kind: str):
+    """Markdown for a text document without Docling: `kind` is 'text', or 'json'/'xml' for a fenced block
+
+    A document above PII_STREAMING_THRESHOLD bytes is decoded chunk by chunk straight into
+    a temporary file and returned as SpilledMarkdown, so neither its text nor the markdown
+    around it is held in memory.
+    """
+    if kind == 'text':
+        header, footer = f"# {file_name}\n\n", ""
+    else:
+        header, footer = f"# {file_name}\n\n## Content\n\n```{kind}\n", f"\n```\n\n*Converted from {kind.upper()} format*"
+    if document_size(document) <= PII_STREAMING_THRESHOLD:
+        return f"{header}{decode_text(read_document_bytes(document))}{footer}"
+    
+    # Same encodings as decode_text(); latin-1 decodes any bytes
+    for encoding in ['utf-8', 'cp1252', 'latin-1']:
+        try:
+            return spill_decoded(document, encoding, header, footer)
+        except UnicodeDecodeError:
+            continue
+
+class FormatRouter:
+    """Sends documents that need no layout analysis around Docling
+
+    Plain text, markdown, JSON and XML are converted directly on a zero-ML path. The
+    extension decides, unless the first bytes show a binary format (a PDF saved as
+    .txt goes to Docling), or the extension is unknown and the blob's content type,
+    or the content itself, shows text. Everything else goes to Docling. Conversion
+    times are tracked so the time saved by the fast path can be reported.
+    """
+    
+    EXTENSION_ROUTES = {'txt': 'text', 'md': 'text', 'markdown': 'text', 'json': 'json', 'xml': 'xml'}
+    # Extensions Docling converts (its FormatToExtensions), kept here so routing never imports Docling
+    DOCLING_EXTENSIONS = frozenset({
+        'pdf', 'docx', 'dotx', 'docm', 'dotm', 'pptx', 'potx', 'ppsx', 'pptm', 'potm', 'ppsm', 'xlsx', 'xlsm',
+        'html', 'htm', 'xhtml', 'csv', 'adoc', 'asciidoc', 'asc', 'nxml',
+        'jpg', 'jpeg', 'png', 'tif', 'tiff', 'bmp', 'webp', 'vtt', 'wav', 'mp3'
+    })
+    CONTENT_TYPE_ROUTES = {
+        'text/plain': 'text', 'text/markdown': 'text', 'text/x-markdown': 'text',
+        'application/json': 'json', 'application/xml': 'xml', 'text/xml': 'xml'
+    }
+    # PDF, ZIP (docx/xlsx/pptx), OLE (doc/xls/ppt), PNG, JPEG, GIF and TIFF signatures
+    BINARY_SIGNATURES = (b'%PDF', b'PK\x03\x04', b'\xd0\xcf\x11\xe0', b'\x89PNG', b'\xff\xd8\xff', b'GIF8', b'II*\x00', b'MM\x00*')
+    SNIFF_BYTES = 8192
+    EWMA_WEIGHT = 0.2
+    
+    def __init__(self):
+        self.routes = {}
+        self.fast_seconds = 0.0
+        self.saved_seconds = 0.0
+        self.docling_seconds = None  # moving average of a Docling conversion
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _head(document, size):
+        path = document if isinstance(document, str) else document.path
+        if path:
+            with open(path, 'rb') as f:
+                return f.read(size)
+        return document.data[:size]
+    
+    @classmethod
+    def may_need_docling(cls, file_name):
+        """Whether an upload may need Docling, judged by its name alone (only fast-path extensions are sure not to)"""
+        file_ext = file_name.lower().split('.')[-1] if '.' in file_name else ''
+        return file_ext not in cls.EXTENSION_ROUTES
+    
+    def route(self, document, file_name):
+        """'text', 'json' or 'xml' for the fast path, or 'docling'"""
+        head = self._head(document, self.SNIFF_BYTES)
+        if head.startswith(self.BINARY_SIGNATURES) or b'\x00' in head:
+            return 'docling'
+        
+        file_ext = file_name.lower().split('.')[-1] if '.' in file_name else ''
+        if file_ext in self.EXTENSION_ROUTES:
+            return self.EXTENSION_ROUTES[file_ext]
+        if file_ext in self.DOCLING_EXTENSIONS:
+            return 'docling'
+        
+        content_type = None if isinstance(document, str) else document.content_type
+        content_type = (content_type or '').split(';')[0].strip().lower()
+        if content_type in self.CONTENT_TYPE_ROUTES:
+            return self.CONTENT_TYPE_ROUTES[content_type]
+        try:
+            # An unknown extension with UTF-8 content (a cut-off character at the end is fine)
+            head.decode('utf-8', errors='strict' if len(head) < self.SNIFF_BYTES else 'ignore')
+            return 'text' if head else 'docling'
+        except UnicodeDecodeError:
+            return 'docling'
+    
+    def record_docling(self, elapsed):
+        """Fold a Docling conversion time into the moving average"""
+        with self._lock:
+            self.routes['docling'] = self.routes.get('docling', 0) + 1
+            if self.docling_seconds is None:
+                self.docling_seconds = elapsed
+            else:
+                self.docling_seconds += self.EWMA_WEIGHT * (elapsed - self.docling_seconds)
+    
+    def record_fast(self, file_name, route, elapsed):
+        """Count a fast-path conversion and the Docling time it saved"""
+        with self._lock:
+            self.routes[route] = self.routes.get(route, 0) + 1
+            self.fast_seconds += elapsed
+            saved = max(0.0, self.docling_seconds - elapsed) if self.docling_seconds is not None else None
+            if saved is not None:
+                self.saved_seconds += saved
+        saved_note = f", ~{saved:.2f}s faster than Docling" if saved is not None else ""
+        logger.info(f"Converted {file_name} on the {route} fast path in {elapsed * 1000:.1f} ms{saved_note}")
+    
+    def stats(self):
+        """Routing counts and conversion time per path"""
+        with self._lock:
+            return {
+                'routes': dict(self.routes),
+                'fast_path_seconds': round(self.fast_seconds, 3),
+                'docling_avg_seconds': round(self.docling_seconds, 3) if self.docling_seconds is not None else None,
+                'estimated_saved_seconds': round(self.saved_seconds, 1)
+            }
+
+format_router = FormatRouter()
+metrics.collect('format_routes_total', 'Documents by conversion route (text, json, xml, docling)',
+                lambda: [({'route': route}, count) for route, count in format_router.stats()['routes'].items()], kind='counter')
+
+def convert_document_to_markdown(document, file_name: str) -> str:
+    """Convert a document (file path or DocumentInput) to markdown using Docling with fallback to text processing"""
     try:
         logger.info(f"Converting document to markdown: {file_name}")
         
         # Get file extension for better format handling
         file_ext = file_name.lower().split('.')[-1] if '.' in file_name else ''
         
-        # Initialize Docling converter
-        converter = DocumentConverter()
-        
-        # Try to convert with automatic format detection
+        # Try to convert with the warm converter for this format
         try:
-            result = converter.convert(file_path)
+            result = converter_registry.convert(document_source(document), file_name)
             markdown_content = result.document.export_to_markdown()
             logger.info(f"Successfully converted {file_name} to markdown using Docling ({len(markdown_content)} characters)")
             return markdown_content
@@ -814,12 +2703,8 @@ def convert_document_to_markdown(file_path: str, file_name: str) -> str:
             if file_ext in ['txt', 'md', 'markdown']:
                 # Plain text files - read and convert to markdown
                 try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    
-                    # Convert to simple markdown
-                    markdown_content = f"# {file_name}\n\n{content}"
-                    logger.info(f"Converted {file_name} as plain text to markdown ({len(markdown_content)} characters)")
+                    markdown_content = convert_text_document(document, file_name, 'text')
+                    logger.info(f"Converted {file_name} as plain text to markdown ({markdown_length(markdown_content)} characters)")
                     return markdown_content
                     
                 except Exception as text_error:
@@ -829,12 +2714,9 @@ def convert_document_to_markdown(file_path: str, file_name: str) -> str:
             elif file_ext in ['json', 'xml']:
                 # Structured files - try to extract text content
                 try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    
                     # For structured files, create a more organized markdown
-                    markdown_content = f"# {file_name}\n\n## Content\n\n```{file_ext}\n{content}\n```\n\n*Converted from {file_ext.upper()} format*"
-                    logger.info(f"Converted {file_name} from {file_ext} to markdown ({len(markdown_content)} characters)")
+                    markdown_content = convert_text_document(document, file_name, file_ext)
+                    logger.info(f"Converted {file_name} from {file_ext} to markdown ({markdown_length(markdown_content)} characters)")
                     return markdown_content
                     
                 except Exception as struct_error:
@@ -844,8 +2726,7 @@ def convert_document_to_markdown(file_path: str, file_name: str) -> str:
             else:
                 # Unknown format - try to read as text anyway
                 try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
+                    content = read_document_bytes(document).decode('utf-8')
                     
                     markdown_content = f"# {file_name}\n\n## Raw Content\n\n```\n{content}\n```\n\n*Converted from unknown format*"
                     logger.info(f"Converted {file_name} from unknown format to markdown ({len(markdown_content)} characters)")
@@ -859,115 +2740,769 @@ def convert_document_to_markdown(file_path: str, file_name: str) -> str:
         logger.error(f"Error converting document to markdown: {str(e)}")
         return None
 
-def protect_pii_with_vault(content: str) -> tuple[str, dict]:
-    """Protect PII using Vault KV patterns (Open Source compatible)"""
+class DocumentError(RuntimeError):
+    """docling-serve processed the document but could not convert it"""
+
+class DoclingServeClient:
+    """Conversion backend that sends documents to docling-serve
+
+    A document is submitted to /v1/convert/file/async and its task long-polled until it
+    finishes, so no request stays open for the length of a conversion. At most
+    `max_concurrency` conversions are in flight from this processor; further workers
+    wait for a slot. A circuit breaker stops submissions while docling-serve is failing.
+    The reported version is fetched again after `version_ttl` seconds, so cache keys
+    follow an upgrade of docling-serve without restarting the processor.
+    """
     
-    # Try KV-based protection first (Open Source compatible)
-    if vault_kv_client:
-        try:
-            logger.info("Protecting PII using Vault KV patterns")
-            protected_content = vault_kv_client.protect_pii(content)
-            
-            # Count PII items for summary
-            pii_summary = {
-                "vault_used": True,
-                "protection_method": "vault_kv",
-                "ssn_count": len(re.findall(r'\b\d{3}-\d{2}-\d{4}\b', content)),
-                "email_count": len(re.findall(r'\b[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b', content)),
-                "phone_count": len(re.findall(r'\b\d{3}-\d{3}-\d{4}\b', content)),
-                "bank_count": len(re.findall(r'\b\d{4}-\d{4}-\d{4}-\d{4}\b', content)),
-                "total_pii_items": 0
-            }
-            pii_summary["total_pii_items"] = sum([
-                pii_summary["ssn_count"], 
-                pii_summary["email_count"], 
-                pii_summary["phone_count"], 
-                pii_summary["bank_count"]
-            ])
-            
-            logger.info(f"PII protection completed: {pii_summary['total_pii_items']} items protected using Vault KV")
-            return protected_content, pii_summary
-            
-        except Exception as e:
-            logger.error(f"Error in Vault KV PII protection: {str(e)}")
-            # Fall through to fallback
+    def __init__(self, url, api_key=None, max_concurrency=DOCLING_SERVE_MAX_CONCURRENCY,
+                 poll_wait=DOCLING_SERVE_POLL_WAIT, timeout=DOCLING_SERVE_TIMEOUT, http=None,
+                 version_ttl=DOCLING_SERVE_VERSION_TTL):
+        self.url = url.rstrip('/')
+        self.headers = {'Accept': 'application/json'}
+        if api_key:
+            self.headers['X-Api-Key'] = api_key
+        self.poll_wait = poll_wait
+        self.timeout = timeout
+        self.http = http or HttpClient("docling-serve", timeout=(HTTP_CONNECT_TIMEOUT, max(HTTP_READ_TIMEOUT, poll_wait + 30)))
+        self.breaker = CircuitBreaker("docling-serve")
+        self._slots = threading.BoundedSemaphore(max(1, max_concurrency))
+        self.version_ttl = version_ttl
+        self._version = None
+        self._version_at = 0.0
     
-    # Fallback to basic protection
-    logger.warning("Vault KV client not available, using basic PII protection")
-    return _basic_pii_protection(content), {"vault_used": False, "protection_method": "basic"}
-
-def _basic_pii_protection(content: str) -> str:
-    """Basic PII protection using hardcoded patterns"""
-    protected_content = content
+    def version(self):
+        """Versions reported by docling-serve, as one string (part of conversion cache keys)"""
+        if self._version is None or time.time() - self._version_at > self.version_ttl:
+            response = self.http.get(f"{self.url}/version", headers=self.headers, endpoint="version")
+            if response.status_code != 200:
+                raise DependencyError(f"docling-serve version returned {response.status_code}", response.status_code)
+            versions = response.json()
+            self._version = ",".join(f"{name}={versions[name]}" for name in sorted(versions))
+            self._version_at = time.time()
+        return self._version
     
-    # SSN tokenization
-    protected_content = re.sub(r'\b\d{3}-\d{2}-\d{4}\b', 'tok_ssn_xxxxx', protected_content)
+    def _options(self):
+        """Conversion options matching the local converter registry"""
+        options = dict(converter_registry.get_pipeline_options())
+        return {
+            'to_formats': 'md',
+            'do_ocr': str(options['do_ocr']).lower(),
+            'do_table_structure': str(options['do_table_structure']).lower()
+        }
     
-    # Email tokenization
-    protected_content = re.sub(r'\b[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b', 'tok_email_xxxxx', protected_content)
+    def _submit(self, document, file_name):
+        path = document if isinstance(document, str) else document.path
+        file = open(path, 'rb') if path else io.BytesIO(document.data)
+        try:
+            files = {'files': (file_name.split('/')[-1], file, 'application/octet-stream')}
+            response = self.http.post(f"{self.url}/v1/convert/file/async", headers=self.headers, files=files,
+                                      data=self._options(), endpoint="POST /v1/convert/file/async")
+        finally:
+            file.close()
+        if response.status_code != 200:
+            raise DependencyError(f"docling-serve rejected {file_name}: {response.status_code} {response.text[:200]}", response.status_code)
+        return response.json()['task_id']
     
-    # Phone masking
-    protected_content = re.sub(r'\b\d{3}-\d{3}-\d{4}\b', '***-***-****', protected_content)
+    def _wait(self, task_id, file_name):
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            response = self.http.get(f"{self.url}/v1/status/poll/{task_id}", headers=self.headers,
+                                     params={'wait': self.poll_wait}, endpoint="GET /v1/status/poll/{task_id}")
+            if response.status_code != 200:
+                raise DependencyError(f"docling-serve lost the task for {file_name}: {response.status_code}", response.status_code)
+            status = response.json()['task_status']
+            if status == 'success':
+                return
+            if status == 'failure':
+                raise DocumentError(f"docling-serve failed to convert {file_name}")
+        raise TimeoutError(f"docling-serve did not convert {file_name} within {self.timeout:.0f}s")
     
-    # Bank account masking
-    protected_content = re.sub(r'\b\d{4}-\d{4}-\d{4}-\d{4}\b', '****-****-****-****', protected_content)
+    def _result(self, task_id, file_name):
+        response = self.http.get(f"{self.url}/v1/result/{task_id}", headers=self.headers, endpoint="GET /v1/result/{task_id}")
+        if response.status_code != 200:
+            raise DependencyError(f"docling-serve result for {file_name} returned {response.status_code}", response.status_code)
+        result = response.json()
+        markdown_content = (result.get('document') or {}).get('md_content')
+        if result.get('status') not in ('success', 'partial_success') or markdown_content is None:
+            raise DocumentError(f"docling-serve could not convert {file_name}: {result.get('errors')}")
+        return markdown_content
     
-    return protected_content
+    def convert(self, document, file_name):
+        """Markdown for a document (file path or DocumentInput); raises if the conversion fails"""
+        if not self.breaker.allow():
+            raise DependencyError("docling-serve circuit breaker is open")
+        with self._slots:
+            try:
+                start = time.time()
+                task_id = self._submit(document, file_name)
+                self._wait(task_id, file_name)
+                markdown_content = self._result(task_id, file_name)
+            except DocumentError:
+                # docling-serve is working; only this document is bad
+                self.breaker.record_success()
+                raise
+            except Exception:
+                self.breaker.record_failure()
+                raise
+        self.breaker.record_success()
+        logger.info(f"Converted {file_name} with docling-serve in {time.time() - start:.2f}s ({len(markdown_content)} characters)")
+        return markdown_content
 
-def process_document(file_path, file_name):
-    """Process a document using Docling and OpenWebUI knowledge base with Vault PII protection"""
-    try:
-        logger.info(f"Processing document: {file_name}")
-        
-        # Extract just the filename without virtual path for temporary files
-        base_filename = file_name.split('/')[-1] if '/' in file_name else file_name
-        
-        # Convert document to markdown using Docling
-        markdown_content = convert_document_to_markdown(file_path, file_name)
-        if not markdown_content:
-            logger.error(f"Failed to convert document to markdown: {file_name}")
-            return False
-        
-        # Save original markdown to temporary file (use base filename only)
-        original_markdown_path = f"/tmp/original_{base_filename}.md"
-        with open(original_markdown_path, "w", encoding="utf-8") as f:
-            f.write(markdown_content)
-        
-        # Protect PII using Vault Transform Engine
-        protected_content, pii_summary = protect_pii_with_vault(markdown_content)
-        
-        # Save protected markdown to temporary file (use base filename only)
-        protected_markdown_path = f"/tmp/protected_{base_filename}.md"
-        with open(protected_markdown_path, "w", encoding="utf-8") as f:
-            f.write(protected_content)
-        
+docling_serve = DoclingServeClient(DOCLING_SERVE_URL, DOCLING_SERVE_API_KEY) if CONVERSION_BACKEND == 'remote' else None
+
+# Process pool for CPU-heavy conversion, created on first use and shared by all workers
+_conversion_pool = None
+_conversion_pool_lock = threading.Lock()
+
+def get_conversion_pool():
+    """Get the shared conversion process pool, or None when converting in-process"""
+    global _conversion_pool
+    if CONVERSION_PROCESSES <= 0:
+        return None
+
+    with _conversion_pool_lock:
+        if _conversion_pool is None:
+            # Use spawn so child processes never inherit locks held by worker threads
+            _conversion_pool = ProcessPoolExecutor(
+                max_workers=CONVERSION_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=warm_up_converters
+            )
+            logger.info(f"Started conversion process pool with {CONVERSION_PROCESSES} processes")
+        return _conversion_pool
+
+def _reset_conversion_pool():
+    """Drop a broken conversion pool so the next job starts a fresh one"""
+    global _conversion_pool
+    with _conversion_pool_lock:
+        if _conversion_pool is not None:
+            _conversion_pool.shutdown(wait=False, cancel_futures=True)
+            _conversion_pool = None
+            _converter_stats_by_pid.clear()
+
+def shutdown_conversion_pool():
+    """Shut down the conversion process pool"""
+    global _conversion_pool
+    with _conversion_pool_lock:
+        if _conversion_pool is not None:
+            _conversion_pool.shutdown(wait=True)
+            _conversion_pool = None
+
+# Markdown too large to pass between processes, written to disk by the conversion process
+SpilledMarkdown = namedtuple('SpilledMarkdown', ['path', 'length'])
+
+def markdown_length(markdown):
+    """Length in characters of converted markdown (in memory or spilled)"""
+    return markdown.length if isinstance(markdown, SpilledMarkdown) else len(markdown)
+
+def iter_markdown_windows(markdown, window=PII_STREAM_WINDOW):
+    """Yield converted markdown (in memory or spilled) in windows of `window` characters"""
+    if isinstance(markdown, SpilledMarkdown):
+        with open(markdown.path, 'r', encoding='utf-8') as f:
+            while True:
+                chunk = f.read(window)
+                if not chunk:
+                    return
+                yield chunk
+    else:
+        for start in range(0, len(markdown), window):
+            yield markdown[start:start + window]
+
+def spill_markdown(markdown_content):
+    """Write markdown above PII_STREAMING_THRESHOLD to a temporary file, returning SpilledMarkdown"""
+    if isinstance(markdown_content, str) and len(markdown_content) > PII_STREAMING_THRESHOLD:
+        fd, spill_path = tempfile.mkstemp(prefix='file-processor-', suffix='.md')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(markdown_content)
+        return SpilledMarkdown(spill_path, len(markdown_content))
+    return markdown_content
+
+def spill_decoded(document, encoding, header, footer):
+    """Decode a document incrementally into a temporary markdown file between `header` and `footer`"""
+    fd, spill_path = tempfile.mkstemp(prefix='file-processor-', suffix='.md')
+    try:
+        decoder = codecs.getincrementaldecoder(encoding)()
+        length = 0
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(header)
+            for chunk in iter_document_bytes(document):
+                text = decoder.decode(chunk)
+                f.write(text)
+                length += len(text)
+            text = decoder.decode(b'', final=True) + footer
+            f.write(text)
+            length += len(header) + len(text)
+        return SpilledMarkdown(spill_path, length)
+    except BaseException:
+        os.remove(spill_path)
+        raise
+
+# Latest converter registry stats reported by each conversion process
+_converter_stats_by_pid = {}
+
+def _convert_in_worker(document, file_name: str):
+    """Conversion process entry point: returns markdown plus this process's converter stats
+
+    Markdown above PII_STREAMING_THRESHOLD is written to a temporary file instead of
+    being pickled back, so the parent can stream it without holding it in memory.
+    """
+    markdown_content = spill_markdown(convert_document_to_markdown(document, file_name))
+    return markdown_content, os.getpid(), converter_registry.stats()
+
+def _report_converter_stats():
+    """Conversion process entry point: this process's converter stats, after its warm-up"""
+    return os.getpid(), converter_registry.stats()
+
+def get_converter_stats() -> dict:
+    """Converter load time and reuse stats for every process that converts documents"""
+    if CONVERSION_PROCESSES <= 0:
+        return {str(os.getpid()): converter_registry.stats()}
+    return {str(pid): stats for pid, stats in list(_converter_stats_by_pid.items())}
+
+@stage_seconds.timed(stage='convert')
+def run_conversion(document, file_name: str, content_hash=None):
+    """Convert a document, reusing cached markdown for content converted before
+
+    Returns markdown text, or SpilledMarkdown when a large result was written to a
+    temporary file (the caller removes it with release_markdown()). `content_hash`
+    is the document's SHA-256, if the caller already has it.
+    """
+    try:
+        route = format_router.route(document, file_name)
+    except Exception as e:
+        logger.error(f"Error routing {file_name}: {str(e)}")
+        failure_reasons.mark_error(e)
+        return None
+    if route != 'docling':
+        try:
+            start = time.perf_counter()
+            markdown_content = convert_text_document(document, file_name, route)
+            format_router.record_fast(file_name, route, time.perf_counter() - start)
+            return spill_markdown(markdown_content)
+        except Exception as e:
+            logger.error(f"Error converting {file_name} on the fast path: {str(e)}")
+            failure_reasons.mark_document_failure()
+            return None
+    
+    if conversion_cache is None:
+        return _convert_document(document, file_name)
+    
+    try:
+        key = conversion_cache.key(content_hash or document_sha256(document))
+        markdown_content = conversion_cache.get(key)
+    except Exception as e:
+        logger.warning(f"Conversion cache unavailable for {file_name}: {str(e)}")
+        return _convert_document(document, file_name)
+    if markdown_content is not None:
+        logger.info(f"Conversion cache hit for {file_name}")
+        return markdown_content
+    
+    _conversion_backend.name = None
+    markdown_content = _convert_document(document, file_name)
+    if markdown_content:
+        # Stored under the backend that converted it: a local fallback is not docling-serve's output
+        backend = getattr(_conversion_backend, 'name', None)
+        try:
+            if backend is not None:
+                key = conversion_cache.key(content_hash or document_sha256(document), backend)
+            conversion_cache.put(key, markdown_content)
+        except Exception as e:
+            logger.warning(f"Could not cache the conversion of {file_name}: {str(e)}")
+    return markdown_content
+
+def _convert_document(document, file_name: str):
+    """Convert a document with Docling, timing it for the format router"""
+    start = time.perf_counter()
+    markdown_content = _convert_with_docling(document, file_name)
+    if markdown_content:
+        format_router.record_docling(time.perf_counter() - start)
+    return markdown_content
+
+# The backend ('docling-serve' or 'local') of each thread's last Docling conversion, for cache keys
+_conversion_backend = threading.local()
+
+def _convert_with_docling(document, file_name: str):
+    """Convert a document with docling-serve, or in the conversion process pool (in-process if disabled)"""
+    if docling_serve is not None:
+        try:
+            markdown_content = docling_serve.convert(document, file_name)
+            _conversion_backend.name = 'docling-serve'
+            return markdown_content
+        except Exception as e:
+            if not DOCLING_SERVE_FALLBACK:
+                logger.error(f"Error converting {file_name} with docling-serve: {str(e)}")
+                failure_reasons.mark_error(e)
+                return None
+            logger.warning(f"docling-serve conversion failed, converting {file_name} locally: {str(e)}")
+    
+    _conversion_backend.name = 'local'
+    pool = get_conversion_pool()
+    if pool is None:
+        markdown_content = convert_document_to_markdown(document, file_name)
+    else:
+        try:
+            markdown_content, pid, stats = pool.submit(_convert_in_worker, document, file_name).result()
+            _converter_stats_by_pid[pid] = stats
+        except BrokenProcessPool as e:
+            # A conversion process died (e.g. OOM kill) - restart the pool for the next job.
+            # A document that keeps killing its process is exactly what MAX_ATTEMPTS is for
+            logger.error(f"Conversion process pool broken while converting {file_name}: {str(e)}")
+            _reset_conversion_pool()
+            failure_reasons.mark_document_failure()
+            return None
+        except Exception as e:
+            logger.error(f"Error running conversion for {file_name}: {str(e)}")
+            failure_reasons.mark_error(e)
+            return None
+    
+    # convert_document_to_markdown() returns None when neither Docling nor a text read works
+    if markdown_content is None:
+        failure_reasons.mark_document_failure()
+    return markdown_content
+
+def release_markdown(markdown):
+    """Remove the temporary file behind spilled markdown"""
+    if isinstance(markdown, SpilledMarkdown):
+        try:
+            os.remove(markdown.path)
+        except OSError:
+            pass
+
+def docling_version():
+    """Installed Docling version, part of every conversion cache key"""
+    try:
+        return package_version('docling')
+    except PackageNotFoundError:
+        return 'unknown'
+
+class ConversionCache:
+    """Content-addressed cache of converted markdown in a local directory
+
+    Entries are keyed by the document's SHA-256, the Docling version and the pipeline
+    options, so upgrading Docling or changing OCR/table settings never serves stale
+    markdown. The directory is capped at `max_bytes`; the least recently used entries
+    are evicted first, and entries unused for `max_age` seconds are removed. Recency
+    survives restarts through file modification times.
+    
+    Entries are the markdown before PII protection, so the directory is created
+    readable by this user only and should not outlive the processor's own storage.
+    """
+    
+    def __init__(self, directory=CONVERSION_CACHE_DIR, max_bytes=CONVERSION_CACHE_MAX_MB * 1024 * 1024,
+                 max_age=CONVERSION_CACHE_MAX_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.version = docling_version()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (size, last used), least recently used first
+        self._size = 0
+        self._lock = threading.Lock()
+        self._load()
+    
+    def _load(self):
+        """Index the entries already on disk, oldest first, removing expired ones"""
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.md'):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name[:-3], stat.st_size))
+            elif name.endswith('.tmp') and time.time() - os.stat(path).st_mtime > 3600:
+                os.remove(path)  # Left behind by an interrupted put()
+        for used_at, key, size in sorted(entries):
+            self._entries[key] = (size, used_at)
+            self._size += size
+        self._remove(self._expire())
+    
+    def _expire(self):
+        """Drop entries unused for max_age seconds from the index (lock held); returns their keys"""
+        expired = []
+        cutoff = time.time() - self.max_age
+        while self._entries:
+            key, (size, used_at) = next(iter(self._entries.items()))
+            if used_at >= cutoff:
+                break
+            del self._entries[key]
+            self._size -= size
+            self.evictions += 1
+            expired.append(key)
+        return expired
+    
+    def _remove(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+    
+    def key(self, content_hash, backend=None):
+        """Cache key for a document's content under a backend's Docling version and the options
+
+        `backend` is 'docling-serve' or 'local'; by default the configured one, which is
+        where a conversion is looked up first.
+        """
+        options = converter_registry.get_pipeline_options()
+        if backend is None:
+            backend = 'docling-serve' if docling_serve else 'local'
+        version = f"docling-serve {docling_serve.version()}" if backend == 'docling-serve' else self.version
+        return hashlib.sha256(f"{content_hash}:{version}:{options!r}".encode('utf-8')).hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.md")
+    
+    def get(self, key):
+        """Cached markdown for a key, or None
+
+        Markdown above PII_STREAMING_THRESHOLD is copied to a temporary file and returned
+        as SpilledMarkdown, like a fresh conversion, so the caller can release it.
+        """
+        with self._lock:
+            expired = self._expire()
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                size = entry[0]
+                self._entries[key] = (size, time.time())
+                self._entries.move_to_end(key)
+                self.hits += 1
+        self._remove(expired)
+        if entry is None:
+            return None
+        
+        path = self._path(key)
+        try:
+            os.utime(path)
+            if size <= PII_STREAMING_THRESHOLD:
+                with open(path, 'r', encoding='utf-8') as f:
+                    return f.read()
+            fd, spill_path = tempfile.mkstemp(prefix='file-processor-', suffix='.md')
+            length = 0
+            with open(path, 'r', encoding='utf-8') as source, os.fdopen(fd, 'w', encoding='utf-8') as target:
+                for chunk in iter(lambda: source.read(PII_STREAM_WINDOW), ''):
+                    target.write(chunk)
+                    length += len(chunk)
+            return SpilledMarkdown(spill_path, length)
+        except OSError as e:
+            # Removed from disk behind our back: treat as a miss
+            logger.warning(f"Conversion cache entry {key} unreadable: {str(e)}")
+            with self._lock:
+                if self._entries.pop(key, None) is not None:
+                    self._size -= size
+                self.hits -= 1
+                self.misses += 1
+            return None
+    
+    def put(self, key, markdown):
+        """Store converted markdown (text or SpilledMarkdown), evicting old entries over the cap"""
+        path = self._path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as target:
+                if isinstance(markdown, SpilledMarkdown):
+                    with open(markdown.path, 'r', encoding='utf-8') as source:
+                        for chunk in iter(lambda: source.read(PII_STREAM_WINDOW), ''):
+                            target.write(chunk)
+                else:
+                    target.write(markdown)
+            size = os.path.getsize(temp_path)
+            if size > self.max_bytes:
+                os.remove(temp_path)
+                return
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not store conversion cache entry {key}: {str(e)}")
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+        
+        with self._lock:
+            self._size += size - self._entries.pop(key, (0, None))[0]
+            self._entries[key] = (size, time.time())
+            evicted = self._expire()
+            while self._size > self.max_bytes:
+                old_key, (old_size, _) = self._entries.popitem(last=False)
+                self._size -= old_size
+                self.evictions += 1
+                evicted.append(old_key)
+        self._remove(evicted)
+    
+    def stats(self):
+        """Hit/miss counts and size of the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'size_mb': round(self._size / 1024 / 1024, 1)
+            }
+
+def create_conversion_cache():
+    """Conversion cache for this process, or None if disabled or its directory is unusable"""
+    if not CONVERSION_CACHE_ENABLED:
+        return None
+    try:
+        return ConversionCache()
+    except OSError as e:
+        logger.warning(f"Conversion cache disabled, cannot use {CONVERSION_CACHE_DIR}: {str(e)}")
+        return None
+
+conversion_cache = create_conversion_cache()
+
+def _conversion_cache_stat(name):
+    return lambda: conversion_cache.stats()[name] if conversion_cache else None
+
+metrics.collect('conversion_cache_hits_total', 'Conversions served from the conversion cache', _conversion_cache_stat('hits'), kind='counter')
+metrics.collect('conversion_cache_misses_total', 'Conversion cache lookups that had to convert', _conversion_cache_stat('misses'), kind='counter')
+metrics.collect('conversion_cache_hit_ratio', 'Share of conversion cache lookups that were hits', _conversion_cache_stat('hit_rate'))
+metrics.collect('conversion_cache_bytes', 'Size of the conversion cache on disk',
+                lambda: conversion_cache.stats()['size_mb'] * 1024 * 1024 if conversion_cache else None)
+
+def _pii_summary(counts, vault_used, protection_method):
+    """PII protection summary stored in document metadata"""
+    pii_summary = {
+        "vault_used": vault_used,
+        "protection_method": protection_method,
+        "ssn_count": counts.get('ssn', 0),
+        "email_count": counts.get('email', 0),
+        "phone_count": counts.get('phone', 0),
+        "bank_count": counts.get('bank', 0),
+        "total_pii_items": 0
+    }
+    pii_summary["total_pii_items"] = sum([
+        pii_summary["ssn_count"], 
+        pii_summary["email_count"], 
+        pii_summary["phone_count"], 
+        pii_summary["bank_count"]
+    ])
+    return pii_summary
+
+@stage_seconds.timed(stage='pii_scan')
+def protect_pii_with_vault(content: str) -> tuple[str, dict]:
+    """Protect PII using Vault KV patterns (Open Source compatible)"""
+    
+    # Try KV-based protection first (Open Source compatible)
+    vault_kv_client = get_vault_kv_client()
+    if vault_kv_client:
+        try:
+            logger.info("Protecting PII using Vault KV patterns")
+            # One pass both protects the content and counts PII items for the summary
+            protected_content, counts = vault_kv_client.protect_pii_with_counts(content)
+            pii_summary = _pii_summary(counts, True, "vault_kv")
+            
+            logger.info(f"PII protection completed: {pii_summary['total_pii_items']} items protected using Vault KV")
+            return protected_content, pii_summary
+            
+        except Exception as e:
+            logger.error(f"Error in Vault KV PII protection: {str(e)}")
+            # Fall through to fallback
+    
+    # Fallback to basic protection
+    logger.warning("Vault KV client not available, using basic PII protection")
+    protected_content, counts = basic_pii_scanner.redact(content)
+    return protected_content, _pii_summary(counts, False, "basic")
+
+@stage_seconds.timed(stage='pii_scan')
+def protect_pii_stream_with_vault(chunks, write) -> dict:
+    """Protect PII in markdown arriving in chunks, writing protected text incrementally; returns the summary"""
+    vault_kv_client = get_vault_kv_client()
+    if vault_kv_client:
+        logger.info("Protecting PII using Vault KV patterns (streaming)")
+        counts = vault_kv_client.protect_pii_stream(chunks, write)
+        pii_summary = _pii_summary(counts, True, "vault_kv")
+        logger.info(f"PII protection completed: {pii_summary['total_pii_items']} items protected using Vault KV")
+        return pii_summary
+    
+    logger.warning("Vault KV client not available, using basic PII protection")
+    return _pii_summary(basic_pii_scanner.redact_stream(chunks, write), False, "basic")
+
+def _basic_pii_protection(content: str) -> str:
+    """Basic PII protection using hardcoded patterns"""
+    return basic_pii_scanner.redact(content)[0]
+
+def document_blob_names(file_name):
+    """Protected markdown and metadata blob names, preserving the virtual path
+
+    test/file.txt -> test/protected_file.txt.md and test/metadata_file.txt.json
+    """
+    virtual_path = get_virtual_path_from_blob_name(file_name)
+    base_filename = file_name.split('/')[-1] if '/' in file_name else file_name
+    if virtual_path:
+        return f"{virtual_path}/protected_{base_filename}.md", f"{virtual_path}/metadata_{base_filename}.json"
+    return f"protected_{base_filename}.md", f"metadata_{base_filename}.json"
+
+def link_upload_etag(etag, entry, file_name):
+    """Record the etag of an upload covered by a ledger entry"""
+    try:
+        processing_ledger.link_etag(etag, entry, file_name)
+    except Exception as e:
+        logger.warning(f"Could not record the etag of {file_name} in the ledger: {str(e)}")
+
+def process_document(document, file_name):
+    """Process a document using Docling and OpenWebUI knowledge base with Vault PII protection
+
+    `document` is a DocumentInput (or a local file path). Converted and protected content
+    stays in memory and is uploaded from buffers; only very large documents touch disk.
+
+    With the processing ledger enabled, content that was already processed is not
+    processed again: a re-upload under the same name is skipped, and one under another
+    name is linked to the existing results. A document whose processing was interrupted
+    resumes after its last completed stage.
+    """
+    if processing_ledger is None:
+        return _process_document(document, file_name)
+    
+    etag = None if isinstance(document, str) else document.etag
+    try:
+        content_hash = document_sha256(document)
+    except Exception as e:
+        logger.error(f"Error reading {file_name}: {str(e)}")
+        return False
+    
+    with processing_ledger.lock(content_hash):
+        try:
+            entry = processing_ledger.get(content_hash)
+        except Exception as e:
+            logger.warning(f"Processing ledger unavailable, processing {file_name} without it: {str(e)}")
+            return _process_document(document, file_name)
+        
+        if ProcessingLedger.is_completed(entry, file_name):
+            logger.info(f"Skipping {file_name}: identical content was already processed")
+            link_upload_etag(etag, entry, file_name)
+            return True
+        if ProcessingLedger.is_completed(entry):
+            return link_duplicate(entry, file_name, etag)
+        
+        # Resume only the same file; unfinished work for other content-identical names starts over
+        if entry is None or entry['file_name'] != file_name:
+            entry = processing_ledger.new_entry(content_hash, file_name)
+        elif entry['stages']:
+            logger.info(f"Resuming {file_name} after stages: {', '.join(entry['stages'])}")
+        
+        processed = _process_document(document, file_name, entry)
+        if processed:
+            link_upload_etag(etag, entry, file_name)
+        return processed
+
+def _process_document(document, file_name, entry=None):
+    """Convert, protect and publish a document, skipping the stages `entry` records as completed"""
+    stages = entry['stages'] if entry else {}
+    spilled_markdown = None
+    protected_upload = None
+    stored_document = None
+    try:
+        logger.info(f"Processing document: {file_name}")
+        
         # Determine knowledge base based on virtual path
         virtual_path = get_virtual_path_from_blob_name(file_name)
-        knowledge_base_id = get_knowledge_base_for_file(file_name)
+        protected_file_name, metadata_file = document_blob_names(file_name)
         
+        if 'stored' in stages:
+            # Converted and protected before an interruption: reuse the stored protected markdown
+            logger.info(f"Reusing protected markdown stored before the interruption: {protected_file_name}")
+            original_length = stages['stored']['original_length']
+            protected_length = stages['stored']['protected_length']
+            pii_summary = stages['stored']['pii_protection']
+            if 'uploaded' not in stages:
+                stored_document = download_document(PROCESSED_CONTAINER, protected_file_name)
+                protected_upload = stored_document.path or stored_document.data
+            in_processed_container = True
+        else:
+            # Convert document to markdown using Docling (in the conversion process pool)
+            markdown_content = run_conversion(document, file_name, content_hash=entry['content_hash'] if entry else None)
+            spilled_markdown = markdown_content
+            if not markdown_content:
+                logger.error(f"Failed to convert document to markdown: {file_name}")
+                return False
+            original_length = markdown_length(markdown_content)
+            
+            in_processed_container = original_length > PII_STREAMING_THRESHOLD
+            if in_processed_container:
+                # Very large document: redact in overlapping windows, streaming protected output
+                # to the processed container (and to a spooled copy for OpenWebUI) as it is produced
+                logger.info(f"Streaming PII protection for large document {file_name} ({original_length} characters)")
+                blob_writer = BlobStreamWriter(PROCESSED_CONTAINER, protected_file_name)
+                protected_upload = tempfile.SpooledTemporaryFile(max_size=DOCUMENT_SPILL_THRESHOLD, prefix='file-processor-')
+                protected_length = 0
+                
+                def write_protected(text):
+                    nonlocal protected_length
+                    blob_writer.write(text)
+                    protected_upload.write(text.encode('utf-8'))
+                    protected_length += len(text)
+                try:
+                    pii_summary = protect_pii_stream_with_vault(iter_markdown_windows(markdown_content), write_protected)
+                except Exception:
+                    blob_writer.abort()
+                    raise
+                blob_writer.close()
+                protected_upload.seek(0)
+                markdown_content = None
+            else:
+                # Protect PII using Vault Transform Engine
+                if isinstance(markdown_content, SpilledMarkdown):
+                    with open(markdown_content.path, 'r', encoding='utf-8') as f:
+                        markdown_content = f.read()
+                protected_content, pii_summary = protect_pii_with_vault(markdown_content)
+                protected_length = len(protected_content)
+                protected_upload = protected_content.encode('utf-8')
+                protected_content = None
+                markdown_content = None
+        
+        knowledge_base_id = get_knowledge_base_for_file(file_name)
         if not knowledge_base_id:
             logger.error(f"Failed to get or create knowledge base for {file_name}")
             return False
         
-        # Upload protected version to processed container (secure)
-        # Preserve virtual path structure: test/file.txt -> test/protected_file.txt.md
-        if virtual_path:
-            protected_file_name = f"{virtual_path}/protected_{base_filename}.md"
+        store_error = None
+        if 'uploaded' in stages:
+            file_id = stages['uploaded']['file_id']
+            if 'stored' not in stages and not in_processed_container:
+                # OpenWebUI took the file last time, but storing the protected version failed
+                upload_blob_data(PROCESSED_CONTAINER, protected_file_name, protected_upload)
+        elif in_processed_container:
+            # A streamed document is already stored
+            file_id = io_engine.run(upload_file_to_openwebui_async(protected_upload, protected_file_name))
         else:
-            protected_file_name = f"protected_{base_filename}.md"
-        
-        upload_blob(PROCESSED_CONTAINER, protected_file_name, protected_markdown_path)
+            # Upload protected version to the processed container (secure) and to OpenWebUI
+            # for the knowledge base at the same time. Both run to the end, so a file OpenWebUI
+            # accepted is recorded even if storing failed, and a retry never uploads it twice
+            store_error, file_id = io_engine.gather(
+                upload_blob_data_async(PROCESSED_CONTAINER, protected_file_name, protected_upload),
+                upload_file_to_openwebui_async(protected_upload, protected_file_name),
+                return_exceptions=True
+            )
+            if isinstance(file_id, Exception):
+                logger.error(f"Error uploading file to OpenWebUI: {str(file_id)}")
+                failure_reasons.mark_error(file_id)
+                file_id = None
         
-        # Upload protected version to OpenWebUI for knowledge base
-        file_id = upload_file_to_openwebui(protected_markdown_path, protected_file_name)
+        if 'stored' not in stages and store_error is None:
+            record_stage(entry, 'stored', protected_markdown=protected_file_name, original_length=original_length,
+                         protected_length=protected_length, pii_protection=pii_summary)
+        if file_id and 'uploaded' not in stages:
+            record_stage(entry, 'uploaded', file_id=file_id)
+        if store_error is not None:
+            raise store_error
         if not file_id:
             logger.error(f"Failed to upload protected markdown file to OpenWebUI: {protected_file_name}")
             return False
         
         # Add file to knowledge base
-        if not add_file_to_knowledge_base(file_id, knowledge_base_id):
-            logger.error(f"Failed to add protected markdown file to knowledge base: {protected_file_name}")
-            return False
+        if stages.get('added', {}).get('knowledge_base_id') != knowledge_base_id:
+            if not add_file_to_knowledge_base(file_id, knowledge_base_id):
+                logger.error(f"Failed to add protected markdown file to knowledge base: {protected_file_name}")
+                return False
+            record_stage(entry, 'added', knowledge_base_id=knowledge_base_id)
         
         # Create enhanced metadata with PII protection details and knowledge base info
         metadata = {
@@ -977,30 +3512,16 @@ def process_document(file_path, file_name):
             "knowledge_base_id": knowledge_base_id,
             "virtual_path": virtual_path,
             "knowledge_base_name": "Default" if not virtual_path else virtual_path.split('/')[0].title(),
-            "original_length": len(markdown_content),
-            "protected_length": len(protected_content),
+            "original_length": original_length,
+            "protected_length": protected_length,
             "pii_protection": pii_summary,
             "processed_at": datetime.utcnow().isoformat(),
             "status": "completed_with_pii_protection"
         }
         
-        # Preserve virtual path structure for metadata file: test/file.txt -> test/metadata_file.txt.json
-        if virtual_path:
-            metadata_file = f"{virtual_path}/metadata_{base_filename}.json"
-        else:
-            metadata_file = f"metadata_{base_filename}.json"
-        
-        metadata_path = f"/tmp/metadata_{base_filename}.json"
-        with open(metadata_path, "w") as f:
-            json.dump(metadata, f, indent=2)
-        
         # Store metadata in processed container
-        upload_blob(PROCESSED_CONTAINER, metadata_file, metadata_path)
-        
-        # Clean up temporary files
-        for temp_file in [original_markdown_path, protected_markdown_path, metadata_path]:
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
+        upload_blob_data(PROCESSED_CONTAINER, metadata_file, json.dumps(metadata, indent=2).encode('utf-8'))
+        record_stage(entry, 'completed', metadata=metadata_file)
         
         logger.info(f"Successfully processed document with PII protection: {file_name}")
         logger.info(f"PII Summary: {pii_summary['total_pii_items']} items protected using {pii_summary['protection_method']}")
@@ -1009,100 +3530,168 @@ def process_document(file_path, file_name):
         
     except Exception as e:
         logger.error(f"Error processing {file_name}: {str(e)}")
+        failure_reasons.mark_error(e)
         return False
+    finally:
+        # Clean up spilled markdown, the spooled protected copy and any re-downloaded markdown
+        release_markdown(spilled_markdown)
+        if isinstance(protected_upload, tempfile.SpooledTemporaryFile):
+            protected_upload.close()
+        release_document(stored_document)
 
-def process_virtual_document(blob_name, container_name):
-    """Process a virtual document directly from blob storage"""
+def link_duplicate(entry, file_name, etag=None):
+    """Publish an upload whose content was already processed under another name
+
+    The existing OpenWebUI file is reused, and added to this file's knowledge base if it
+    is not already in it. The protected markdown is copied server-side and metadata is
+    written for the new name, so nothing is converted, protected or uploaded again.
+    """
     try:
-        logger.info(f"Processing virtual document: {blob_name}")
-        
-        # Initialize virtual file handler
-        virtual_handler = VirtualFileHandler(blob_service_client)
-        
-        # Get blob client
-        container_client = blob_service_client.get_container_client(container_name)
-        blob_client = container_client.get_blob_client(blob_name)
-        
-        # Get virtual file metadata
-        metadata = virtual_handler.get_virtual_file_metadata(blob_client)
+        logger.info(f"{file_name} has the same content as {entry['file_name']}, linking to its processed version")
+        stages = entry['stages']
+        virtual_path = get_virtual_path_from_blob_name(file_name)
+        protected_file_name, metadata_file = document_blob_names(file_name)
+        file_id = stages['uploaded']['file_id']
         
-        # Get virtual file content
-        content = virtual_handler.get_virtual_file_content(blob_client)
-        if content is None:
-            logger.error(f"Failed to get content from virtual file: {blob_name}")
+        knowledge_base_id = get_knowledge_base_for_file(file_name)
+        if not knowledge_base_id:
+            logger.error(f"Failed to get or create knowledge base for {file_name}")
             return False
         
-        # Convert content to string if it's bytes
-        if isinstance(content, bytes):
-            try:
-                content = content.decode('utf-8')
-            except UnicodeDecodeError:
-                # Try other encodings
-                for encoding in ['latin-1', 'cp1252']:
-                    try:
-                        content = content.decode(encoding)
-                        break
-                    except UnicodeDecodeError:
-                        continue
-                else:
-                    logger.error(f"Failed to decode content from virtual file: {blob_name}")
-                    return False
+        linked_knowledge_bases = entry['linked_knowledge_bases']
+        if knowledge_base_id != stages['added']['knowledge_base_id'] and knowledge_base_id not in linked_knowledge_bases:
+            if not add_file_to_knowledge_base(file_id, knowledge_base_id):
+                logger.error(f"Failed to add existing file {file_id} to knowledge base for {file_name}")
+                return False
+            linked_knowledge_bases.append(knowledge_base_id)
         
-        # Save content to temporary file
-        temp_file_path = f"/tmp/virtual_{os.path.basename(blob_name)}"
-        with open(temp_file_path, "w", encoding="utf-8") as f:
-            f.write(content)
+        if protected_file_name != stages['stored']['protected_markdown']:
+            copy_blob(PROCESSED_CONTAINER, stages['stored']['protected_markdown'], protected_file_name)
         
-        # Process the document (this will handle knowledge base creation based on virtual path)
-        success = process_document(temp_file_path, blob_name)
+        metadata = {
+            "original_file": file_name,
+            "duplicate_of": entry['file_name'],
+            "protected_markdown": protected_file_name,
+            "openwebui_file_id": file_id,
+            "knowledge_base_id": knowledge_base_id,
+            "virtual_path": virtual_path,
+            "knowledge_base_name": "Default" if not virtual_path else virtual_path.split('/')[0].title(),
+            "original_length": stages['stored']['original_length'],
+            "protected_length": stages['stored']['protected_length'],
+            "pii_protection": stages['stored']['pii_protection'],
+            "processed_at": datetime.utcnow().isoformat(),
+            "status": "linked_duplicate"
+        }
+        upload_blob_data(PROCESSED_CONTAINER, metadata_file, json.dumps(metadata, indent=2).encode('utf-8'))
         
-        # Clean up temporary file
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+        entry['duplicates'].append(file_name)
+        processing_ledger.save(entry)
+        link_upload_etag(etag, entry, file_name)
+        logger.info(f"Linked {file_name} to OpenWebUI file {file_id} without reprocessing")
+        return True
         
-        return success
+    except Exception as e:
+        logger.error(f"Error linking duplicate {file_name}: {str(e)}")
+        failure_reasons.mark_error(e)
+        return False
+
+def process_virtual_document(blob_name, container_name):
+    """Process a virtual document directly from blob storage"""
+    try:
+        logger.info(f"Processing virtual document: {blob_name}")
+        
+        # Download the raw bytes; binary formats such as PDF must not be decoded as text
+        document = download_document(container_name, blob_name)
+        try:
+            # Process the document (this will handle knowledge base creation based on virtual path)
+            return process_document(document, blob_name)
+        finally:
+            release_document(document)
         
     except Exception as e:
         logger.error(f"Error processing virtual document {blob_name}: {str(e)}")
+        failure_reasons.mark_error(e)
         return False
 
+class DocumentComparison:
+    """Protected markdown and metadata of a processed upload, for the comparison endpoint
+
+    Construction only reads the two blobs' properties. `etag` changes whenever either
+    blob changes, so responses can be validated and cached without downloading them.
+    The protected markdown is streamed as text by iter_protected().
+    """
+    
+    def __init__(self, file_name):
+        protected_name, metadata_name = document_blob_names(file_name)
+        container_client = get_blob_service_client().get_container_client(PROCESSED_CONTAINER)
+        self.protected_blob = container_client.get_blob_client(protected_name)
+        self.metadata_blob = container_client.get_blob_client(metadata_name)
+        self.protected_etag, self.protected_size = self._properties(self.protected_blob)
+        self.metadata_etag, _ = self._properties(self.metadata_blob)
+    
+    @staticmethod
+    def _properties(blob_client):
+        """(etag, size) of a blob, or (None, 0) if it does not exist"""
+        try:
+            properties = blob_client.get_blob_properties()
+            return properties.etag, properties.size
+        except ResourceNotFoundError:
+            return None, 0
+    
+    @property
+    def available(self):
+        """Whether there is protected markdown to compare (an empty blob counts as none)"""
+        return self.protected_size > 0
+    
+    @property
+    def etag(self):
+        digest = hashlib.sha256(f"{self.protected_etag}|{self.metadata_etag}".encode()).hexdigest()
+        return f'"{digest[:32]}"'
+    
+    def metadata(self) -> dict:
+        """PII summary metadata, or {} if it cannot be read"""
+        if self.metadata_etag is None:
+            return {}
+        try:
+            return json.loads(self.metadata_blob.download_blob().readall().decode('utf-8'))
+        except Exception as e:
+            logger.warning(f"Could not retrieve metadata: {str(e)}")
+            return {}
+    
+    def iter_protected(self):
+        """Protected markdown as text chunks, as they download
+
+        The download is started before the first chunk is returned, and it fails if the
+        blob changed since `etag` was read.
+        """
+        if not self.available:
+            return iter(())
+        downloader = self.protected_blob.download_blob(etag=self.protected_etag, match_condition=MatchConditions.IfNotModified)
+        
+        def chunks():
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            for chunk in downloader.chunks():
+                text = decoder.decode(chunk)
+                if text:
+                    yield text
+            tail = decoder.decode(b"", final=True)
+            if tail:
+                yield tail
+        return chunks()
+
 def get_document_comparison(file_name: str) -> dict:
     """Get protected version and metadata for demo comparison"""
     try:
-        # Get protected version from processed container
-        # Use virtual path-aware naming: test/file.txt -> test/protected_file.txt.md
-        virtual_path = get_virtual_path_from_blob_name(file_name)
-        base_filename = file_name.split('/')[-1] if '/' in file_name else file_name
-        
-        if virtual_path:
-            protected_file_name = f"{virtual_path}/protected_{base_filename}.md"
-            metadata_file = f"{virtual_path}/metadata_{base_filename}.json"
-        else:
-            protected_file_name = f"protected_{base_filename}.md"
-            metadata_file = f"metadata_{base_filename}.json"
-        
+        comparison = DocumentComparison(file_name)
         protected_content = ""
         try:
-            container_client = blob_service_client.get_container_client(PROCESSED_CONTAINER)
-            blob_client = container_client.get_blob_client(protected_file_name)
-            download_stream = blob_client.download_blob()
-            protected_content = download_stream.readall().decode('utf-8')
+            protected_content = "".join(comparison.iter_protected())
         except Exception as e:
             logger.warning(f"Could not retrieve protected version: {str(e)}")
         
-        # Get metadata for PII summary
-        metadata = {}
-        try:
-            container_client = blob_service_client.get_container_client(PROCESSED_CONTAINER)
-            blob_client = container_client.get_blob_client(metadata_file)
-            download_stream = blob_client.download_blob()
-            metadata = json.loads(download_stream.readall().decode('utf-8'))
-        except Exception as e:
-            logger.warning(f"Could not retrieve metadata: {str(e)}")
-        
         return {
             "protected": protected_content,
-            "metadata": metadata,
+            "metadata": comparison.metadata(),
             "comparison_available": bool(protected_content)
         }
         
@@ -1130,7 +3719,7 @@ def get_knowledge_base_summary():
             }
             
             try:
-                response = requests.get(url, headers=headers)
+                response = openwebui_http.get(url, headers=headers, endpoint="GET /api/v1/knowledge/{id}/files")
                 if response.status_code == 200:
                     files = response.json()
                     file_count = len(files)
@@ -1171,39 +3760,617 @@ def get_knowledge_base_for_file(file_name):
     kb_description = f"Knowledge base for {directory_name.title()} documents from the upload pipeline"
     
     # Get or create the knowledge base
-    knowledge_bases = get_list_knowledge()
-    
-    for kb in knowledge_bases:
-        if kb['name'] == kb_name:
-            logger.debug(f"Found existing knowledge base for {directory_name}: {kb['name']} (ID: {kb['id']})")
-            return kb['id']
-    
-    # Create new knowledge base
-    logger.info(f"Creating new knowledge base for {directory_name}: {kb_name}")
-    result = create_knowledge(name=kb_name, description=kb_description)
-    if result and 'id' in result:
-        logger.info(f"Successfully created knowledge base: {kb_name} (ID: {result['id']})")
-        
-        # Automatically create a model and attach this knowledge base
-        model_result = create_model_with_knowledge_base(result['id'], kb_name)
-        if model_result:
-            logger.info(f"Successfully created model for knowledge base: {kb_name}")
+    kb_id = knowledge_base_directory.get_or_create(kb_name, kb_description)
+    if kb_id:
+        return kb_id
+    
+    logger.error(f"Failed to get or create knowledge base for {directory_name}")
+    # Fall back to default knowledge base
+    return get_or_create_knowledge_base()
+
+class PollingChangeFeed:
+    """Lists the upload container, backing off while it stays empty
+
+    The interval starts at MIN_POLL_INTERVAL, doubles after every listing that finds
+    nothing new (up to PROCESSING_INTERVAL), and drops back to the minimum as soon as a
+    listing finds files that were not there last time. Files that keep failing are
+    therefore retried at the slow interval rather than the fast one.
+    """
+    
+    def __init__(self, container_name, min_interval=MIN_POLL_INTERVAL, max_interval=PROCESSING_INTERVAL, lister=None, virtual_handler=None):
+        self.container_name = container_name
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.interval = min_interval
+        self.lister = lister or (lambda: iter_blobs(container_name))
+        self.virtual_handler = virtual_handler
+        self._next_poll = 0.0  # Poll immediately on startup
+        self._last_names = set()
+        self._last_listing = []
+    
+    def start(self):
+        pass
+    
+    def stop(self):
+        pass
+    
+    def seconds_until_poll(self):
+        """Seconds until the next listing is due"""
+        return max(0.0, self._next_poll - time.time())
+    
+    def poll(self):
+        """List the container now, yielding blobs as each page arrives, and schedule the next listing"""
+        listing = []
+        started = time.perf_counter()
+        try:
+            for blob in self.lister():
+                if isinstance(blob, str):
+                    blob = PendingBlob(blob)
+                listing.append(blob)
+                yield blob
+        except Exception as e:
+            logger.error(f"Error listing {self.container_name}: {str(e)}")
+        stage_seconds.observe(time.perf_counter() - started, stage='list')
+        
+        self._last_listing = listing
+        current_names = {blob.name for blob in listing}
+        if current_names - self._last_names:
+            self.interval = self.min_interval
         else:
-            logger.warning(f"Failed to create model for knowledge base: {kb_name}")
+            self.interval = min(self.interval * 2, self.max_interval)
+        self._last_names = current_names
+        self._next_poll = time.time() + self.interval
+        
+        # The hierarchy is only built when something actually consumes it
+        if logger.isEnabledFor(logging.DEBUG) and listing:
+            virtual_structure = self.virtual_hierarchy()
+            if virtual_structure:
+                logger.debug(f"Virtual file structure detected: {json.dumps(virtual_structure, indent=2)}")
+    
+    def virtual_hierarchy(self):
+        """Virtual file hierarchy of the most recent listing (built on demand, no extra listing)"""
+        virtual_handler = self.virtual_handler or VirtualFileHandler(None)
+        return virtual_handler.build_virtual_file_hierarchy(self._last_listing)
+    
+    def next_batch(self):
+        """Wait until the next listing is due and return the pending blobs found"""
+        time.sleep(self.seconds_until_poll())
+        return self.poll()
+
+class LocalChangeFeed:
+    """In-process change feed: blob names pushed with publish() are handed to the pipeline immediately
+
+    Used directly as a stand-in source in tests, and as the base of HttpChangeFeed.
+    An optional polling fallback picks up anything that was never announced.
+    """
+    
+    def __init__(self, fallback=None, idle_timeout=1.0):
+        self.fallback = fallback
+        self.idle_timeout = idle_timeout
+        self._queue = queue.Queue()
+    
+    def start(self):
+        pass
+    
+    def stop(self):
+        pass
+    
+    def publish(self, blob):
+        """Announce a new blob (a name or a PendingBlob)"""
+        self._queue.put(PendingBlob(blob) if isinstance(blob, str) else blob)
+    
+    def next_batch(self):
+        """Return announced blobs as soon as any arrive, followed by the fallback listing whenever it is due"""
+        names = []
+        wait = self.fallback.seconds_until_poll() if self.fallback else self.idle_timeout
+        if wait > 0:
+            try:
+                names.append(self._queue.get(timeout=wait))
+            except queue.Empty:
+                pass
+        
+        # Drain everything else that has already arrived
+        while True:
+            try:
+                names.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        # A steady stream of notifications must not hold off the listing of unannounced uploads
+        if self.fallback and self.fallback.seconds_until_poll() <= 0:
+            return itertools.chain(names, self.fallback.poll())
+        return names
+
+class HttpChangeFeed(LocalChangeFeed):
+    """Change feed fed by upload notifications (POST /notify) from the web upload app"""
+    
+    def __init__(self, port=CHANGE_FEED_PORT, container_name=UPLOAD_CONTAINER, token=CHANGE_FEED_TOKEN, fallback=None):
+        super().__init__(fallback=fallback)
+        self.port = port
+        self.container_name = container_name
+        self.token = token
+        self._server = None
+    
+    def start(self):
+        """Start the notification listener in a background thread"""
+        feed = self
         
-        return result['id']
+        class NotifyHandler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != "/notify":
+                    self._respond(404, {"error": "Endpoint not found"})
+                    return
+                if feed.token and self.headers.get("X-Notify-Token") != feed.token:
+                    self._respond(401, {"error": "Invalid notification token"})
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    payload = json.loads(self.rfile.read(length) or b"{}")
+                except Exception:
+                    self._respond(400, {"error": "Invalid JSON payload"})
+                    return
+                
+                blob_name = payload.get("blobName") or payload.get("blob_name")
+                container = payload.get("container", feed.container_name)
+                if not blob_name or container != feed.container_name:
+                    self._respond(400, {"error": "Expected blobName in the upload container"})
+                    return
+                
+                size = payload.get("size")
+                feed.publish(PendingBlob(blob_name, size if isinstance(size, int) else None))
+                self._respond(202, {"queued": blob_name})
+            
+            def _respond(self, status, body):
+                self.send_response(status)
+                self.send_header("Content-type", "application/json")
+                self.end_headers()
+                self.wfile.write(json.dumps(body).encode())
+            
+            def log_message(self, format, *args):
+                logger.debug(f"Change feed: {format % args}")
+        
+        self._server = http.server.ThreadingHTTPServer(("", self.port), NotifyHandler)
+        threading.Thread(target=self._server.serve_forever, name='change-feed', daemon=True).start()
+        logger.info(f"Listening for upload notifications on port {self.port} (POST /notify)")
+    
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+def create_change_feed(virtual_handler=None):
+    """Build the configured change feed; polling always remains as a fallback"""
+    polling = PollingChangeFeed(UPLOAD_CONTAINER, virtual_handler=virtual_handler)
+    if CHANGE_FEED == 'http':
+        return HttpChangeFeed(fallback=polling)
+    return polling
+
+class UploadScheduler:
+    """Orders pending uploads and runs them on separate light and heavy worker lanes
+
+    Formats the format router converts without Docling (text, markdown, JSON and XML)
+    go to the light lane and everything else to the heavy lane, however small, since the
+    light lane has no conversion capacity of its own. Each lane has its own workers, so a
+    backlog of large scanned PDFs never delays a small text file. Within a lane the
+    policy picks the next upload when a worker frees up:
+
+    - sjf: smallest first; the effective size halves every `aging_seconds` an upload
+      waits, so large files are not starved
+    - fifo: oldest `last_modified` first
+    - fair: round-robin across knowledge bases (top-level virtual directories),
+      smallest first within each
+
+    `policy` may also be a callable taking (pending uploads, scheduler) and returning
+    the one to run. An upload that is pending or running is not queued again.
+    """
+    
+    def __init__(self, handler, policy=SCHEDULER_POLICY, light_workers=SCHEDULER_LIGHT_WORKERS,
+                 heavy_workers=SCHEDULER_HEAVY_WORKERS, aging_seconds=SCHEDULER_AGING_SECONDS, on_idle=None):
+        self.handler = handler
+        self.pick = policy if callable(policy) else getattr(self, f"_pick_{policy}")
+        self.workers = {'light': max(1, light_workers), 'heavy': max(1, heavy_workers)}
+        self.aging_seconds = aging_seconds
+        self.on_idle = on_idle
+        self._pending = {'light': {}, 'heavy': {}}
+        self._running = {}  # name -> start time
+        self._served = {}  # knowledge base -> dispatch sequence number, for fair share
+        self._dispatched = 0
+        self._condition = threading.Condition()
+        self._threads = []
+        self._stopped = False
+    
+    @staticmethod
+    def lane_for(blob):
+        """'light' for the format router's fast-path formats, 'heavy' for anything that may need Docling"""
+        return 'heavy' if FormatRouter.may_need_docling(blob.name) else 'light'
+    
+    @staticmethod
+    def knowledge_base_of(blob):
+        return blob.name.split('/')[0] if '/' in blob.name else ''
+    
+    def submit(self, blob):
+        """Queue an upload; returns False if it is already pending or running"""
+        with self._condition:
+            lane = self.lane_for(blob)
+            if blob.name in self._running or any(blob.name in pending for pending in self._pending.values()):
+                return False
+            self._pending[lane][blob.name] = (blob, time.time())
+            self._condition.notify_all()
+            return True
+    
+    def _age(self, item):
+        blob, queued_at = item
+        return time.time() - queued_at
+    
+    def _pick_sjf(self, items, scheduler=None):
+        # Unknown sizes (notifications without one) count as small: they are fresh uploads
+        return min(items, key=lambda item: (item[0].size or 0) / 2 ** (self._age(item) / self.aging_seconds))
+    
+    def _pick_fifo(self, items, scheduler=None):
+        def modified(item):
+            blob, queued_at = item
+            if isinstance(blob.last_modified, datetime):
+                return blob.last_modified.timestamp()
+            return queued_at
+        return min(items, key=modified)
+    
+    def _pick_fair(self, items, scheduler=None):
+        knowledge_base = min({self.knowledge_base_of(item[0]) for item in items}, key=lambda kb: (self._served.get(kb, -1), kb))
+        return self._pick_sjf([item for item in items if self.knowledge_base_of(item[0]) == knowledge_base])
+    
+    def _next(self, lane):
+        """Block until an upload is pending in `lane`; returns None once stopped"""
+        with self._condition:
+            while not self._pending[lane] and not self._stopped:
+                self._condition.wait()
+            if self._stopped:
+                return None
+            blob, _ = self.pick(list(self._pending[lane].values()), self)
+            del self._pending[lane][blob.name]
+            self._running[blob.name] = time.time()
+            self._dispatched += 1
+            self._served[self.knowledge_base_of(blob)] = self._dispatched
+            return blob
+    
+    def _worker(self, lane):
+        while True:
+            blob = self._next(lane)
+            if blob is None:
+                return
+            try:
+                self.handler(blob)
+            except Exception as e:
+                logger.error(f"Unhandled error in job for {blob.name}: {str(e)}")
+            with self._condition:
+                self._running.pop(blob.name, None)
+                idle = not self._running and not any(self._pending.values())
+            if idle and self.on_idle:
+                self.on_idle()
+    
+    def start(self):
+        """Start the lane workers"""
+        for lane, count in self.workers.items():
+            for i in range(count):
+                thread = threading.Thread(target=self._worker, args=(lane,), name=f'{lane}-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return self
+    
+    def stop(self):
+        """Stop the workers after their current uploads; pending uploads are dropped"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+    
+    def stats(self):
+        """Pending and running upload counts, worker capacity and the longest running upload"""
+        with self._condition:
+            oldest = min(self._running.values(), default=None)
+            return {
+                'pending': {lane: len(pending) for lane, pending in self._pending.items()},
+                'running': len(self._running),
+                'workers': sum(self.workers.values()),
+                'workers_alive': sum(thread.is_alive() for thread in self._threads),
+                'oldest_running_seconds': round(time.time() - oldest, 1) if oldest else None
+            }
+
+def _probe_blob_storage():
+    get_blob_service_client().get_container_client(UPLOAD_CONTAINER).get_container_properties(
+        connection_timeout=HEALTH_PROBE_TIMEOUT, read_timeout=HEALTH_PROBE_TIMEOUT, retry_total=0
+    )
+    return True
+
+def _probe_http(http, url):
+    # Probes are not retried: a dependency that needs retries is reported as down
+    response = http.get(url, endpoint="health probe", idempotent=False, timeout=(HEALTH_PROBE_TIMEOUT, HEALTH_PROBE_TIMEOUT))
+    return response.status_code < 500
+
+def _probe_openwebui():
+    return _probe_http(openwebui_http, f"{OPENWEBUI_URL}/health")
+
+def _probe_vault():
+    vault_kv_client = get_vault_kv_client()
+    if vault_kv_client is None:
+        return None
+    return _probe_http(vault_http, f"{vault_kv_client.vault_url}/v1/sys/health?standbyok=true")
+
+def _probe_converter():
+    """docling-serve answering, or at least one warm converter in the converting processes"""
+    if docling_serve is not None:
+        if not docling_serve.url:
+            raise RuntimeError("DOCLING_SERVE_URL is not set")
+        return _probe_http(docling_serve.http, f"{docling_serve.url}/health")
+    if not CONVERTER_WARMUP_FORMATS:
+        return True
+    return any(entry['loaded'] for stats in get_converter_stats().values() for entry in stats.values())
+
+class PipelineHealth:
+    """Liveness and readiness of the running processor, for the health server
+
+    Liveness only looks at the process itself: the processing loop must have completed
+    an iteration within `heartbeat_timeout` and every scheduler worker thread must be
+    running. Readiness also needs the critical dependencies (Blob Storage, OpenWebUI
+    and the converter) to answer. Vault is reported but not required, because fallback
+    PII protection keeps documents moving without it. Dependency probes are cached for
+    `probe_ttl` seconds, so frequent checks do not turn into load on the dependencies.
+    """
+    
+    PROBES = {
+        'blob_storage': (_probe_blob_storage, True),
+        'openwebui': (_probe_openwebui, True),
+        'converter': (_probe_converter, True),
+        'vault': (_probe_vault, False)
+    }
+    
+    def __init__(self, heartbeat_timeout=HEARTBEAT_TIMEOUT, probe_ttl=HEALTH_PROBE_TTL, probes=None):
+        self.heartbeat_timeout = heartbeat_timeout
+        self.probe_ttl = probe_ttl
+        self.probes = probes if probes is not None else self.PROBES
+        self.scheduler = None
+        self.last_heartbeat = None
+        self._results = {}  # name -> (checked_at, ok, error)
+        self._probe_locks = {name: threading.Lock() for name in self.probes}
+    
+    def heartbeat(self):
+        """Called by the processing loop on every iteration"""
+        self.last_heartbeat = time.time()
+    
+    def liveness(self):
+        """(live, details); live until the loop has started, so slow converter warm-up is not a failure"""
+        details = {'heartbeat_age_seconds': None}
+        live = True
+        if self.last_heartbeat is not None:
+            age = time.time() - self.last_heartbeat
+            details['heartbeat_age_seconds'] = round(age, 1)
+            live = age <= self.heartbeat_timeout
+        if self.scheduler is not None:
+            stats = self.scheduler.stats()
+            details['workers_alive'] = stats['workers_alive']
+            live = live and stats['workers_alive'] == stats['workers']
+        details['status'] = 'live' if live else 'failing'
+        return live, details
+    
+    def _probe(self, name):
+        check, _ = self.probes[name]
+        with self._probe_locks[name]:
+            checked_at, ok, error = self._results.get(name, (0, None, None))
+            if time.time() - checked_at >= self.probe_ttl:
+                try:
+                    ok, error = check(), None
+                except Exception as e:
+                    ok, error = False, str(e)
+                checked_at = time.time()
+                self._results[name] = (checked_at, ok, error)
+        result = {'ok': ok, 'checked_seconds_ago': round(time.time() - checked_at, 1)}
+        if error:
+            result['error'] = error
+        return result
+    
+    def dependency_ok(self, name):
+        """Cached probe of one dependency; a dependency that is not configured counts as ok"""
+        return self._probe(name)['ok'] is not False
+    
+    def readiness(self):
+        """(ready, details) with the loop state, each dependency and the scheduler backlog"""
+        live, liveness = self.liveness()
+        checks = {name: self._probe(name) for name in self.probes}
+        ready = live and self.last_heartbeat is not None and all(
+            checks[name]['ok'] is not False for name, (_, critical) in self.probes.items() if critical
+        )
+        details = {'status': 'ready' if ready else 'not_ready', 'loop': liveness, 'checks': checks}
+        for name, (_, critical) in self.probes.items():
+            checks[name]['critical'] = critical
+        if self.scheduler is not None:
+            stats = self.scheduler.stats()
+            details['workers'] = dict(stats, backlog=sum(stats['pending'].values()),
+                                      saturation=round(stats['running'] / stats['workers'], 2))
+        return ready, details
+
+pipeline_health = PipelineHealth()
+
+def delete_upload(file_name, etag=None):
+    """Delete a processed file from the upload container
+
+    With `etag`, the delete only succeeds while the upload is still the version that was
+    processed, so a file re-uploaded in the meantime is kept and processed again.
+    """
+    ensure_claimed("delete the upload")
+    container_client = get_blob_service_client().get_container_client(UPLOAD_CONTAINER)
+    blob_client = container_client.get_blob_client(file_name)
+    if etag:
+        blob_client.delete_blob(etag=etag, match_condition=MatchConditions.IfNotModified)
     else:
-        logger.error(f"Failed to create knowledge base for {directory_name}")
-        # Fall back to default knowledge base
-        return get_or_create_knowledge_base()
+        blob_client.delete_blob()
+
+def upload_exists(file_name):
+    """Whether the upload is still in the upload container"""
+    container_client = get_blob_service_client().get_container_client(UPLOAD_CONTAINER)
+    return container_client.get_blob_client(file_name).exists()
+
+def retry_delay(attempts):
+    """Seconds to wait after `attempts` failed attempts: RETRY_BACKOFF_BASE doubling up to RETRY_BACKOFF_MAX"""
+    return min(RETRY_BACKOFF_BASE * 2 ** (attempts - 1), RETRY_BACKOFF_MAX)
+
+def dead_letter_upload(file_name, reason, attempts, etag=None):
+    """Move an upload that keeps failing to the dead-letter container, with the failure reason in its metadata"""
+    ensure_claimed("dead-letter the upload")
+    metadata = attempt_metadata(AttemptRecord(attempts, error=reason))
+    metadata['failed_at'] = datetime.utcnow().isoformat()
+    copy_blob(UPLOAD_CONTAINER, file_name, file_name, target_container=FAILED_CONTAINER, metadata=metadata)
+    delete_upload(file_name, etag)
+
+def record_failed_attempt(claim, blob, reason):
+    """Count a failed attempt: back off before the next one, or dead-letter the upload after MAX_ATTEMPTS"""
+    attempts = claim.record.attempts + 1
+    if MAX_ATTEMPTS and attempts >= MAX_ATTEMPTS:
+        try:
+            dead_letter_upload(blob.name, reason, attempts, blob.etag)
+            claim.release(done=True)
+            documents_total.inc(result='dead_lettered')
+            logger.error(f"Moved {blob.name} to {FAILED_CONTAINER} after {attempts} failed attempts: {reason}")
+            return
+        except Exception as e:
+            logger.error(f"Could not move {blob.name} to {FAILED_CONTAINER}: {str(e)}")
+    
+    documents_total.inc(result='failed')
+    delay = retry_delay(attempts)
+    claim.release(failure=AttemptRecord(attempts, time.time() + delay, blob.etag, reason))
+    limit = f"/{MAX_ATTEMPTS}" if MAX_ATTEMPTS else ""
+    logger.warning(f"Attempt {attempts}{limit} at {blob.name} failed, retrying in {delay:g}s: {reason}")
+
+def defer_upload(claim, blob, reason):
+    """Retry without using up an attempt (a dependency failed, not the document), backing off per deferral"""
+    documents_total.inc(result='deferred')
+    deferrals = claim.record.deferrals + 1
+    delay = retry_delay(deferrals)
+    claim.release(failure=AttemptRecord(claim.record.attempts, time.time() + delay, blob.etag, reason, deferrals))
+    logger.warning(f"Processing {blob.name} failed on a dependency, retrying in {delay:g}s: {reason}")
+
+def converter_ready():
+    """Whether uploads that need Docling can be converted now
+
+    Only docling-serve without a local fallback can be missing: its URL is unset (the
+    service lookup rendered empty) or it does not answer. Uses the readiness probe,
+    so it is checked at most every HEALTH_PROBE_TTL seconds.
+    """
+    if docling_serve is None or DOCLING_SERVE_FALLBACK:
+        return True
+    return pipeline_health.dependency_ok('converter')
+
+def process_upload(blob, virtual_handler):
+    """Claim an upload for this replica and process it; uploads claimed elsewhere or not yet due for a retry are skipped"""
+    file_name = blob.name
+    # Left unclaimed, so the next listing offers it again once docling-serve is back
+    if FormatRouter.may_need_docling(file_name) and not converter_ready():
+        logger.debug(f"Skipping {file_name}: waiting for docling-serve")
+        return False
+    try:
+        claim = work_claims.claim(file_name, blob.etag)
+    except Exception as e:
+        logger.error(f"Could not claim {file_name}: {str(e)}")
+        return False
+    if claim is None:
+        logger.debug(f"Skipping {file_name}: claimed by another replica or waiting to be retried")
+        return False
+    
+    succeeded = False
+    _current_claim.claim = claim
+    try:
+        # Another replica may have finished the upload between our listing and the claim
+        if not upload_exists(file_name):
+            logger.debug(f"Skipping {file_name}: already processed by another replica")
+            succeeded = True
+            return True
+        failure_reasons.reset()
+        try:
+            with stage_seconds.time(stage='document'):
+                succeeded = _process_upload(blob, virtual_handler)
+        except Exception as e:
+            logger.error(f"Unhandled error processing {file_name}: {str(e)}")
+            failure_reasons.mark_error(e)
+        if claim.lost and not succeeded:
+            # The replica holding the claim now records any failure
+            logger.warning(f"Stopped processing {file_name}: {failure_reasons.last() or 'lost the claim'}")
+        elif succeeded:
+            documents_total.inc(result='processed')
+        elif failure_reasons.is_document_failure():
+            record_failed_attempt(claim, blob, failure_reasons.last() or "processing failed")
+        else:
+            defer_upload(claim, blob, failure_reasons.last() or "processing failed")
+        return succeeded
+    finally:
+        _current_claim.claim = None
+        claim.release(done=succeeded)
+
+def _process_upload(blob, virtual_handler):
+    """Process a single upload as one job, deleting it only after successful processing"""
+    file_name = blob.name
+    
+    # The processor may have stopped between finishing an upload and deleting it; the
+    # ledger recognises that upload by its etag, so it is deleted without another download
+    if processing_ledger and blob.etag:
+        try:
+            if ProcessingLedger.is_completed(processing_ledger.lookup_etag(blob.etag), file_name):
+                delete_upload(file_name, blob.etag)
+                logger.info(f"Removed already processed upload: {file_name}")
+                return True
+        except Exception as e:
+            logger.warning(f"Could not check the ledger for {file_name}: {str(e)}")
+    
+    # Check if this is a virtual file
+    if virtual_handler.is_virtual_directory(file_name):
+        logger.info(f"Processing virtual file: {file_name}")
+        try:
+            if process_virtual_document(file_name, UPLOAD_CONTAINER):
+                # Delete from upload container after successful processing
+                delete_upload(file_name, blob.etag)
+                logger.info(f"Successfully processed and removed virtual file: {file_name}")
+                return True
+        except Exception as e:
+            logger.error(f"Error processing virtual file {file_name}: {str(e)}")
+            failure_reasons.mark_error(e)
+        return False
+    
+    # Regular file processing
+    document = None
+    try:
+        # Download file (into memory unless it is very large)
+        document = download_document(UPLOAD_CONTAINER, file_name)
+        
+        # Process file
+        if process_document(document, file_name):
+            # Delete from upload container after successful processing
+            delete_upload(file_name, blob.etag)
+            logger.info(f"Successfully processed and removed: {file_name}")
+            return True
+        return False
+        
+    except Exception as e:
+        logger.error(f"Error processing regular file {file_name}: {str(e)}")
+        failure_reasons.mark_error(e)
+        return False
+    finally:
+        # Clean up the spilled download, if any
+        release_document(document)
 
 def main():
     """Main processing loop with enhanced virtual file handling"""
     logger.info("Starting file processor with virtual file support...")
+    
+    # The health server runs in this process, so /metrics sees the pipeline's own counters
+    if HEALTH_PORT:
+        try:
+            import health_server
+            health_server.start_health_server(HEALTH_PORT)
+            logger.info(f"Health server listening on port {HEALTH_PORT} (/health, /metrics, /demo/compare/<file>)")
+        except Exception as e:
+            logger.warning(f"Could not start the health server: {str(e)}")
     logger.info(f"Base model for KB agents: {BASE_MODEL_ID}")
     
     # Initialize virtual file handler
-    virtual_handler = VirtualFileHandler(blob_service_client)
+    virtual_handler = VirtualFileHandler(get_blob_service_client())
     
     # Log current knowledge base status
     kb_summary = get_knowledge_base_summary()
@@ -1221,59 +4388,72 @@ def main():
             model_id = model.get('id', 'Unknown')
             logger.info(f"  - {model_name} (ID: {model_id})")
     
+    logger.info(f"Worker lanes: {SCHEDULER_LIGHT_WORKERS} light and {SCHEDULER_HEAVY_WORKERS} heavy ({SCHEDULER_POLICY}), "
+                f"{CONVERSION_PROCESSES} conversion processes")
+    if processing_ledger:
+        try:
+            processing_ledger.ensure_container()
+        except Exception as e:
+            logger.warning(f"Could not prepare the processing ledger container: {str(e)}")
+    try:
+        work_claims.ensure_container()
+    except Exception as e:
+        logger.warning(f"Could not prepare the work claim container: {str(e)}")
+    try:
+        get_blob_service_client().get_container_client(FAILED_CONTAINER).create_container()
+        logger.info(f"Created dead-letter container: {FAILED_CONTAINER}")
+    except ResourceExistsError:
+        pass
+    except Exception as e:
+        logger.warning(f"Could not prepare the dead-letter container: {str(e)}")
+    
+    # Warm up Docling converters (conversion processes warm up in their initializer);
+    # with docling-serve the models are only loaded if a local fallback is needed
+    if docling_serve is not None:
+        logger.info(f"Converting with docling-serve at {DOCLING_SERVE_URL} (local fallback: {DOCLING_SERVE_FALLBACK})")
+        if not DOCLING_SERVE_URL and not DOCLING_SERVE_FALLBACK:
+            logger.warning("DOCLING_SERVE_URL is not set; uploads that need Docling wait until it is")
+    elif get_conversion_pool() is None:
+        warm_up_converters()
+    else:
+        # Start a conversion process now; its report shows readiness checks a warm converter
+        def record_report(report):
+            if report.exception() is None:
+                pid, stats = report.result()
+                _converter_stats_by_pid[pid] = stats
+        get_conversion_pool().submit(_report_converter_stats).add_done_callback(record_report)
+    
+    def log_stats():
+        logger.info(f"Converter stats: {json.dumps(get_converter_stats())}")
+        logger.info(f"Format routing: {json.dumps(format_router.stats())}")
+        if conversion_cache:
+            logger.info(f"Conversion cache: {json.dumps(conversion_cache.stats())}")
+        logger.info(f"HTTP stats: {json.dumps(get_http_stats())}")
+    
+    # New uploads arrive from the change feed and wait in the scheduler until a worker
+    # in their lane is free; names already pending or being processed are skipped
+    scheduler = UploadScheduler(lambda blob: process_upload(blob, virtual_handler), on_idle=log_stats).start()
+    metrics.collect('queue_depth', 'Uploads waiting for a worker, by lane',
+                    lambda: [({'lane': lane}, count) for lane, count in scheduler.stats()['pending'].items()])
+    metrics.collect('uploads_in_progress', 'Uploads being processed', lambda: scheduler.stats()['running'])
+    pipeline_health.scheduler = scheduler
+    change_feed = create_change_feed(virtual_handler)
+    change_feed.start()
+    
     while True:
+        pipeline_health.heartbeat()
         try:
-            # List files in upload container
-            upload_files = list_blobs(UPLOAD_CONTAINER)
-            
-            # Process virtual file hierarchy if enabled
-            # Virtual file handling is always enabled for automatic knowledge base organization
-            virtual_structure = virtual_handler.process_virtual_file_hierarchy(UPLOAD_CONTAINER)
-            if virtual_structure:
-                logger.debug(f"Virtual file structure detected: {json.dumps(virtual_structure, indent=2)}")
-            
-            for file_name in upload_files:
-                if not file_name.endswith('/'):  # Skip directory markers
-                    # Extract just the filename without virtual path for local processing
-                    base_filename = file_name.split('/')[-1] if '/' in file_name else file_name
-                    local_path = f"/tmp/{base_filename}"
-                    
-                    # Check if this is a virtual file
-                    if virtual_handler.is_virtual_directory(file_name):
-                        logger.info(f"Processing virtual file: {file_name}")
-                        if process_virtual_document(file_name, UPLOAD_CONTAINER):
-                            # Delete from upload container after successful processing
-                            container_client = blob_service_client.get_container_client(UPLOAD_CONTAINER)
-                            blob_client = container_client.get_blob_client(file_name)
-                            blob_client.delete_blob()
-                            logger.info(f"Successfully processed and removed virtual file: {file_name}")
-                    else:
-                        # Regular file processing
-                        try:
-                            # Download file
-                            download_blob(UPLOAD_CONTAINER, file_name, local_path)
-                            
-                            # Process file
-                            if process_document(local_path, file_name):
-                                # Delete from upload container after successful processing
-                                container_client = blob_service_client.get_container_client(UPLOAD_CONTAINER)
-                                blob_client = container_client.get_blob_client(file_name)
-                                blob_client.delete_blob()
-                                logger.info(f"Successfully processed and removed: {file_name}")
-                            
-                        except Exception as e:
-                            logger.error(f"Error processing regular file {file_name}: {str(e)}")
-                        finally:
-                            # Clean up local file
-                            if os.path.exists(local_path):
-                                os.remove(local_path)
-            
-            # Wait before next check
-            time.sleep(PROCESSING_INTERVAL)
+            # Blobs are queued as the listing streams in, not after it completes
+            for blob in change_feed.next_batch():
+                if blob.name.endswith('/'):  # Skip directory markers
+                    continue
+                scheduler.submit(blob)
             
         except Exception as e:
             logger.error(f"Error in main loop: {str(e)}")
             time.sleep(PROCESSING_INTERVAL)
 
 if __name__ == "__main__":
+    # health_server imports this module by name; share this instance instead of loading a second copy
+    sys.modules.setdefault('process_documents', sys.modules[__name__])
     main()
\ No newline at end of file
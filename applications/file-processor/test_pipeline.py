@@ -0,0 +1,1444 @@
+#!/usr/bin/env python3
+"""
+Test script for the document pipeline components
+
+These tests exercise the scheduling and ingestion building blocks of the
+file-processor using local stand-ins, so no Azure, Vault or OpenWebUI
+connection is needed.
+"""
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import process_documents
+from local_standins import MockVaultServer, FakeBlobServer, FakeDoclingServe
+from process_documents import LocalChangeFeed, PollingChangeFeed, PendingBlob, VaultKVPIIProtector, VaultTransformClient, HttpClient, AsyncHttpClient, AsyncIOEngine, KnowledgeBaseDirectory, DocumentInput, PIIScanner, basic_pii_scanner
+
+def test_local_change_feed():
+    """Test that published blob names are delivered in one batch"""
+    print("Testing local change feed...")
+
+    feed = LocalChangeFeed(idle_timeout=0.1)
+    feed.publish("contracts/contract1.pdf")
+    feed.publish("simple_file.txt")
+
+    batch = [blob.name for blob in feed.next_batch()]
+    expected = ["contracts/contract1.pdf", "simple_file.txt"]
+    status = "✓" if batch == expected else "✗"
+    print(f"  {status} published names -> {batch}")
+    assert batch == expected
+
+    empty = list(feed.next_batch())
+    status = "✓" if empty == [] else "✗"
+    print(f"  {status} idle feed -> {empty}")
+    assert empty == []
+
+    print()
+
+def test_polling_backoff():
+    """Test adaptive polling interval"""
+    print("Testing polling backoff...")
+
+    listings = [[], [], ["a.txt"], ["a.txt"], []]
+    polling = PollingChangeFeed("uploads", min_interval=1, max_interval=4, lister=lambda: listings.pop(0))
+
+    intervals = []
+    for _ in range(5):
+        list(polling.poll())
+        intervals.append(polling.interval)
+
+    expected = [2, 4, 1, 2, 4]
+    status = "✓" if intervals == expected else "✗"
+    print(f"  {status} intervals -> {intervals} (expected: {expected})")
+    assert intervals == expected
+
+    print()
+
+def test_change_feed_fallback():
+    """Test that the polling fallback runs when no notifications arrive"""
+    print("Testing change feed polling fallback...")
+
+    polling = PollingChangeFeed("uploads", min_interval=0.05, max_interval=0.05, lister=lambda: ["missed.txt"])
+    feed = LocalChangeFeed(fallback=polling)
+
+    start = time.time()
+    batch = [blob.name for blob in feed.next_batch()]
+    status = "✓" if batch == ["missed.txt"] else "✗"
+    print(f"  {status} fallback listing -> {batch} ({time.time() - start:.2f}s)")
+    assert batch == ["missed.txt"]
+
+    feed.publish("announced.txt")
+    batch = [blob.name for blob in feed.next_batch()]
+    status = "✓" if batch == ["announced.txt"] else "✗"
+    print(f"  {status} notification preferred -> {batch}")
+    assert batch == ["announced.txt"]
+
+    # A busy feed still lists once the fallback is due
+    time.sleep(0.06)
+    feed.publish("busy.txt")
+    batch = [blob.name for blob in feed.next_batch()]
+    status = "✓" if batch == ["busy.txt", "missed.txt"] else "✗"
+    print(f"  {status} fallback listing alongside notifications -> {batch}")
+    assert batch == ["busy.txt", "missed.txt"]
+
+    print()
+
+def test_single_listing_hierarchy():
+    """Test that the hierarchy is built from the polling listing without listing again"""
+    print("Testing hierarchy from a single listing...")
+
+    listing_calls = []
+    blobs = [
+        PendingBlob("documents/contracts/contract1.pdf", 1024, "0x1", "2024-01-01T00:00:00Z"),
+        PendingBlob("simple_file.txt", 10, "0x2", "2024-01-01T00:00:00Z")
+    ]
+
+    def lister():
+        listing_calls.append(1)
+        return iter(blobs)
+
+    polling = PollingChangeFeed("uploads", lister=lister)
+    names = [blob.name for blob in polling.poll()]
+    hierarchy = polling.virtual_hierarchy()
+
+    contract = hierarchy["documents"]["children"]["contracts"]["children"]["contract1.pdf"]
+    status = "✓" if names == ["documents/contracts/contract1.pdf", "simple_file.txt"] else "✗"
+    print(f"  {status} streamed blobs -> {names}")
+    status = "✓" if contract["size"] == 1024 and len(listing_calls) == 1 else "✗"
+    print(f"  {status} hierarchy built lazily with {len(listing_calls)} listing call(s)")
+    assert contract["size"] == 1024
+    assert len(listing_calls) == 1
+
+    print()
+
+class RotatingVault(VaultKVPIIProtector):
+    """Vault KV stand-in whose SSN pattern can be rotated or made unreachable"""
+
+    def __init__(self):
+        super().__init__("http://vault.invalid:8200", "test-token", pattern_ttl=3600)
+        self.ssn_pattern = r'\b\d{3}-\d{2}-\d{4}\b'
+        self.reachable = True
+        self.fetches = 0
+
+    def fetch_pii_patterns(self):
+        if not self.reachable:
+            raise ConnectionError("vault unreachable")
+        self.fetches += 1
+        patterns = self._fallback_patterns()
+        patterns['ssn'] = self.ssn_pattern
+        return patterns
+
+    def fetch_replacement_strategies(self):
+        if not self.reachable:
+            raise ConnectionError("vault unreachable")
+        return self._fallback_strategies()
+
+def test_pii_pattern_cache():
+    """Test cached, pre-compiled PII patterns with rotation and Vault outages"""
+    print("Testing PII pattern cache...")
+
+    vault = RotatingVault()
+    vault.protect_pii("SSN 123-45-6789")
+    vault.protect_pii("SSN 987-65-4321")
+    status = "✓" if vault.fetches == 1 else "✗"
+    print(f"  {status} two documents -> {vault.fetches} Vault fetch(es)")
+    assert vault.fetches == 1
+
+    vault.reachable = False
+    vault.pattern_cache.refresh()
+    protected = vault.protect_pii("SSN 123-45-6789")
+    status = "✓" if "123-45-6789" not in protected else "✗"
+    print(f"  {status} Vault unreachable -> last known good patterns still applied")
+    assert "123-45-6789" not in protected
+
+    vault.reachable = True
+    vault.ssn_pattern = r'\b\d{9}\b'
+    vault.pattern_cache.refresh()
+    protected = vault.protect_pii("SSN 123456789")
+    status = "✓" if "123456789" not in protected else "✗"
+    print(f"  {status} rotated pattern picked up on refresh")
+    assert "123456789" not in protected
+
+    vault.pattern_cache.stop()
+    print()
+
+def test_single_pass_pii_scanner():
+    """Test that one scan applies every replacement and counts each PII type"""
+    print("Testing single-pass PII scanner...")
+
+    text = (
+        "SSN 123-45-6789, email jane.doe@example.com, phone 555-123-4567, "
+        "account 1234-5678-9012-3456, second SSN 987-65-4321"
+    )
+    protected, counts = basic_pii_scanner.redact(text)
+    expected_counts = {'ssn': 2, 'email': 1, 'phone': 1, 'bank': 1}
+    expected_text = (
+        "SSN tok_ssn_xxxxx, email tok_email_xxxxx, phone ***-***-****, "
+        "account ****-****-****-****, second SSN tok_ssn_xxxxx"
+    )
+    status = "✓" if counts == expected_counts else "✗"
+    print(f"  {status} counts -> {counts}")
+    assert counts == expected_counts
+    status = "✓" if protected == expected_text else "✗"
+    print(f"  {status} replacements applied in one pass")
+    assert protected == expected_text
+
+    # Patterns with numbered backreferences cannot be combined and are scanned separately
+    scanner = PIIScanner({'repeat': r'(\d)\1{3}', 'ssn': r'\b\d{3}-\d{2}-\d{4}\b'}, {'repeat': '####', 'ssn': 'SSN'})
+    protected, counts = scanner.redact("pin 7777 and 123-45-6789")
+    status = "✓" if scanner.combined is None and protected == "pin #### and SSN" else "✗"
+    print(f"  {status} backreference pattern -> separate passes ({protected})")
+    assert scanner.combined is None and counts == {'repeat': 1, 'ssn': 1}
+
+    print()
+
+def test_streaming_redaction():
+    """Test that windowed redaction matches full-text redaction, including across window boundaries"""
+    print("Testing streaming redaction...")
+
+    text = "".join(
+        f"Row {i}: SSN 123-45-{6000 + i}, mail user{i}@example.com, phone 555-123-{4000 + i}, x{i}123-45-6789\n"
+        for i in range(200)
+    )
+    expected, expected_counts = basic_pii_scanner.redact(text)
+
+    for window in [7, 50, 333, 4096]:
+        output = []
+        chunks = (text[i:i + window] for i in range(0, len(text), window))
+        counts = basic_pii_scanner.redact_stream(chunks, output.append, overlap=64)
+        result = "".join(output)
+        status = "✓" if result == expected and counts == expected_counts else "✗"
+        print(f"  {status} window {window} -> {counts}")
+        assert result == expected
+        assert counts == expected_counts
+
+    # Patterns scanned separately stream the same way
+    scanner = PIIScanner({'repeat': r'(\d)\1{3}', 'ssn': r'\b\d{3}-\d{2}-\d{4}\b'}, {'repeat': '####', 'ssn': 'SSN'})
+    output = []
+    counts = scanner.redact_stream(iter(["pin 77", "77 and 123-4", "5-6789"]), output.append, overlap=16)
+    result = "".join(output)
+    status = "✓" if result == "pin #### and SSN" else "✗"
+    print(f"  {status} separate patterns across boundaries -> {result}")
+    assert result == "pin #### and SSN" and counts == {'repeat': 1, 'ssn': 1}
+
+    print()
+
+def test_batched_vault_transform():
+    """Test that chunks are encoded in batches and a failing Vault trips the breaker"""
+    print("Testing batched Vault Transform encoding...")
+
+    text = " ".join(f"Member {i} has SSN 123-45-{6000 + i}." for i in range(300))
+    with MockVaultServer() as vault:
+        client = VaultTransformClient(vault.url, "test-token", "ai_data_transform", "file-processor",
+                                      batch_size=100, chunk_size=200, http=HttpClient("test", max_retries=0))
+        chunks = len(client._split_text_into_chunks(text, 200))
+        tokenized = client.tokenize_pii(text)
+        status = "✓" if "123-45-" not in tokenized and vault.request_count == -(-chunks // 100) else "✗"
+        print(f"  {status} {chunks} chunks -> {vault.request_count} encode request(s)")
+        assert "123-45-" not in tokenized
+        assert vault.request_count == -(-chunks // 100)
+
+        vault.available = False
+        client.breaker.reset_timeout = 3600
+        for _ in range(client.breaker.failure_threshold + 2):
+            tokenized = client.tokenize_pii("SSN 123-45-6789")
+        failed_requests = vault.request_count - -(-chunks // 100)
+        status = "✓" if client.breaker.state == 'open' and failed_requests == client.breaker.failure_threshold else "✗"
+        print(f"  {status} Vault down -> breaker {client.breaker.state} after {failed_requests} request(s), fallback used")
+        assert client.breaker.state == 'open'
+        assert failed_requests == client.breaker.failure_threshold
+        assert "123-45-6789" not in tokenized
+
+        vault.available = True
+        client.breaker.reset_timeout = 0
+        client.tokenize_pii("SSN 123-45-6789")
+        status = "✓" if client.breaker.state == 'closed' else "✗"
+        print(f"  {status} trial call after reset timeout -> breaker {client.breaker.state}")
+        assert client.breaker.state == 'closed'
+
+    print()
+
+def test_pooled_http_client():
+    """Test keep-alive reuse, jittered retries and per-endpoint metrics"""
+    print("Testing pooled HTTP client...")
+
+    with MockVaultServer() as vault:
+        http = HttpClient("test", backoff_base=0.01, backoff_max=0.05)
+        for _ in range(20):
+            assert http.get(f"{vault.url}/v1/sys/health").status_code == 200
+        status = "✓" if vault.connection_count == 1 else "✗"
+        print(f"  {status} 20 requests -> {vault.connection_count} connection(s)")
+        assert vault.connection_count == 1
+
+        vault.fail_requests = 2
+        response = http.get(f"{vault.url}/v1/secret/data/missing", endpoint="kv read")
+        metrics = http.stats()["kv read"]
+        status = "✓" if metrics["retries"] == 2 and metrics["statuses"] == {"404": 1} else "✗"
+        print(f"  {status} two 503s retried -> {response.status_code} after {metrics['retries']} retries")
+        assert metrics["retries"] == 2 and metrics["statuses"] == {"404": 1}
+
+        vault.fail_requests = 1
+        response = http.post(f"{vault.url}/v1/ai_data_transform/encode/file-processor", json={"value": "x"})
+        status = "✓" if response.status_code == 503 else "✗"
+        print(f"  {status} non-idempotent POST not retried -> {response.status_code}")
+        assert response.status_code == 503
+        http.close()
+
+    print()
+
+def test_knowledge_base_directory():
+    """Test cached KB lookups and single-flight creation"""
+    print("Testing knowledge base directory cache...")
+
+    knowledge_bases = [{'id': 'kb-default', 'name': 'Default Knowledge Base', 'description': ''}]
+    calls = {'list': 0, 'create': 0, 'model': 0}
+
+    def lister():
+        calls['list'] += 1
+        return list(knowledge_bases)
+
+    def creator(name, description):
+        calls['create'] += 1
+        time.sleep(0.05)
+        kb = {'id': f"kb-{len(knowledge_bases)}", 'name': name, 'description': description}
+        knowledge_bases.append(kb)
+        return kb
+
+    def on_created(kb_id, name):
+        calls['model'] += 1
+        return {'id': f"kb-agent-{kb_id}"}
+
+    directory = KnowledgeBaseDirectory(lister=lister, creator=creator, on_created=on_created, ttl=3600)
+    ids = {directory.get_or_create('Default Knowledge Base') for _ in range(100)}
+    status = "✓" if ids == {'kb-default'} and calls['list'] == 1 else "✗"
+    print(f"  {status} 100 lookups -> {calls['list']} listing(s)")
+    assert ids == {'kb-default'} and calls['list'] == 1
+
+    results = []
+    workers = [threading.Thread(target=lambda: results.append(directory.get_or_create('Contracts Knowledge Base')))
+               for _ in range(8)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    status = "✓" if len(set(results)) == 1 and calls['create'] == 1 and calls['model'] == 1 else "✗"
+    print(f"  {status} 8 concurrent workers -> {calls['create']} KB and {calls['model']} model created")
+    assert len(set(results)) == 1 and calls['create'] == 1 and calls['model'] == 1
+
+    knowledge_bases.append({'id': 'kb-external', 'name': 'Hr Knowledge Base', 'description': ''})
+    directory.ttl = 0
+    kb_id = directory.lookup('Hr Knowledge Base')
+    status = "✓" if kb_id == 'kb-external' and calls['create'] == 1 else "✗"
+    print(f"  {status} reconcile picks up KB created elsewhere -> {kb_id}")
+    assert kb_id == 'kb-external'
+
+    print()
+
+def test_in_memory_data_path():
+    """Test that a document goes from download buffer to uploads without temporary files"""
+    print("Testing in-memory data path...")
+
+    uploads = {}
+
+    async def upload_blob_data_async(container, blob_name, data):
+        uploads[blob_name] = data
+
+    async def upload_file_to_openwebui_async(content, file_name):
+        uploads[f"openwebui:{file_name}"] = content
+        return 'file-1'
+
+    replaced = {
+        'get_conversion_pool': lambda: None,
+        'get_knowledge_base_for_file': lambda file_name: 'kb-test',
+        'upload_blob_data': lambda container, blob_name, data: uploads.__setitem__(blob_name, data),
+        'upload_blob_data_async': upload_blob_data_async,
+        'upload_file_to_openwebui_async': upload_file_to_openwebui_async,
+        'add_file_to_knowledge_base': lambda file_id, kb_id: True,
+        'vault_kv_client': None,
+        'processing_ledger': None,
+        'conversion_cache': None
+    }
+    original = {name: getattr(process_documents, name) for name in replaced}
+    original_tempdir = tempfile.tempdir
+    with tempfile.TemporaryDirectory() as scratch:
+        tempfile.tempdir = scratch
+        try:
+            for name, value in replaced.items():
+                setattr(process_documents, name, value)
+            # Windows-1252 text, as uploaded from older tools, still decodes
+            document = DocumentInput("notes.txt", data="Caf\u00e9 contact: jane.doe@example.com".encode('cp1252'))
+            result = process_documents.process_document(document, "team/notes.txt")
+            leftovers = os.listdir(scratch)
+        finally:
+            tempfile.tempdir = original_tempdir
+            for name, value in original.items():
+                setattr(process_documents, name, value)
+
+    protected = uploads.get("team/protected_notes.txt.md", b"")
+    status = "✓" if result and b"Caf\xc3\xa9" in protected and b"jane.doe" not in protected else "✗"
+    print(f"  {status} protected markdown uploaded from memory ({len(protected)} bytes)")
+    assert result and b"Caf\xc3\xa9" in protected and b"jane.doe" not in protected
+    assert uploads["openwebui:team/protected_notes.txt.md"] == protected
+    assert json.loads(uploads["team/metadata_notes.txt.json"])["pii_protection"]["email_count"] == 1
+    status = "✓" if leftovers == [] else "✗"
+    print(f"  {status} temporary files written -> {leftovers}")
+    assert leftovers == []
+
+    print()
+
+def test_blob_transfer():
+    """Test parallel block uploads and ranged downloads with MD5 verification"""
+    print("Testing blob transfer against the blob stand-in...")
+
+    original_client = process_documents.blob_service_client
+    with FakeBlobServer() as fake:
+        client = process_documents.create_blob_service_client(fake.connection_string)
+        client._config.max_single_put_size = client._config.max_block_size = 256 * 1024
+        client._config.max_single_get_size = client._config.max_chunk_get_size = 256 * 1024
+        client.create_container("processed")
+        process_documents.blob_service_client = client
+        try:
+            data = os.urandom(3 * 1024 * 1024 + 17)
+            process_documents.upload_blob_data("processed", "big/file.bin", data)
+            puts = fake.requests_by_path.get("PUT /devstoreaccount1/processed/big/file.bin", 0)
+            document = process_documents.download_document("processed", "big/file.bin")
+            status = "✓" if document.data == data and puts > 2 else "✗"
+            print(f"  {status} {len(data)} bytes round trip in {puts} upload request(s)")
+            assert document.data == data and puts > 2
+
+            spilled = process_documents.download_document("processed", "big/file.bin", spill_threshold=1024)
+            with open(spilled.path, 'rb') as f:
+                spilled_ok = f.read() == data
+            process_documents.release_document(spilled)
+            status = "✓" if spilled_ok and not os.path.exists(spilled.path) else "✗"
+            print(f"  {status} download above the spill threshold streamed to a temporary file")
+            assert spilled_ok and not os.path.exists(spilled.path)
+
+            writer = process_documents.BlobStreamWriter("processed", "streamed.md", block_size=64 * 1024)
+            text = "".join(f"line {i}\n" for i in range(100000))
+            for start in range(0, len(text), 10000):
+                writer.write(text[start:start + 10000])
+            writer.close()
+            streamed = process_documents.download_document("processed", "streamed.md")
+            status = "✓" if streamed.data == text.encode() else "✗"
+            print(f"  {status} streamed writer staged {len(writer._block_ids)} blocks in parallel")
+            assert streamed.data == text.encode()
+
+            # Corruption at rest is caught by the whole-blob MD5
+            blob = fake.get_blob("processed", "big/file.bin")
+            blob['data'] = b"X" + blob['data'][1:]
+            try:
+                process_documents.download_document("processed", "big/file.bin")
+                detected = False
+            except ValueError:
+                detected = True
+            status = "✓" if detected else "✗"
+            print(f"  {status} corrupted blob rejected by MD5 check")
+            assert detected
+        finally:
+            process_documents.blob_service_client = original_client
+
+    print()
+
+def test_async_io_engine():
+    """Test concurrent Vault reads and overlapped blob uploads on the async I/O engine"""
+    print("Testing async I/O engine...")
+
+    engine = AsyncIOEngine()
+    original = {name: getattr(process_documents, name) for name in ('io_engine', 'connection_string')}
+    kv = {f"pii-patterns/{pii_type}": {"pattern": r"\bX-\d{4}\b"} for pii_type in ('ssn', 'email')}
+    latency = 0.2
+    with MockVaultServer(latency=latency, kv=kv) as vault, FakeBlobServer(latency=latency) as fake:
+        process_documents.io_engine = engine
+        process_documents.connection_string = fake.connection_string
+        try:
+            http_async = AsyncHttpClient("test-async")
+            protector = VaultKVPIIProtector(vault.url, "test-token", http_async=http_async)
+            start = time.perf_counter()
+            patterns = protector.fetch_pii_patterns()
+            elapsed = time.perf_counter() - start
+            reads = sum(count for key, count in vault.requests_by_path.items() if "/secret/data/" in key)
+            status = "✓" if patterns['ssn'] == r"\bX-\d{4}\b" and elapsed < 2 * latency else "✗"
+            print(f"  {status} {reads} KV reads in {elapsed:.2f}s ({latency}s each)")
+            assert patterns['ssn'] == r"\bX-\d{4}\b" and patterns['phone'] == protector._fallback_patterns()['phone']
+            assert elapsed < 2 * latency
+
+            engine.run(engine.blob_service.create_container("processed"))
+            start = time.perf_counter()
+            engine.gather(
+                process_documents.upload_blob_data_async("processed", "a.md", b"first"),
+                process_documents.upload_blob_data_async("processed", "b.md", "second")
+            )
+            elapsed = time.perf_counter() - start
+            stored = (fake.get_blob("processed", "a.md")['data'], fake.get_blob("processed", "b.md")['data'])
+            status = "✓" if stored == (b"first", b"second") and elapsed < 2 * latency else "✗"
+            print(f"  {status} two blob uploads overlapped in {elapsed:.2f}s")
+            assert stored == (b"first", b"second") and elapsed < 2 * latency
+            engine.run(http_async.aclose())
+        finally:
+            engine.close()
+            for name, value in original.items():
+                setattr(process_documents, name, value)
+
+    print()
+
+def test_processing_ledger():
+    """Test stage-by-stage resume, duplicate content linking and etag recognition"""
+    print("Testing processing ledger...")
+
+    calls = {'convert': 0, 'openwebui': 0, 'added': [], 'fail_add': 1, 'fail_delete': 0, 'fail_store': 0}
+    original_delete = process_documents.delete_upload
+    original_convert = process_documents.run_conversion
+    original_store = process_documents.upload_blob_data_async
+
+    def run_conversion(document, file_name, content_hash=None):
+        calls['convert'] += 1
+        return original_convert(document, file_name, content_hash)
+
+    async def upload_file_to_openwebui_async(content, file_name):
+        calls['openwebui'] += 1
+        return f"file-{calls['openwebui']}"
+
+    async def upload_blob_data_async(container_name, blob_name, data):
+        if calls['fail_store']:
+            calls['fail_store'] -= 1
+            raise ConnectionError("processed container unavailable")
+        return await original_store(container_name, blob_name, data)
+
+    def add_file_to_knowledge_base(file_id, kb_id):
+        if calls['fail_add']:
+            calls['fail_add'] -= 1
+            return False
+        calls['added'].append((file_id, kb_id))
+        return True
+
+    def delete_upload(file_name, etag=None):
+        if calls['fail_delete']:
+            calls['fail_delete'] -= 1
+            raise ConnectionError("processor stopped before deleting")
+        original_delete(file_name, etag)
+
+    replaced = {
+        'get_conversion_pool': lambda: None,
+        'run_conversion': run_conversion,
+        'get_knowledge_base_for_file': lambda file_name: 'kb-legal' if file_name.startswith('legal/') else 'kb-team',
+        'upload_file_to_openwebui_async': upload_file_to_openwebui_async,
+        'upload_blob_data_async': upload_blob_data_async,
+        'add_file_to_knowledge_base': add_file_to_knowledge_base,
+        'delete_upload': delete_upload,
+        'vault_kv_client': None,
+        'conversion_cache': None,
+        'io_engine': AsyncIOEngine(),
+        'processing_ledger': process_documents.ProcessingLedger("ledger"),
+        'work_claims': process_documents.BlobWorkClaims("locks"),
+        'RETRY_BACKOFF_BASE': 0
+    }
+    original = {name: getattr(process_documents, name) for name in list(replaced) + ['blob_service_client', 'connection_string']}
+    with FakeBlobServer() as fake:
+        for container in ("uploads", "processed", "locks"):
+            fake.containers[container] = {}
+        process_documents.blob_service_client = process_documents.create_blob_service_client(fake.connection_string)
+        process_documents.connection_string = fake.connection_string
+        for name, value in replaced.items():
+            setattr(process_documents, name, value)
+        ledger = process_documents.processing_ledger
+        handler = process_documents.VirtualFileHandler(process_documents.blob_service_client)
+        content = b"Contact jane.doe@example.com about the renewal."
+
+        def upload(name):
+            blob = fake.put_blob("uploads", name, content)
+            return PendingBlob(name, len(content), blob['etag'])
+
+        try:
+            ledger.ensure_container()
+            pending = upload("team/renewal.txt")
+            first = process_documents.process_upload(pending, handler)
+            entry = ledger.get(process_documents.document_sha256(DocumentInput("renewal.txt", data=content)))
+            status = "✓" if not first and list(entry['stages']) == ['stored', 'uploaded'] else "✗"
+            print(f"  {status} interrupted at knowledge base add -> ledger has {list(entry['stages'])}")
+            assert not first and list(entry['stages']) == ['stored', 'uploaded']
+
+            calls['fail_delete'] = 1
+            second = process_documents.process_upload(pending, handler)
+            status = "✓" if calls['convert'] == 1 and calls['openwebui'] == 1 and calls['added'] == [('file-1', 'kb-team')] else "✗"
+            print(f"  {status} resumed without reconverting: {calls['convert']} conversion, {calls['openwebui']} OpenWebUI upload")
+            assert not second and calls['convert'] == 1 and calls['openwebui'] == 1 and calls['added'] == [('file-1', 'kb-team')]
+
+            downloads = fake.requests_by_path.get("GET /devstoreaccount1/uploads/team/renewal.txt", 0)
+            third = process_documents.process_upload(pending, handler)
+            status = "✓" if third and fake.get_blob("uploads", "team/renewal.txt") is None else "✗"
+            print(f"  {status} completed upload recognised by etag and removed without downloading")
+            assert third and fake.get_blob("uploads", "team/renewal.txt") is None
+            assert fake.requests_by_path.get("GET /devstoreaccount1/uploads/team/renewal.txt", 0) == downloads
+
+            same = process_documents.process_upload(upload("team/renewal.txt"), handler)
+            linked = process_documents.process_upload(upload("legal/renewal-copy.txt"), handler)
+            copy = fake.get_blob("processed", "legal/protected_renewal-copy.txt.md")
+            metadata = json.loads(fake.get_blob("processed", "legal/metadata_renewal-copy.txt.json")['data'])
+            status = "✓" if same and linked and calls['convert'] == 1 and calls['openwebui'] == 1 else "✗"
+            print(f"  {status} re-upload skipped, copy under a new name linked to file-1 in {metadata['knowledge_base_id']}")
+            assert same and linked and calls['convert'] == 1 and calls['openwebui'] == 1
+            assert calls['added'] == [('file-1', 'kb-team'), ('file-1', 'kb-legal')]
+            assert copy['data'] == fake.get_blob("processed", "team/protected_renewal.txt.md")['data']
+            assert metadata['duplicate_of'] == "team/renewal.txt" and metadata['openwebui_file_id'] == "file-1"
+
+            # OpenWebUI accepted the file but storing the protected copy failed: the file id is
+            # kept, so the retry stores the copy without uploading to OpenWebUI again
+            calls['fail_store'] = 1
+            uploads_before = calls['openwebui']
+            minutes = fake.put_blob("uploads", "team/minutes.txt", b"Minutes for john@example.com")
+            pending = PendingBlob("team/minutes.txt", 28, minutes['etag'])
+            failed = process_documents.process_upload(pending, handler)
+            retried = process_documents.process_upload(pending, handler)
+            ok = not failed and retried and calls['openwebui'] == uploads_before + 1
+            ok = ok and fake.get_blob("processed", "team/protected_minutes.txt.md") is not None
+            status = "✓" if ok else "✗"
+            print(f"  {status} failed store keeps the OpenWebUI file id: {calls['openwebui'] - uploads_before} upload across the retry")
+            assert ok
+
+            # Two replicas recording stages of one entry, and a third creating it again
+            other = process_documents.ProcessingLedger("ledger")
+            ours = ledger.new_entry("c" * 64, "team/shared.txt")
+            ledger.record(ours, 'stored', protected_markdown="team/protected_shared.txt.md")
+            theirs = other.get("c" * 64)
+            other.record(theirs, 'uploaded', file_id="file-9")
+            ledger.record(ours, 'added', knowledge_base_id="kb-team")
+            late = other.new_entry("c" * 64, "team/shared.txt")
+            late['duplicates'].append("legal/shared.txt")
+            other.save(late)
+            stored = ledger.get("c" * 64)
+            status = "✓" if sorted(stored['stages']) == ['added', 'stored', 'uploaded'] and stored['duplicates'] == ["legal/shared.txt"] else "✗"
+            print(f"  {status} concurrent ledger writes merged instead of overwritten: {sorted(stored['stages'])}")
+            assert sorted(stored['stages']) == ['added', 'stored', 'uploaded'] and stored['duplicates'] == ["legal/shared.txt"]
+            assert stored['stages']['uploaded']['file_id'] == "file-9"
+            status = "✓" if not ledger._locks else "✗"
+            print(f"  {status} per-content locks dropped after use")
+            assert not ledger._locks
+        finally:
+            process_documents.io_engine.close()
+            for name, value in original.items():
+                setattr(process_documents, name, value)
+
+    print()
+
+def test_conversion_cache():
+    """Test cache hits for identical content, option-aware keys and LRU eviction"""
+    print("Testing conversion cache...")
+
+    conversions = []
+
+    def convert_document(document, file_name):
+        conversions.append(file_name)
+        return process_documents.read_document_bytes(document).decode('utf-8') * 4
+
+    original = {name: getattr(process_documents, name) for name in
+                ('_convert_document', 'conversion_cache', 'DOCLING_DO_OCR', 'PII_STREAMING_THRESHOLD')}
+    with tempfile.TemporaryDirectory() as directory:
+        cache = process_documents.ConversionCache(directory, max_bytes=1024)
+        process_documents._convert_document = convert_document
+        process_documents.conversion_cache = cache
+        try:
+            policy = DocumentInput("policy.pdf", data=b"Same policy text. ")
+            first = process_documents.run_conversion(policy, "team/policy.pdf")
+            second = process_documents.run_conversion(policy, "legal/policy.pdf")
+            status = "✓" if first == second and conversions == ["team/policy.pdf"] else "✗"
+            print(f"  {status} identical content in two directories -> {len(conversions)} conversion")
+            assert first == second and conversions == ["team/policy.pdf"]
+
+            process_documents.DOCLING_DO_OCR = not process_documents.DOCLING_DO_OCR
+            process_documents.run_conversion(policy, "team/policy.pdf")
+            status = "✓" if len(conversions) == 2 else "✗"
+            print(f"  {status} changed pipeline options -> cache miss")
+            assert len(conversions) == 2
+
+            process_documents.PII_STREAMING_THRESHOLD = 16
+            spilled = process_documents.run_conversion(policy, "hr/policy.pdf")
+            with open(spilled.path, encoding='utf-8') as f:
+                spilled_ok = f.read() == first and spilled.length == len(first)
+            process_documents.release_markdown(spilled)
+            status = "✓" if spilled_ok and len(conversions) == 2 else "✗"
+            print(f"  {status} large cached markdown returned as a releasable spilled copy")
+            assert spilled_ok and len(conversions) == 2
+
+            for i in range(20):
+                process_documents.run_conversion(DocumentInput(f"doc{i}.pdf", data=f"Document {i} ".encode() * 4), f"doc{i}.pdf")
+            stats = cache.stats()
+            on_disk = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+            status = "✓" if stats['evictions'] > 0 and on_disk <= 1024 else "✗"
+            print(f"  {status} {stats['evictions']} LRU evictions keep {on_disk} bytes on disk, hit rate {stats['hit_rate']}")
+            assert stats['evictions'] > 0 and on_disk <= 1024 and stats['hits'] == 2
+
+            reloaded = process_documents.ConversionCache(directory, max_bytes=1024)
+            assert reloaded.stats()['entries'] == stats['entries']
+
+            short_lived = process_documents.ConversionCache(os.path.join(directory, "short"), max_age=0.2)
+            short_lived.put("k", "# unredacted")
+            time.sleep(0.3)
+            expired = short_lived.get("k") is None and not os.listdir(short_lived.directory)
+            private = os.stat(short_lived.directory).st_mode & 0o077 == 0
+            status = "✓" if expired and private else "✗"
+            print(f"  {status} entries unused for max_age removed; directory readable by the processor only")
+            assert expired and private
+            if os.getenv('CONVERSION_CACHE_ENABLED') is None:
+                assert process_documents.CONVERSION_CACHE_ENABLED is False
+        finally:
+            for name, value in original.items():
+                setattr(process_documents, name, value)
+
+    print()
+
+def test_docling_serve_backend():
+    """Test remote conversion with a concurrency limit, task polling and local fallback"""
+    print("Testing docling-serve conversion backend...")
+
+    original = {name: getattr(process_documents, name) for name in
+                ('docling_serve', 'get_conversion_pool', 'conversion_cache', 'DOCLING_SERVE_FALLBACK', 'pipeline_health',
+                 'work_claims', 'upload_exists', '_process_upload')}
+    with FakeDoclingServe(conversion_time=0.2) as docling:
+        client = process_documents.DoclingServeClient(docling.url, max_concurrency=2, poll_wait=0.05)
+        process_documents.docling_serve = client
+        process_documents.get_conversion_pool = lambda: None
+        try:
+            results = {}
+            documents = [DocumentInput(f"report{i}.pdf", data=f"Report {i}".encode()) for i in range(6)]
+            workers = [threading.Thread(target=lambda d=d: results.__setitem__(d.name, process_documents._convert_document(d, f"team/{d.name}")))
+                       for d in documents]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            converted = all(results[d.name] == f"# {d.name}\n\n{d.data.decode()}" for d in documents)
+            status = "✓" if converted and docling.max_in_flight == 2 else "✗"
+            print(f"  {status} 6 documents converted remotely, at most {docling.max_in_flight} in flight")
+            assert converted and docling.max_in_flight == 2
+            assert docling.last_options == {'to_formats': 'md', 'do_ocr': str(process_documents.DOCLING_DO_OCR).lower(),
+                                            'do_table_structure': str(process_documents.DOCLING_DO_TABLE_STRUCTURE).lower()}
+
+            client.version_ttl = 0.1
+            before = client.version()
+            docling.versions = {"docling-serve": "fake", "docling": "2.44.0"}
+            cached = client.version()
+            time.sleep(0.15)
+            after = client.version()
+            ok = before == cached and "docling=2.43.0" in before and "docling=2.44.0" in after
+            status = "✓" if ok else "✗"
+            print(f"  {status} docling-serve version reused, then refetched after its TTL: {after}")
+            assert ok
+
+            docling.fail_tasks = 1
+            markdown = process_documents._convert_document(DocumentInput("notes.txt", data=b"plain notes"), "notes.txt")
+            status = "✓" if markdown and "plain notes" in markdown and client.breaker.failures == 0 else "✗"
+            print(f"  {status} failed remote task -> converted locally instead, breaker untouched by a bad document")
+            assert markdown and "plain notes" in markdown and client.breaker.failures == 0
+
+            # Markdown from the local fallback is cached as local output, not as docling-serve's
+            with tempfile.TemporaryDirectory() as directory:
+                cache = process_documents.ConversionCache(directory)
+                process_documents.conversion_cache = cache
+                scan = DocumentInput("scan.pdf", data=b"scanned text")
+                docling.fail_tasks = 1
+                process_documents.run_conversion(scan, "scan.pdf")
+                content_hash = process_documents.document_sha256(scan)
+                ok = cache.get(cache.key(content_hash, 'local')) is not None and cache.get(cache.key(content_hash)) is None
+                status = "✓" if ok else "✗"
+                print(f"  {status} fallback conversion cached under the local backend's key")
+                assert ok
+
+            # docling-serve without a URL: not ready, and uploads that need Docling stay unclaimed
+            processed = []
+            process_documents.docling_serve = process_documents.DoclingServeClient("")
+            process_documents.DOCLING_SERVE_FALLBACK = False
+            process_documents.pipeline_health = process_documents.PipelineHealth(
+                probes={'converter': (process_documents._probe_converter, True)})
+            process_documents.work_claims = process_documents.LocalWorkClaims()
+            process_documents.upload_exists = lambda file_name: True
+            process_documents._process_upload = lambda blob, handler: processed.append(blob.name) or True
+            waiting = process_documents.process_upload(PendingBlob("team/scan.pdf", 10), None)
+            process_documents.process_upload(PendingBlob("team/notes.txt", 10), None)
+            checks = process_documents.pipeline_health.readiness()[1]['checks']
+            ok = not waiting and processed == ["team/notes.txt"] and checks['converter']['error'] == "DOCLING_SERVE_URL is not set"
+            status = "✓" if ok else "✗"
+            print(f"  {status} unset DOCLING_SERVE_URL fails readiness; PDFs wait unclaimed, text still processed")
+            assert ok
+        finally:
+            for name, value in original.items():
+                setattr(process_documents, name, value)
+
+    print()
+
+def test_format_router():
+    """Test that text formats skip Docling and binary content is still sent to it"""
+    print("Testing format router...")
+
+    router = process_documents.FormatRouter()
+    cases = [
+        (DocumentInput("notes.txt", data=b"Meeting notes"), "team/notes.txt", "text"),
+        (DocumentInput("claims.json", data=b'{"claim": 1}'), "claims.json", "json"),
+        (DocumentInput("report.pdf", data=b"%PDF-1.7 ..."), "report.pdf", "docling"),
+        (DocumentInput("scan.txt", data=b"%PDF-1.4 mislabeled"), "scan.txt", "docling"),
+        (DocumentInput("README", data=b"# Title", content_type="text/markdown"), "README", "text"),
+        (DocumentInput("export.dat", data="Caf\u00e9 export".encode()), "export.dat", "text"),
+        (DocumentInput("export.bin", data=b"\x00\x01\x02binary"), "export.bin", "docling"),
+    ]
+    routes = [router.route(document, file_name) for document, file_name, _ in cases]
+    expected = [route for _, _, route in cases]
+    status = "✓" if routes == expected else "✗"
+    print(f"  {status} routes by extension, magic bytes and content type -> {routes}")
+    assert routes == expected
+
+    docling_calls = []
+    original = {name: getattr(process_documents, name) for name in
+                ('_convert_with_docling', 'format_router', 'conversion_cache', 'PII_STREAMING_THRESHOLD')}
+
+    def convert_with_docling(document, file_name):
+        docling_calls.append(file_name)
+        time.sleep(0.05)
+        return f"# {file_name}"
+
+    process_documents._convert_with_docling = convert_with_docling
+    process_documents.format_router = router
+    process_documents.conversion_cache = None
+    try:
+        process_documents.run_conversion(cases[2][0], "report.pdf")
+        markdown = process_documents.run_conversion(cases[0][0], "team/notes.txt")
+        stats = router.stats()
+        status = "✓" if docling_calls == ["report.pdf"] and markdown == "# team/notes.txt\n\nMeeting notes" else "✗"
+        print(f"  {status} text converted without Docling, ~{stats['estimated_saved_seconds']}s saved per {stats['routes']}")
+        assert docling_calls == ["report.pdf"] and markdown == "# team/notes.txt\n\nMeeting notes"
+        assert stats['routes'] == {'docling': 1, 'text': 1} and stats['estimated_saved_seconds'] > 0
+
+        # Above the threshold, text is decoded chunk by chunk into a spilled file
+        process_documents.PII_STREAMING_THRESHOLD = 16
+        utf8 = "Caf\u00e9 \u20ac " * 300000  # Multi-byte characters across chunk boundaries
+        cp1252 = "Caf\u00e9 \u20ac " * 10
+        results = []
+        for name, data, kind in (("menu.txt", utf8.encode('utf-8'), 'text'), ("prices.json", cp1252.encode('cp1252'), 'json')):
+            spilled = process_documents.run_conversion(DocumentInput(name, data=data), name)
+            with open(spilled.path, encoding='utf-8') as f:
+                results.append((f.read(), spilled.length))
+            process_documents.release_markdown(spilled)
+        expected = [f"# menu.txt\n\n{utf8}", f"# prices.json\n\n## Content\n\n```json\n{cp1252}\n```\n\n*Converted from JSON format*"]
+        status = "✓" if [text for text, _ in results] == expected and all(len(text) == length for text, length in results) else "✗"
+        print(f"  {status} large UTF-8 and cp1252 text decoded incrementally into spilled markdown")
+        assert [text for text, _ in results] == expected and all(len(text) == length for text, length in results)
+    finally:
+        for name, value in original.items():
+            setattr(process_documents, name, value)
+
+    print()
+
+def test_upload_scheduler():
+    """Test scheduling policies and that small text files are not stuck behind heavy ones"""
+    print("Testing upload scheduler...")
+
+    from datetime import datetime, timezone
+    from process_documents import UploadScheduler
+
+    def run(policy, blobs, delays=None):
+        order = []
+        finished = threading.Event()
+        def handler(blob):
+            time.sleep((delays or {}).get(blob.name, 0))
+            order.append(blob.name)
+        scheduler = UploadScheduler(handler, policy=policy, light_workers=1, heavy_workers=1, on_idle=finished.set)
+        for blob in blobs:
+            scheduler.submit(blob)
+        duplicate = scheduler.submit(blobs[0])
+        scheduler.start()
+        finished.wait(timeout=5)
+        scheduler.stop()
+        return order, duplicate
+
+    heavy = [PendingBlob("a/large.pdf", 90000), PendingBlob("a/small.pdf", 2000), PendingBlob("a/medium.pdf", 40000)]
+    order, duplicate = run("sjf", heavy)
+    status = "✓" if order == ["a/small.pdf", "a/medium.pdf", "a/large.pdf"] and duplicate is False else "✗"
+    print(f"  {status} sjf runs smallest first, duplicates ignored -> {order}")
+    assert order == ["a/small.pdf", "a/medium.pdf", "a/large.pdf"] and duplicate is False
+
+    dated = [PendingBlob(f"a/{i}.pdf", 5000, None, datetime(2024, 1, day, tzinfo=timezone.utc))
+             for i, day in enumerate([3, 1, 2])]
+    order, _ = run("fifo", dated)
+    status = "✓" if order == ["a/1.pdf", "a/2.pdf", "a/0.pdf"] else "✗"
+    print(f"  {status} fifo runs oldest first -> {order}")
+    assert order == ["a/1.pdf", "a/2.pdf", "a/0.pdf"]
+
+    shared = [PendingBlob(f"hr/{i}.pdf", 5000 + i) for i in range(3)] + [PendingBlob("legal/0.pdf", 9000)]
+    order, _ = run("fair", shared)
+    status = "✓" if order[:2] in (["hr/0.pdf", "legal/0.pdf"], ["legal/0.pdf", "hr/0.pdf"]) else "✗"
+    print(f"  {status} fair share alternates knowledge bases -> {order}")
+    assert order[:2] in (["hr/0.pdf", "legal/0.pdf"], ["legal/0.pdf", "hr/0.pdf"])
+
+    mixed = [PendingBlob("a/scan.pdf", 80000), PendingBlob("a/notes.txt", 80000), PendingBlob("a/memo.pdf", 90000)]
+    order, _ = run("sjf", mixed, delays={"a/scan.pdf": 0.3})
+    status = "✓" if order == ["a/notes.txt", "a/scan.pdf", "a/memo.pdf"] else "✗"
+    print(f"  {status} light lane finishes while a heavy file converts -> {order}")
+    assert order == ["a/notes.txt", "a/scan.pdf", "a/memo.pdf"]
+
+    lanes = [UploadScheduler.lane_for(blob) for blob in
+             (PendingBlob("a/tiny.pdf", 500), PendingBlob("a/big.json", 10 ** 8), PendingBlob("a/README", 100))]
+    status = "✓" if lanes == ["heavy", "light", "heavy"] else "✗"
+    print(f"  {status} only fast-path formats use the light lane, whatever their size -> {lanes}")
+    assert lanes == ["heavy", "light", "heavy"]
+
+    print()
+
+def test_work_claims():
+    """Test that replicas claim each upload once and a crashed replica's claim expires"""
+    print("Testing work claims...")
+
+    original = {name: getattr(process_documents, name) for name in ('blob_service_client', '_process_upload', 'work_claims')}
+    with FakeBlobServer() as fake:
+        fake.containers["uploads"] = {}
+        process_documents.blob_service_client = process_documents.create_blob_service_client(fake.connection_string)
+        replica_a = process_documents.BlobWorkClaims("locks", lease_duration=1)
+        replica_b = process_documents.BlobWorkClaims("locks", lease_duration=1)
+        try:
+            replica_a.ensure_container()
+            replica_b.ensure_container()
+            claim = replica_a.claim("team/contract.pdf")
+            time.sleep(1.5)  # Past the lease duration: only renewal keeps the claim
+            rival = replica_b.claim("team/contract.pdf")
+            status = "✓" if claim and not claim.lost and rival is None else "✗"
+            print(f"  {status} renewed claim held across the lease duration, second replica refused")
+            assert claim and not claim.lost and rival is None
+
+            claim.release()
+            taken_over = replica_b.claim("team/contract.pdf")
+            status = "✓" if taken_over else "✗"
+            print(f"  {status} released claim taken by the other replica")
+            assert taken_over
+            taken_over.release(done=True)
+            assert fake.get_blob("locks", "team/contract.pdf") is None
+
+            # A crashed replica stops renewing; its lease runs out and the upload is claimed again
+            replica_a.container.upload_blob("team/scan.pdf", b"")
+            replica_a.container.get_blob_client("team/scan.pdf").acquire_lease(lease_duration=1)
+            refused = replica_b.claim("team/scan.pdf")
+            time.sleep(1.2)
+            recovered = replica_b.claim("team/scan.pdf")
+            status = "✓" if refused is None and recovered else "✗"
+            print(f"  {status} crashed replica's claim expired and was recovered")
+            assert refused is None and recovered
+            recovered.release(done=True)
+
+            # Workers racing on the same listing process each upload exactly once; claims go
+            # through the blob leases, so this is the same race two replicas would have
+            processed = []
+            def process_upload(blob, virtual_handler):
+                processed.append(blob.name)
+                time.sleep(0.1)
+                fake.containers["uploads"].pop(blob.name)
+                return True
+            process_documents._process_upload = process_upload
+            process_documents.work_claims = replica_a
+            names = [f"team/file-{i}.pdf" for i in range(6)]
+            for name in names:
+                fake.put_blob("uploads", name, b"%PDF")
+            def worker():
+                for name in names:
+                    process_documents.process_upload(PendingBlob(name), None)
+            threads = [threading.Thread(target=worker) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            status = "✓" if sorted(processed) == names and not fake.containers["locks"] else "✗"
+            print(f"  {status} {len(names)} uploads processed once by three racing workers, locks removed")
+            assert sorted(processed) == names and not fake.containers["locks"]
+
+            # A worker whose claim lapsed stops before deleting, and records no failure
+            def process_upload(blob, virtual_handler):
+                process_documents._current_claim.claim.lost = True
+                process_documents.delete_upload(blob.name, blob.etag)
+                return True
+            process_documents._process_upload = process_upload
+            blob = fake.put_blob("uploads", "team/lapsed.pdf", b"%PDF")
+            result = process_documents.process_upload(PendingBlob("team/lapsed.pdf", 4, blob['etag']), None)
+            lock = fake.get_blob("locks", "team/lapsed.pdf")
+            status = "✓" if not result and fake.get_blob("uploads", "team/lapsed.pdf") and "attempts" not in lock['metadata'] else "✗"
+            print(f"  {status} lost claim: upload kept for the replica that holds it now")
+            assert not result and fake.get_blob("uploads", "team/lapsed.pdf") and "attempts" not in lock['metadata']
+
+            # The delete is conditional on the processed version
+            stale_etag = blob['etag']
+            fake.put_blob("uploads", "team/lapsed.pdf", b"%PDF re-uploaded")
+            try:
+                process_documents.delete_upload("team/lapsed.pdf", stale_etag)
+                kept = False
+            except Exception:
+                kept = fake.get_blob("uploads", "team/lapsed.pdf") is not None
+            status = "✓" if kept else "✗"
+            print(f"  {status} re-uploaded file not deleted by the worker that processed the old version")
+            assert kept
+
+            # Only retries still pending are remembered
+            now = time.time()
+            for i in range(3):
+                replica_a._remember_retry(f"team/old-{i}.pdf", process_documents.AttemptRecord(1, now - 1))
+            replica_a._remember_retry("team/due-later.pdf", process_documents.AttemptRecord(1, now + 60))
+            status = "✓" if list(replica_a._retry_at) == ["team/due-later.pdf"] else "✗"
+            print(f"  {status} past retry times dropped: {sorted(replica_a._retry_at)}")
+            assert list(replica_a._retry_at) == ["team/due-later.pdf"]
+        finally:
+            for name, value in original.items():
+                setattr(process_documents, name, value)
+
+    print()
+
+def test_dead_letter():
+    """Test retry backoff, dead-lettering after the last attempt and the reset on re-upload"""
+    print("Testing bounded retries and dead-letter container...")
+
+    attempts = []
+    def process_upload(blob, virtual_handler):
+        attempts.append(blob.name)
+        if blob.name.startswith("outage/"):
+            raise process_documents.DependencyError("Failed to upload file to OpenWebUI. Status code: 503", 503)
+        if blob.name.startswith("rejected/"):
+            raise process_documents.DependencyError("Failed to upload file to OpenWebUI. Status code: 413", 413)
+        if blob.name.startswith("crash/"):
+            raise KeyError("md_content")
+        process_documents.logger.error(f"Error converting {blob.name}: broken xref table")
+        process_documents.failure_reasons.mark_document_failure()
+        return False
+
+    replaced = {
+        '_process_upload': process_upload,
+        'work_claims': process_documents.BlobWorkClaims("locks"),
+        'MAX_ATTEMPTS': 3,
+        'RETRY_BACKOFF_BASE': 0.2,
+        'RETRY_BACKOFF_MAX': 0.4
+    }
+    original = {name: getattr(process_documents, name) for name in list(replaced) + ['blob_service_client']}
+    with FakeBlobServer() as fake:
+        for container in ("uploads", "locks", "failed"):
+            fake.containers[container] = {}
+        process_documents.blob_service_client = process_documents.create_blob_service_client(fake.connection_string)
+        for name, value in replaced.items():
+            setattr(process_documents, name, value)
+        try:
+            blob = fake.put_blob("uploads", "team/poison.pdf", b"%PDF-1.7 broken")
+            pending = PendingBlob("team/poison.pdf", 15, blob['etag'])
+            process_documents.process_upload(pending, None)
+            process_documents.process_upload(pending, None)  # Not due yet
+            lock = fake.get_blob("locks", "team/poison.pdf")
+            status = "✓" if len(attempts) == 1 and lock['metadata']['attempts'] == "1" else "✗"
+            print(f"  {status} failure recorded in the lock blob: {lock['metadata']}")
+            assert len(attempts) == 1 and lock['metadata']['attempts'] == "1"
+            assert "broken xref table" in lock['metadata']['error']
+
+            time.sleep(0.25)
+            process_documents.process_upload(pending, None)
+            time.sleep(0.45)
+            process_documents.process_upload(pending, None)
+            failed = fake.get_blob("failed", "team/poison.pdf")
+            status = "✓" if len(attempts) == 3 and failed and fake.get_blob("uploads", "team/poison.pdf") is None else "✗"
+            print(f"  {status} moved to the dead-letter container after {len(attempts)} attempts")
+            assert len(attempts) == 3 and failed and fake.get_blob("uploads", "team/poison.pdf") is None
+            assert failed['data'] == b"%PDF-1.7 broken" and failed['metadata']['attempts'] == "3"
+            assert "broken xref table" in failed['metadata']['error'] and not fake.containers["locks"]
+
+            blob = fake.put_blob("uploads", "team/draft.pdf", b"%PDF-1.7 draft")
+            process_documents.process_upload(PendingBlob("team/draft.pdf", 14, blob['etag']), None)
+            blob = fake.put_blob("uploads", "team/draft.pdf", b"%PDF-1.7 fixed draft")
+            process_documents.process_upload(PendingBlob("team/draft.pdf", 20, blob['etag']), None)
+            lock = fake.get_blob("locks", "team/draft.pdf")
+            status = "✓" if attempts[-2:] == ["team/draft.pdf"] * 2 and lock['metadata']['attempts'] == "1" else "✗"
+            print(f"  {status} re-uploaded file retried at once with a fresh attempt count")
+            assert attempts[-2:] == ["team/draft.pdf"] * 2 and lock['metadata']['attempts'] == "1"
+
+            blob = fake.put_blob("uploads", "outage/report.pdf", b"%PDF-1.7 fine")
+            pending = PendingBlob("outage/report.pdf", 13, blob['etag'])
+            process_documents.process_upload(pending, None)
+            process_documents.process_upload(pending, None)  # Not due yet
+            time.sleep(0.25)
+            process_documents.process_upload(pending, None)
+            lock = fake.get_blob("locks", "outage/report.pdf")
+            wait = float(lock['metadata']['retry_at']) - time.time()
+            status = "✓" if attempts.count("outage/report.pdf") == 2 and lock['metadata']['deferrals'] == "2" and wait > 0.3 else "✗"
+            print(f"  {status} deferred retries back off: deferral {lock['metadata']['deferrals']} waits {wait:.2f}s")
+            assert attempts.count("outage/report.pdf") == 2 and lock['metadata']['deferrals'] == "2" and wait > 0.3
+            time.sleep(0.45)
+            process_documents.process_upload(pending, None)
+            lock = fake.get_blob("locks", "outage/report.pdf")
+            retried = attempts.count("outage/report.pdf")
+            ok = retried == 3 and lock['metadata']['attempts'] == "0" and fake.get_blob("uploads", "outage/report.pdf")
+            status = "✓" if ok else "✗"
+            print(f"  {status} dependency failures retried {retried} times without using up attempts or dead-lettering")
+            assert ok and "503" in lock['metadata']['error']
+
+            blob = fake.put_blob("uploads", "rejected/huge.pdf", b"%PDF-1.7 huge")
+            process_documents.process_upload(PendingBlob("rejected/huge.pdf", 13, blob['etag']), None)
+            lock = fake.get_blob("locks", "rejected/huge.pdf")
+            status = "✓" if lock['metadata']['attempts'] == "1" and "413" in lock['metadata']['error'] else "✗"
+            print(f"  {status} a 4xx for the document counts as a failed attempt: {lock['metadata']['error']}")
+            assert lock['metadata']['attempts'] == "1" and "413" in lock['metadata']['error']
+
+            blob = fake.put_blob("uploads", "crash/report.pdf", b"%PDF-1.7 odd")
+            pending = PendingBlob("crash/report.pdf", 12, blob['etag'])
+            for pause in (0.25, 0.45, 0):
+                process_documents.process_upload(pending, None)
+                time.sleep(pause)
+            failed = fake.get_blob("failed", "crash/report.pdf")
+            status = "✓" if attempts.count("crash/report.pdf") == 3 and failed and "md_content" in failed['metadata']['error'] else "✗"
+            print(f"  {status} unhandled errors count as attempts and dead-letter the upload")
+            assert attempts.count("crash/report.pdf") == 3 and failed and "md_content" in failed['metadata']['error']
+        finally:
+            for name, value in original.items():
+                setattr(process_documents, name, value)
+
+    print()
+
+def test_metrics():
+    """Test the metrics registry, stage instrumentation and the /metrics endpoint"""
+    print("Testing metrics...")
+
+    import health_server
+    import urllib.request
+
+    registry = process_documents.MetricsRegistry(prefix="test")
+    latency = registry.histogram("stage_seconds", "Stage latency", (0.1, 1))
+    for seconds in (0.05, 0.5, 5):
+        latency.observe(seconds, stage="convert")
+    registry.counter("documents_total", "Documents").inc(result="processed")
+    registry.collect("queue_depth", "Queue depth", lambda: [({"lane": "light"}, 3)])
+    text = registry.render()
+    expected = [
+        'test_stage_seconds_bucket{stage="convert",le="0.1"} 1',
+        'test_stage_seconds_bucket{stage="convert",le="1"} 2',
+        'test_stage_seconds_bucket{stage="convert",le="+Inf"} 3',
+        'test_stage_seconds_sum{stage="convert"} 5.55',
+        'test_documents_total{result="processed"} 1',
+        'test_queue_depth{lane="light"} 3',
+        '# TYPE test_stage_seconds histogram',
+    ]
+    missing = [line for line in expected if line not in text.splitlines()]
+    status = "✓" if not missing else "✗"
+    print(f"  {status} histogram, counter and collected gauge rendered in the Prometheus format")
+    assert not missing, missing
+
+    original_client = process_documents.blob_service_client
+    with FakeBlobServer() as fake:
+        process_documents.blob_service_client = process_documents.create_blob_service_client(fake.connection_string)
+        fake.containers["processed"] = {}
+        httpd = health_server.start_health_server(0)
+        try:
+            before = process_documents.stage_seconds.summary()
+            process_documents.upload_blob_data("processed", "team/a.md", b"# a")
+            process_documents.download_document("processed", "team/a.md")
+            after = process_documents.stage_seconds.summary()
+            counts = {stage: after[(("stage", stage),)][0] - before.get((("stage", stage),), (0, 0))[0]
+                      for stage in ("blob_upload", "download")}
+            status = "✓" if counts == {"blob_upload": 1, "download": 1} else "✗"
+            print(f"  {status} pipeline stages observed: {counts}")
+            assert counts == {"blob_upload": 1, "download": 1}
+
+            with urllib.request.urlopen(f"http://127.0.0.1:{httpd.server_address[1]}/metrics", timeout=5) as response:
+                body = response.read().decode()
+                content_type = response.headers["Content-Type"]
+            scraped = 'file_processor_stage_seconds_count{stage="download"}' in body and "file_processor_memory_rss_bytes" in body
+            status = "✓" if scraped and content_type.startswith("text/plain") else "✗"
+            print(f"  {status} /metrics served with stage latencies and RSS ({len(body)} bytes)")
+            assert scraped and content_type.startswith("text/plain")
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            process_documents.blob_service_client = original_client
+
+    print()
+
+def test_pipeline_health():
+    """Test liveness, cached dependency probes and the readiness endpoint"""
+    print("Testing liveness and readiness...")
+
+    import health_server
+    import urllib.error
+    import urllib.request
+
+    calls = {"openwebui": 0, "vault": 0}
+    state = {"openwebui": True, "vault": False}
+    def probe(name):
+        def check():
+            calls[name] += 1
+            if not state[name]:
+                raise ConnectionError(f"{name} unreachable")
+            return True
+        return check
+
+    health = process_documents.PipelineHealth(heartbeat_timeout=10, probe_ttl=60, probes={
+        "openwebui": (probe("openwebui"), True),
+        "vault": (probe("vault"), False)
+    })
+    scheduler = process_documents.UploadScheduler(lambda blob: None, light_workers=1, heavy_workers=1).start()
+    health.scheduler = scheduler
+    try:
+        starting = health.liveness()[0] and not health.readiness()[0]
+        health.heartbeat()
+        ready, details = health.readiness()
+        health.readiness()
+        status = "✓" if starting and ready and calls == {"openwebui": 1, "vault": 1} else "✗"
+        print(f"  {status} live while starting, ready with Vault down (non-critical), probes cached: {calls}")
+        assert starting and ready and calls == {"openwebui": 1, "vault": 1}
+        assert details["checks"]["vault"]["ok"] is False and details["workers"]["workers_alive"] == 2
+
+        state["openwebui"] = False
+        health.probe_ttl = 0
+        not_ready = not health.readiness()[0]
+        health.last_heartbeat = time.time() - 30
+        dead = not health.liveness()[0]
+        status = "✓" if not_ready and dead else "✗"
+        print(f"  {status} not ready without OpenWebUI, not live with a stale loop heartbeat")
+        assert not_ready and dead
+
+        original = health_server.pipeline_health
+        health_server.pipeline_health = health
+        httpd = health_server.start_health_server(0)
+        try:
+            url = f"http://127.0.0.1:{httpd.server_address[1]}"
+            codes = {}
+            for path in ("/health", "/health/live", "/health/ready"):
+                try:
+                    with urllib.request.urlopen(url + path, timeout=5) as response:
+                        codes[path] = response.status
+                except urllib.error.HTTPError as e:
+                    codes[path] = e.code
+                    if path == "/health/ready":
+                        body = json.loads(e.read())
+            status = "✓" if set(codes.values()) == {503} and body["checks"]["openwebui"]["error"] else "✗"
+            print(f"  {status} endpoints report failure to the orchestrator: {codes}")
+            assert set(codes.values()) == {503} and body["checks"]["openwebui"]["error"] == "openwebui unreachable"
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            health_server.pipeline_health = original
+    finally:
+        scheduler.stop()
+
+    print()
+
+def test_health_server_comparisons():
+    """Test concurrent requests, the etag-validated comparison cache, gzip and streaming"""
+    print("Testing comparison endpoint...")
+
+    import gzip
+    import health_server
+    import urllib.error
+    import urllib.request
+
+    protected = "# Report\n\n" + "Naïve \"quoted\" text for [REDACTED_PERSON_1]\n" * 40000
+    metadata = {"pii_entities": {"PERSON": 1}}
+    original_client = process_documents.blob_service_client
+    original_cache = health_server.comparison_cache
+    with FakeBlobServer() as fake:
+        process_documents.blob_service_client = process_documents.create_blob_service_client(fake.connection_string)
+        fake.put_blob("processed", "team/protected_report.pdf.md", protected.encode())
+        fake.put_blob("processed", "team/metadata_report.pdf.json", json.dumps(metadata).encode())
+        health_server.comparison_cache = health_server.ComparisonCache(max_bytes=1024 * 1024)
+        httpd = health_server.start_health_server(0)
+        url = f"http://127.0.0.1:{httpd.server_address[1]}"
+
+        def fetch(path, headers=None):
+            request = urllib.request.Request(url + path, headers=headers or {})
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    return response.status, response.headers, response.read()
+            except urllib.error.HTTPError as e:
+                return e.code, e.headers, e.read()
+
+        try:
+            fake.latency = 0.5
+            results = {}
+            compare = threading.Thread(target=lambda: results.update(compare=fetch("/demo/compare/team%2Freport.pdf")))
+            compare.start()
+            time.sleep(0.2)
+            start = time.perf_counter()
+            health_status = fetch("/health")[0]
+            health_seconds = time.perf_counter() - start
+            compare.join()
+            fake.latency = 0.0
+            status_code, headers, body = results["compare"]
+            streamed = json.loads(body)
+            ok = health_status == 200 and health_seconds < 0.5 and status_code == 200
+            ok = ok and streamed == {"protected": protected, "metadata": metadata, "comparison_available": True}
+            status = "✓" if ok else "✗"
+            print(f"  {status} /health answered in {health_seconds * 1000:.0f} ms during a slow compare; streamed body decodes ({len(body)} bytes)")
+            assert ok and headers.get("Content-Length") is None
+
+            etag = headers["ETag"]
+            not_modified = fetch("/demo/compare/team%2Freport.pdf", {"If-None-Match": etag})[0]
+            requests_before = fake.request_count
+            status_code, headers, body = fetch("/demo/compare/team%2Freport.pdf", {"Accept-Encoding": "gzip"})
+            cached = json.loads(gzip.decompress(body))
+            gets = fake.request_count - requests_before
+            stats = health_server.comparison_cache.stats()
+            ok = not_modified == 304 and headers["Content-Encoding"] == "gzip" and cached["protected"] == protected
+            ok = ok and stats["hits"] == 1 and gets == 2 and len(body) < len(protected) // 10
+            status = "✓" if ok else "✗"
+            print(f"  {status} 304 for a matching ETag, cached gzip response served with {gets} property reads ({len(body)} bytes)")
+            assert ok, stats
+
+            encodings = {"gzip": True, "deflate, gzip;q=0.5": True, "*": True, "gzip;q=0, identity": False,
+                         "GZIP; Q=0.0": False, "*;q=0": False, "br, *;q=0.1, gzip;q=0": False, "identity": False, "": False}
+            accepted = {value: health_server.HealthHandler._accepts_gzip(SimpleNamespace(headers={"Accept-Encoding": value}))
+                        for value in encodings}
+            status = "✓" if accepted == encodings else "✗"
+            print(f"  {status} gzip only for Accept-Encoding entries without q=0")
+            assert accepted == encodings
+
+            fake.put_blob("processed", "team/protected_report.pdf.md", b"# Report\n\nRewritten")
+            status_code, headers, body = fetch("/demo/compare/team%2Freport.pdf")
+            ok = json.loads(body)["protected"] == "# Report\n\nRewritten" and headers["ETag"] != etag
+            ok = ok and health_server.comparison_cache.stats()["hits"] == 1
+            status = "✓" if ok else "✗"
+            print(f"  {status} reprocessed document invalidates the cached response")
+            assert ok
+
+            missing = json.loads(fetch("/demo/compare/team%2Fmissing.pdf")[2])
+            status = "✓" if missing == {"protected": "", "metadata": {}, "comparison_available": False} else "✗"
+            print(f"  {status} unprocessed document reported as unavailable")
+            assert missing["comparison_available"] is False
+
+            fake.put_blob("processed", "team/protected_empty.pdf.md", b"")
+            empty = json.loads(fetch("/demo/compare/team%2Fempty.pdf")[2])
+            status = "✓" if empty["comparison_available"] is False else "✗"
+            print(f"  {status} empty protected version reported as unavailable")
+            assert empty["comparison_available"] is False
+
+            original_comparison = health_server.DocumentComparison
+            def broken_comparison(filename):
+                raise ConnectionError("storage unreachable")
+            health_server.DocumentComparison = broken_comparison
+            try:
+                status_code, _, body = fetch("/demo/compare/team%2Freport.pdf")
+            finally:
+                health_server.DocumentComparison = original_comparison
+            failed = json.loads(body)
+            ok = status_code == 200 and failed["comparison_available"] is False and failed["error"] == "storage unreachable"
+            status = "✓" if ok else "✗"
+            print(f"  {status} unreadable comparison answered with 200 and an error, as before streaming")
+            assert ok
+
+            original_iter = health_server.iter_comparison_json
+            def interrupted(protected_chunks, metadata, available):
+                yield '{"protected": "'
+                raise ConnectionError("download interrupted")
+            health_server.iter_comparison_json = interrupted
+            health_server.comparison_cache = health_server.ComparisonCache(max_bytes=1024 * 1024)
+            try:
+                status_code, _, body = fetch("/demo/compare/team%2Freport.pdf")
+            finally:
+                health_server.iter_comparison_json = original_iter
+            ok = status_code == 200 and body == b'{"protected": "' and health_server.comparison_cache.stats()["entries"] == 0
+            status = "✓" if ok else "✗"
+            print(f"  {status} failure mid-stream closes the connection instead of appending a 500: {body!r}")
+            assert ok
+        finally:
+            fake.latency = 0.0
+            httpd.shutdown()
+            httpd.server_close()
+            health_server.comparison_cache = original_cache
+            process_documents.blob_service_client = original_client
+
+    print()
+
+def test_lazy_imports():
+    """Test that importing the processor loads neither Docling, the blob SDK nor any client"""
+    print("Testing lazy imports...")
+
+    import subprocess
+    probe = ("import sys, process_documents; "
+             "[process_documents.format_router.route(process_documents.DocumentInput(name, data=b'%PDF-1.4'), name) "
+             "for name in ('a.pdf', 'b.docx', 'c.bin')]; "
+             "print(sorted(m for m in ('docling', 'aiohttp', 'azure.storage.blob') if m in sys.modules)); "
+             "print(sorted(n for n in ('blob_service_client', 'vault_kv_client') if n in vars(process_documents)))")
+    output = subprocess.run([sys.executable, "-c", probe], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stdout.splitlines()
+    status = "✓" if output[-2:] == ["[]", "[]"] else "✗"
+    print(f"  {status} import and format routing load no heavy modules and create no clients: {output[-2:]}")
+    assert output[-2:] == ["[]", "[]"]
+
+    original = process_documents.vault_kv_client
+    try:
+        process_documents.vault_kv_client = "replaced"
+        status = "✓" if process_documents.get_vault_kv_client() == "replaced" else "✗"
+        print(f"  {status} assigning the module attribute replaces the lazily created client")
+        assert process_documents.get_vault_kv_client() == "replaced"
+    finally:
+        process_documents.vault_kv_client = original
+
+    print()
+
+def test_benchmark_harness():
+    """Test the pipeline benchmark end to end on small corpora against the stand-ins"""
+    print("Testing pipeline benchmark harness...")
+
+    import benchmark_pipeline
+
+    args = benchmark_pipeline.parse_args([
+        "--pii-docs", "2", "--pii-kb", "8", "--pdf-docs", "1", "--pdf-mb", "0.2", "--tiny-docs", "5",
+        "--blob-latency-ms", "0", "--vault-latency-ms", "0", "--openwebui-latency-ms", "0",
+        "--docling-latency-ms", "0", "--conversion-ms", "0", "--timeout", "60"
+    ])
+    original = process_documents.blob_service_client
+    results = benchmark_pipeline.run_benchmark(args)
+    processed = {name: corpus["processed"] for name, corpus in results["corpora"].items()}
+    status = "✓" if processed == {"pii": 2, "pdf": 1, "tiny": 5} and results["openwebui_files"] == 8 else "✗"
+    print(f"  {status} every corpus processed into the fake OpenWebUI: {processed}")
+    assert processed == {"pii": 2, "pdf": 1, "tiny": 5} and results["openwebui_files"] == 8
+
+    stages = results["corpora"]["pdf"]["stages"]
+    expected = {"download", "convert", "pii_scan", "blob_upload", "openwebui_upload", "kb_add", "document"}
+    status = "✓" if expected <= set(stages) and stages["document"]["p99_ms"] >= stages["document"]["p50_ms"] > 0 else "✗"
+    print(f"  {status} p50/p99 per stage reported: {sorted(stages)}")
+    assert expected <= set(stages) and stages["document"]["p99_ms"] >= stages["document"]["p50_ms"] > 0
+    assert json.loads(json.dumps(results)) == results and process_documents.blob_service_client is original
+
+    print()
+
+def main():
+    """Run all tests"""
+    print("=" * 60)
+    print("DOCUMENT PIPELINE COMPONENT TEST")
+    print("=" * 60)
+    print()
+
+    test_local_change_feed()
+    test_polling_backoff()
+    test_change_feed_fallback()
+    test_single_listing_hierarchy()
+    test_pii_pattern_cache()
+    test_single_pass_pii_scanner()
+    test_streaming_redaction()
+    test_batched_vault_transform()
+    test_pooled_http_client()
+    test_knowledge_base_directory()
+    test_in_memory_data_path()
+    test_blob_transfer()
+    test_async_io_engine()
+    test_processing_ledger()
+    test_conversion_cache()
+    test_docling_serve_backend()
+    test_format_router()
+    test_upload_scheduler()
+    test_work_claims()
+    test_dead_letter()
+    test_metrics()
+    test_pipeline_health()
+    test_health_server_comparisons()
+    test_lazy_imports()
+    test_benchmark_harness()
+
+    print("=" * 60)
+    print("All pipeline component tests passed")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    main()
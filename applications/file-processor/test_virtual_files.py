@@ -10,7 +10,6 @@ import os
 import sys
 import tempfile
 import json
-from azure.storage.blob import BlobServiceClient
 
 # Add the current directory to Python path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -1,6 +1,11 @@
+import { createHash } from 'crypto'
 import { NextRequest, NextResponse } from 'next/server'
 import { BlobServiceClient } from '@azure/storage-blob'
 
+// Large uploads are split into blocks sent in parallel; small ones go in a single request
+const UPLOAD_BLOCK_SIZE = parseInt(process.env.UPLOAD_BLOCK_SIZE_MB || '8', 10) * 1024 * 1024
+const UPLOAD_CONCURRENCY = parseInt(process.env.UPLOAD_CONCURRENCY || '8', 10)
+
 export async function POST(request: NextRequest) {
   try {
     const formData = await request.formData()
@@ -41,10 +46,16 @@ export async function POST(request: NextRequest) {
     // Convert file to buffer and upload
     const arrayBuffer = await file.arrayBuffer()
     const buffer = Buffer.from(arrayBuffer)
+    // Stored with the blob so the file processor can verify what it downloads
+    const contentMD5 = createHash('md5').update(buffer).digest()
     
-    await blockBlobClient.upload(buffer, buffer.length, {
+    await blockBlobClient.uploadData(buffer, {
+      blockSize: UPLOAD_BLOCK_SIZE,
+      maxSingleShotSize: UPLOAD_BLOCK_SIZE,
+      concurrency: UPLOAD_CONCURRENCY,
       blobHTTPHeaders: {
         blobContentType: file.type,
+        blobContentMD5: contentMD5,
       },
       metadata: {
         originalName: file.name,
@@ -55,6 +66,24 @@ export async function POST(request: NextRequest) {
       }
     })
 
+    // Notify the file processor so processing starts now instead of on its next poll
+    const notifyUrl = process.env.FILE_PROCESSOR_NOTIFY_URL
+    if (notifyUrl) {
+      try {
+        await fetch(notifyUrl, {
+          method: 'POST',
+          headers: {
+            'Content-Type': 'application/json',
+            ...(process.env.FILE_PROCESSOR_NOTIFY_TOKEN ? { 'X-Notify-Token': process.env.FILE_PROCESSOR_NOTIFY_TOKEN } : {})
+          },
+          body: JSON.stringify({ container: uploadContainer, blobName, size: buffer.length }),
+          signal: AbortSignal.timeout(2000)
+        })
+      } catch (error) {
+        console.warn('Failed to notify file processor, it will pick up the file on its next poll:', error)
+      }
+    }
+
     // Also upload to the appropriate knowledge base folder for organization
     if (knowledgeBase !== 'default') {
       try {
@@ -62,9 +91,13 @@ export async function POST(request: NextRequest) {
         const kbBlobName = `${knowledgeBase}/${Date.now()}-${file.name}`
         const kbBlockBlobClient = kbContainerClient.getBlockBlobClient(kbBlobName)
         
-        await kbBlockBlobClient.upload(buffer, buffer.length, {
+        await kbBlockBlobClient.uploadData(buffer, {
+          blockSize: UPLOAD_BLOCK_SIZE,
+          maxSingleShotSize: UPLOAD_BLOCK_SIZE,
+          concurrency: UPLOAD_CONCURRENCY,
           blobHTTPHeaders: {
             blobContentType: file.type,
+            blobContentMD5: contentMD5,
           },
           metadata: {
             originalName: file.name,
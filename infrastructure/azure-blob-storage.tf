@@ -44,6 +44,24 @@ resource "azurerm_storage_container" "knowledge_base" {
   container_access_type = "blob"
 }
 
+resource "azurerm_storage_container" "ledger" {
+  name                  = "ledger"
+  storage_account_id    = azurerm_storage_account.workshop_storage.id
+  container_access_type = "private"
+}
+
+resource "azurerm_storage_container" "locks" {
+  name                  = "locks"
+  storage_account_id    = azurerm_storage_account.workshop_storage.id
+  container_access_type = "private"
+}
+
+resource "azurerm_storage_container" "failed" {
+  name                  = "failed"
+  storage_account_id    = azurerm_storage_account.workshop_storage.id
+  container_access_type = "private"
+}
+
 resource "azurerm_storage_container" "nomad_data" {
   name                  = "nomad-data"
   storage_account_id    = azurerm_storage_account.workshop_storage.id
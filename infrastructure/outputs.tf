@@ -82,6 +82,9 @@ output "azure_storage" {
       uploads        = azurerm_storage_container.uploads.name
       processed      = azurerm_storage_container.processed.name
       knowledge_base = azurerm_storage_container.knowledge_base.name
+      ledger         = azurerm_storage_container.ledger.name
+      locks          = azurerm_storage_container.locks.name
+      failed         = azurerm_storage_container.failed.name
 
       nomad_data = azurerm_storage_container.nomad_data.name
     }
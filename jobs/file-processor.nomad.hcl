@@ -39,6 +39,8 @@ job "file-processor" {
   type = "service"
 
   group "file-processor-group" {
+    # Replicas claim uploads through blob leases. The web upload app notifies only
+    # one of them; the others find uploads through their fallback listing
     count = 1
 
     # Constraint to run on private clients only
@@ -48,16 +50,65 @@ job "file-processor" {
       value     = "false"
     }
 
+    network {
+      port "notify" {
+        to = 8082
+      }
+      port "health" {
+        to = 8081
+      }
+    }
+
     task "file-processor" {
       driver = "docker"
       
       config {
         image = "im2nguyenhashi/file-processor:latest"
+        ports = ["notify", "health"]
+      }
+
+      # Upload notifications from the web upload app (POST /notify)
+      service {
+        name = "file-processor-notify"
+        port = "notify"
+        provider = "nomad"
+      }
+
+      # Health, Prometheus metrics (GET /metrics) and document comparison
+      service {
+        name = "file-processor"
+        port = "health"
+        provider = "nomad"
+        tags = ["metrics"]
+
+        # Restart the task when the processing loop or a worker has stopped
+        check {
+          type     = "http"
+          name     = "file-processor-live"
+          path     = "/health/live"
+          interval = "15s"
+          timeout  = "3s"
+
+          check_restart {
+            limit = 3
+            grace = "120s"
+          }
+        }
+
+        # Blob Storage, OpenWebUI and docling-serve reachable
+        check {
+          type     = "http"
+          name     = "file-processor-ready"
+          path     = "/health/ready"
+          interval = "30s"
+          timeout  = "10s"
+        }
       }
 
+      # Conversion runs in the docling job; this task only moves documents and calls services
       resources {
-        cpu    = 4000
-        memory = 8192
+        cpu    = 1000
+        memory = 2048
       }
 
       env {
@@ -66,19 +117,43 @@ job "file-processor" {
         AZURE_STORAGE_CONNECTION_STRING = var.azure_storage_connection_string
         OPENWEBUI_API_KEY = var.openwebui_api_key
         PROCESSING_INTERVAL = "30"
+        MIN_POLL_INTERVAL = "2"
+        CHANGE_FEED = "http"
+        CHANGE_FEED_PORT = "8082"
+        HEALTH_PORT = "8081"
+        MAX_WORKERS = "4"
+        CONVERSION_PROCESSES = "0"
+        CONVERSION_BACKEND = "remote"
+        DOCLING_SERVE_MAX_CONCURRENCY = "4"
+        # No local Docling in this task's memory: while DOCLING_SERVE_URL is empty (no docling
+        # service registered yet) or docling-serve is down, readiness fails and uploads that
+        # need Docling are left unclaimed; text, markdown, JSON and XML are still processed
+        DOCLING_SERVE_FALLBACK = "false"
         UPLOAD_CONTAINER = "uploads"
         PROCESSED_CONTAINER = "processed"
+        LEDGER_CONTAINER = "ledger"
+        LOCK_CONTAINER = "locks"
+        LEASE_DURATION = "30"
+        FAILED_CONTAINER = "failed"
+        MAX_ATTEMPTS = "5"
         KNOWLEDGE_BASE_CONTAINER = "knowledge-base"
         OPENWEBUI_URL = "http://${var.client_ip}:8080"
         VAULT_ADDR = var.vault_addr
         VAULT_TOKEN = var.vault_token
         VAULT_TRANSFORM_PATH = var.vault_transform_path
         VAULT_ROLE = var.vault_role
+        PII_PATTERN_TTL = "300"
+        # Opt-in: cached markdown is not yet PII-protected, so it stays in the allocation
+        # directory (removed with the allocation) and unused entries expire after a day
+        CONVERSION_CACHE_ENABLED = "true"
+        CONVERSION_CACHE_DIR = "${NOMAD_ALLOC_DIR}/conversion-cache"
+        CONVERSION_CACHE_MAX_AGE = "86400"
       }
 
       template {
         data = <<EOH
 OPENWEBUI_URL="{{ range nomadService "openwebui" }}http://{{ .Address }}:{{ .Port }}{{ end }}"
+DOCLING_SERVE_URL="{{ range nomadService "docling" }}http://{{ .Address }}:{{ .Port }}{{ end }}"
 EOH
         destination = "local/openwebui_url.txt"
         env         = true
@@ -74,6 +74,17 @@ job "web-upload-app" {
         NEXT_PUBLIC_APP_URL = "http://${var.client_ip}:3000"
 
       }
+
+      # One file processor replica is notified; any replica can claim the upload,
+      # and the others still find it through their fallback listing
+      template {
+        data = <<EOH
+FILE_PROCESSOR_NOTIFY_URL="{{ with nomadService "file-processor-notify" }}{{ with index . 0 }}http://{{ .Address }}:{{ .Port }}/notify{{ end }}{{ end }}"
+EOH
+        destination = "local/file_processor_notify.env"
+        env         = true
+        change_mode = "restart"
+      }
     }
   }
 } 
\ No newline at end of file